@@ -10,11 +10,11 @@ import numpy as np
 import pandas as pd
 import fire
 from scipy import stats
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 
 from vgc_project import utils
 from vgc_project.dynamic_vgc import dynamic_vgc
-from vgc_project.dynamic_vgc.dynamic_vgc import solve_construal_switching_mdp
+from vgc_project.dynamic_vgc.dynamic_vgc import dynamic_vgc_sweep
 
 
 def start_logger_if_necessary(log_file):
@@ -26,13 +26,7 @@ def start_logger_if_necessary(log_file):
         logger.addHandler(fh)
     return logger
 
-def run_maze(maze_name, tile_array, dvgc_params):
-    logger = start_logger_if_necessary('gridsearch.log')
-    logger.debug(f"Calculating {maze_name}")
-    eval_stats = dynamic_vgc(
-        tile_array=tuple(tile_array),
-        **dvgc_params
-    )
+def obstacle_predictions(maze_name, tile_array, eval_stats):
     dvgc_preds = []
     obstacles = set(''.join(tile_array)) & set("0123456789")
     for o in obstacles:
@@ -42,24 +36,50 @@ def run_maze(maze_name, tile_array, dvgc_params):
             dvgc_occ=eval_stats['obs_occ'].get(o, 0),
             dvgc_occ_prob=eval_stats['obs_prob'].get(o, 0)
         ))
+    return dvgc_preds
+
+def run_maze(maze_name, tile_array, dvgc_params):
+    logger = start_logger_if_necessary('gridsearch.log')
+    logger.debug(f"Calculating {maze_name}")
+    eval_stats = dynamic_vgc(
+        tile_array=tuple(tile_array),
+        **dvgc_params
+    )
     return {
         'grid': maze_name,
         'eval_stats': eval_stats,
-        'dvgc_preds': dvgc_preds
+        'dvgc_preds': obstacle_predictions(maze_name, tile_array, eval_stats)
     }
 
-def calculate_maze_predictions(dvgc_params, mazes_to_run, parallel=None):
-    if parallel:
-        maze_predictions = parallel(
-            delayed(run_maze)(maze_name, tile_array, dvgc_params)
-            for maze_name, tile_array in mazes_to_run.items()
-        )
-    else:
-        maze_predictions = [
-            run_maze(maze_name, tile_array, dvgc_params)
-            for maze_name, tile_array in mazes_to_run.items()
-        ]
-    return maze_predictions
+def run_maze_sweep(maze_name, tile_array, param_sets):
+    """
+    Runs all parameter sets on one maze with `dynamic_vgc_sweep`, so each
+    switching MDP is solved once per worker rather than once per parameter set.
+    """
+    logger = start_logger_if_necessary('gridsearch.log')
+    logger.debug(f"Sweeping {maze_name}")
+    sweep = dynamic_vgc_sweep([
+        {**params, 'tile_array': tuple(tile_array)}
+        for params in param_sets
+    ])
+    logger.debug(f"Finished {maze_name}: {pprint.pformat(sweep.stats)}")
+    return {
+        'grid': maze_name,
+        'dvgc_preds': [
+            obstacle_predictions(maze_name, tile_array, eval_stats)
+            for eval_stats in sweep.results
+        ],
+        'sweep_stats': sweep.stats
+    }
+
+def write_predictions(run_name, param_sets, maze_sweeps):
+    # results are ordered by parameter set, then maze
+    all_maze_preds = []
+    for param_i, params in enumerate(param_sets):
+        for maze_sweep in maze_sweeps:
+            all_maze_preds.extend([{**params, **r} for r in maze_sweep['dvgc_preds'][param_i]])
+    with open(f"./results/{run_name}.json", "w") as file:
+        file.write(json.dumps(all_maze_preds))
 
 def main(n_jobs=2, seed=21912491, run_name=None):
     if run_name is None:
@@ -103,50 +123,40 @@ def main(n_jobs=2, seed=21912491, run_name=None):
     ground_param_names, ground_param_vals = zip(*ground_param_space)
     switch_param_names, switch_param_vals = zip(*switch_param_space)
 
-    all_maze_preds = []
+    param_sets = [
+        {
+            **default_dvgc_params,
+            **dict(zip(ground_param_names, ground_params)),
+            **dict(zip(switch_param_names, switch_params))
+        }
+        for ground_params, switch_params in product(
+            product(*ground_param_vals),
+            product(*switch_param_vals)
+        )
+    ]
+    logger.debug(f"Parameter sets: {len(param_sets)}")
+    maze_items = list(mazes.items())
+    batch_size = effective_n_jobs(n_jobs)
+    maze_sweeps = []
     with Parallel(n_jobs=n_jobs, backend="loky") as parallel:
-        param_iter = list(product(
-            enumerate(product(*ground_param_vals)),
-            enumerate(product(*switch_param_vals))
-        ))
-        logger.debug(f"Parameter sets: {len(param_iter)}")
-        for (ground_i, ground_params), (switch_i, switch_params) in param_iter:
-            ground_params = dict(zip(ground_param_names, ground_params))
-            switch_params = dict(zip(switch_param_names, switch_params))
-            if switch_i == 0:
-                with open(f"./results/{run_name}.json", "w") as file:
-                    file.write(json.dumps(all_maze_preds))
-                logger.debug(f"Time elapsed: {time.time() - start}")
-                logger.debug(f"Construal Switching Solver Cache")
-                logger.debug(pprint.pformat(dict(solve_construal_switching_mdp.cache_info()._asdict())))
-                logger.debug("Ground Params:")
-                logger.debug(pprint.pformat(ground_params))
-            logger.debug("Switch Params:")
-            logger.debug(pprint.pformat(switch_params))
-
-            # calculate maze predictions
-            params = {
-                **default_dvgc_params,
-                **ground_params,
-                **switch_params
-            }
-            if switch_i == 0:
-                maze_preds = calculate_maze_predictions(params, mazes, parallel=None)
-            else:
-                maze_preds = calculate_maze_predictions(params, mazes, parallel=parallel)
-
-            # save results
-            maze_obs_preds = sum([r['dvgc_preds'] for r in maze_preds], [])
-            maze_obs_preds = [{**params, **r}for r in maze_obs_preds]
-            all_maze_preds.extend(maze_obs_preds)
-
-    with open(f"./results/{run_name}.json", "w") as file:
-        file.write(json.dumps(all_maze_preds))
-
+        # sweep one maze per worker at a time and save the results so far after each batch
+        for batch_start in range(0, len(maze_items), batch_size):
+            maze_sweeps.extend(parallel(
+                delayed(run_maze_sweep)(maze_name, tile_array, param_sets)
+                for maze_name, tile_array in maze_items[batch_start:batch_start + batch_size]
+            ))
+            write_predictions(run_name, param_sets, maze_sweeps)
+            logger.debug(f"Mazes finished: {len(maze_sweeps)}/{len(maze_items)}")
+            logger.debug(f"Time elapsed: {time.time() - start}")
+
+    sweep_stats = {}
+    for maze_sweep in maze_sweeps:
+        for stat, count in maze_sweep['sweep_stats'].items():
+            sweep_stats[stat] = sweep_stats.get(stat, 0) + count
     run_summary = dict(
-        param_sets_evaluated=len(param_iter),
+        param_sets_evaluated=len(param_sets),
         total_time=time.time() - start,
-        cache_stats=dict(solve_construal_switching_mdp.cache_info()._asdict()),
+        sweep_stats=sweep_stats,
         seed=seed,
         n_jobs=n_jobs
     )
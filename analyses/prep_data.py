@@ -81,7 +81,7 @@ mazes = {
     **{k: tuple(v) for k,v in mazes_12_15.items()}
 }
 
-mods = create_modeling_interface(joblib_cache_location="./_analysiscache")
+mods = create_modeling_interface(cache_location="./_analysiscache")
 model_preds = []
 for grid, tile_array in mazes.items():
     for obs in sorted(set("0123456789") & set.union(*[set(r) for r in tile_array])):
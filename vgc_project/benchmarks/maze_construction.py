@@ -0,0 +1,74 @@
+"""
+Times `Maze` construction against grid size, comparing the array-based
+transition/reward construction to the per-state-action loop.
+
+    $ python maze_construction.py --sizes="[5, 11, 21, 31]" --repeats=3
+"""
+import time
+import random
+
+import fire
+import numpy as np
+
+from vgc_project.maze import Maze
+from vgc_project.tests.test_maze import loop_transition_reward_matrices
+
+def random_tile_array(size, obstacle_density=.2, rng=random):
+    tiles = [
+        [rng.choice("0123456789") if rng.random() < obstacle_density else "." for _ in range(size)]
+        for _ in range(size)
+    ]
+    tiles[-1][0] = "S"
+    tiles[0][-1] = "G"
+    return tuple("".join(row) for row in tiles)
+
+def maze_params(tile_array):
+    return dict(
+        tile_array=tile_array,
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=1.0-1e-5,
+        success_prob=1-1e-5,
+        wall_bias=.1
+    )
+
+def time_loop_construction(maze, params):
+    start = time.perf_counter()
+    tf, rf = loop_transition_reward_matrices(
+        maze,
+        move_prob=params['success_prob'],
+        wall_block_prob=1.0,
+        step_cost=params['step_cost'],
+        wall_bump_cost=0,
+        include_action_effect=True,
+        include_wall_effect=True,
+        include_terminal_state_effect=True
+    )
+    return time.perf_counter() - start, tf, rf
+
+def main(sizes=(5, 11, 21, 31), repeats=3, seed=1234):
+    rng = random.Random(seed)
+    print(f"{'size':>6} {'states':>8} {'vectorized (s)':>15} {'loop (s)':>10} {'speedup':>8}")
+    for size in sizes:
+        params = maze_params(random_tile_array(size, rng=rng))
+        vectorized_times, loop_times = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            maze = Maze(**params)
+            vectorized_times.append(time.perf_counter() - start)
+            loop_time, tf, rf = time_loop_construction(maze, params)
+            loop_times.append(loop_time)
+            assert (tf == maze.transition_matrix).all()
+            assert (rf == maze.reward_matrix).all()
+        vectorized_time, loop_time = min(vectorized_times), min(loop_times)
+        print(
+            f"{size:>6} {len(maze.state_list):>8} {vectorized_time:>15.4f} "
+            f"{loop_time:>10.4f} {loop_time/vectorized_time:>8.1f}"
+        )
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,104 @@
+"""
+Times `sparse_value_iteration` on a construal switching MDP, comparing the
+dense-vector sweep orders to the previous implementation, which kept the
+value vector as a sparse column.
+
+    $ python value_iteration.py --n_obstacles=4 --repeats=3
+"""
+import time
+from itertools import combinations
+
+import fire
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from vgc_project.dynamic_vgc import ConstrualSwitchingMDP
+from vgc_project.sparse.sparse_solvers import sparse_value_iteration
+
+def csr_value_iteration(
+    transition_matrix,
+    state_action_reward_matrix,
+    n_states,
+    n_actions,
+    discount_rate,
+    max_iterations,
+    convergence_diff
+):
+    v = csr_matrix((n_states, 1), dtype=transition_matrix.dtype)
+    for i in range(max_iterations):
+        q = state_action_reward_matrix + \
+            (discount_rate*transition_matrix*v).reshape(n_states, n_actions)
+        nv = q.max(-1)
+        diff = np.abs(v - nv)
+        if np.max(diff) < convergence_diff:
+            break
+        v = csr_matrix(nv)
+    return np.array(v.toarray()).flatten(), i
+
+def switching_mdp(n_obstacles, discount_rate):
+    obstacles = "0123456789"[:n_obstacles]
+    ground_mdp_params = dict(
+        tile_array=(
+            'S.....2......',
+            '.1#..........',
+            '0.......3....',
+            '.....4.......',
+            '........5...G',
+        ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=discount_rate,
+        success_prob=.9
+    )
+    return ConstrualSwitchingMDP(
+        construals=tuple("".join(c) for n in range(len(obstacles) + 1) for c in combinations(obstacles, n)),
+        initial_construal="",
+        eval_ground_mdp_params=ground_mdp_params,
+        policy_ground_mdp_params=ground_mdp_params,
+        ground_policy_inv_temp=1.,
+        ground_policy_rand_choose=.1,
+        added_obs_cost=1,
+        removed_obs_cost=0,
+        continuing_obs_cost=0,
+        construal_switch_cost=.1,
+        discount_rate=discount_rate
+    )
+
+def main(n_obstacles=4, discount_rate=.99, convergence_diff=1e-8, repeats=3):
+    mdp = switching_mdp(n_obstacles, discount_rate)
+    n_states, n_actions = len(mdp.state_list), len(mdp.action_list)
+    kwargs = dict(
+        transition_matrix=mdp.transition_matrix,
+        state_action_reward_matrix=csr_matrix(mdp.state_action_reward_matrix),
+        n_states=n_states,
+        n_actions=n_actions,
+        discount_rate=discount_rate,
+        max_iterations=int(1e6),
+        convergence_diff=convergence_diff
+    )
+    print(f"{n_states} states, {n_actions} actions, {mdp.transition_matrix.nnz} transitions")
+    print(f"{'method':>14} {'sweeps':>7} {'time (s)':>9} {'speedup':>8} {'max value diff':>15}")
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        csr_v, csr_iterations = csr_value_iteration(**kwargs)
+        times.append(time.perf_counter() - start)
+    csr_time = min(times)
+    print(f"{'csr (before)':>14} {csr_iterations + 1:>7} {csr_time:>9.4f} {1:>8.1f} {0:>15.2e}")
+    for sweep_order in ["jacobi", "gauss_seidel", "prioritized"]:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            res = sparse_value_iteration(**kwargs, sweep_order=sweep_order)
+            times.append(time.perf_counter() - start)
+        print(
+            f"{sweep_order:>14} {res.iterations + 1:>7} {min(times):>9.4f} "
+            f"{csr_time/min(times):>8.1f} {np.abs(res.state_value_vec - csr_v).max():>15.2e}"
+        )
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,279 @@
+"""
+Persistent, content-addressed store for intermediate artifacts
+(solved Q-matrices, switching MDP solutions, model predictions, ...).
+
+Entries are keyed by a stable hash of their canonicalized parameters and
+stored as a pickle in which NumPy arrays are replaced by `.npy` files that
+are memory-mapped when loaded. Entries are written atomically, so the store
+can be shared by many worker processes, and the least recently used entries
+are evicted once the store exceeds its size budget.
+
+The default store is configured with `configure_artifact_store` or the
+`VGC_CACHE_DIR` and `VGC_CACHE_MAX_BYTES` environment variables.
+"""
+import os
+import io
+import json
+import time
+import uuid
+import shutil
+import pickle
+import inspect
+import hashlib
+import functools
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+# relative to the working directory, like the joblib cache it replaces
+DEFAULT_CACHE_DIR = "./_cache"
+DEFAULT_MAX_BYTES = 10*2**30
+MIN_MEMMAP_BYTES = 1024
+
+def _canonicalize(obj):
+    if obj is None or isinstance(obj, (bool, int, str)):
+        return obj
+    if isinstance(obj, float):
+        return ["float", repr(obj)]
+    if isinstance(obj, np.generic):
+        return _canonicalize(obj.item())
+    if isinstance(obj, np.ndarray):
+        return ["ndarray", obj.dtype.str, list(obj.shape), hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest()]
+    if isinstance(obj, (tuple, list)):
+        return ["seq", [_canonicalize(e) for e in obj]]
+    if isinstance(obj, (set, frozenset)):
+        return ["set", sorted([_canonicalize(e) for e in obj], key=json.dumps)]
+    if hasattr(obj, "to_numpy") and hasattr(obj, "columns"):
+        import pandas as pd
+        return ["dataframe", hashlib.sha256(pd.util.hash_pandas_object(obj, index=True).values).hexdigest()]
+    if isinstance(obj, dict) or hasattr(obj, "items"):
+        items = [[_canonicalize(k), _canonicalize(v)] for k, v in obj.items()]
+        return ["map", sorted(items, key=json.dumps)]
+    raise TypeError(f"Cannot compute a stable hash for objects of type {type(obj)}")
+
+def stable_hash(obj):
+    """
+    Hash of `obj` that is the same across processes and sessions (unlike
+    `hash`). Dicts and sets are canonicalized so that ordering does not matter.
+    """
+    return hashlib.sha256(json.dumps(_canonicalize(obj)).encode()).hexdigest()
+
+class _ArrayPickler(pickle.Pickler):
+    def __init__(self, file, entry_dir):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.entry_dir = entry_dir
+        self.n_arrays = 0
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject or obj.nbytes < MIN_MEMMAP_BYTES:
+            return None
+        array_file = f"array-{self.n_arrays}.npy"
+        np.save(os.path.join(self.entry_dir, array_file), obj)
+        self.n_arrays += 1
+        return array_file
+
+class _ArrayUnpickler(pickle.Unpickler):
+    def __init__(self, file, entry_dir, mmap_mode):
+        super().__init__(file)
+        self.entry_dir = entry_dir
+        self.mmap_mode = mmap_mode
+    def persistent_load(self, array_file):
+        return np.load(os.path.join(self.entry_dir, array_file), mmap_mode=self.mmap_mode)
+
+def _touch(path):
+    # filesystem timestamps can be too coarse to order recent accesses
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+class ArtifactStore:
+    def __init__(self, location=None, max_bytes=None, mmap_mode='c'):
+        """
+        location :
+            Directory of the store (default: `$VGC_CACHE_DIR` or `./_cache`)
+        max_bytes :
+            Size budget in bytes (default: `$VGC_CACHE_MAX_BYTES` or 10GB)
+        mmap_mode :
+            Mode used to memory-map stored arrays. The default, `'c'`
+            (copy-on-write), lets callers modify loaded arrays in memory.
+        """
+        if location is None:
+            location = os.environ.get("VGC_CACHE_DIR", DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("VGC_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.location = os.path.abspath(location)
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.stats = dict(hits=0, misses=0, writes=0, evictions=0)
+        # size of the store at the last scan plus bytes written since then
+        self._estimated_bytes = None
+        self._writes_since_scan = 0
+
+    def _entry_dir(self, namespace, key):
+        return os.path.join(self.location, namespace, key[:2], key)
+
+    def get(self, namespace, key):
+        """Returns `(True, value)` for a stored entry and `(False, None)` otherwise"""
+        entry_dir = self._entry_dir(namespace, key)
+        value_file = os.path.join(entry_dir, "value.pkl")
+        try:
+            with open(value_file, 'rb') as file:
+                value = _ArrayUnpickler(file, entry_dir, self.mmap_mode).load()
+            _touch(value_file)
+        except (FileNotFoundError, EOFError):
+            # missing, or evicted while it was being read
+            self.stats['misses'] += 1
+            return False, None
+        self.stats['hits'] += 1
+        return True, value
+
+    def put(self, namespace, key, value):
+        entry_dir = self._entry_dir(namespace, key)
+        if os.path.exists(entry_dir):
+            return
+        tmp_dir = os.path.join(self.location, ".tmp", uuid.uuid4().hex)
+        os.makedirs(tmp_dir)
+        try:
+            buffer = io.BytesIO()
+            _ArrayPickler(buffer, tmp_dir).dump(value)
+            with open(os.path.join(tmp_dir, "value.pkl"), 'wb') as file:
+                file.write(buffer.getvalue())
+            _touch(os.path.join(tmp_dir, "value.pkl"))
+            n_bytes = sum(f.stat().st_size for f in os.scandir(tmp_dir))
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            os.rename(tmp_dir, entry_dir)
+            self.stats['writes'] += 1
+        except OSError:
+            # another process stored the same entry first
+            if not os.path.exists(entry_dir):
+                raise
+            return
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # other processes also write to the store, so rescan it periodically
+        self._writes_since_scan += 1
+        if self._estimated_bytes is not None:
+            self._estimated_bytes += n_bytes
+        if self._estimated_bytes is None or \
+                self._estimated_bytes > self.max_bytes or \
+                self._writes_since_scan >= 100:
+            self.evict()
+
+    def entries(self):
+        """Yields `(last_access_time, n_bytes, entry_dir)` for every entry"""
+        if not os.path.isdir(self.location):
+            return
+        for namespace in os.scandir(self.location):
+            if not namespace.is_dir() or namespace.name.startswith("."):
+                continue
+            for prefix in os.scandir(namespace.path):
+                for entry in os.scandir(prefix.path):
+                    try:
+                        files = list(os.scandir(entry.path))
+                        n_bytes = sum(f.stat().st_size for f in files)
+                        atime = os.stat(os.path.join(entry.path, "value.pkl")).st_mtime_ns
+                    except FileNotFoundError:
+                        continue
+                    yield atime, n_bytes, entry.path
+
+    def size(self):
+        return sum(n_bytes for _, n_bytes, _ in self.entries())
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(self.location, exist_ok=True)
+        with open(os.path.join(self.location, ".lock"), 'w') as lock_file:
+            if fcntl is None:
+                yield True
+                return
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is already evicting
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict(self, max_bytes=None):
+        """Removes least recently used entries until the store fits in `max_bytes`"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock() as acquired:
+            if not acquired:
+                return
+            entries = sorted(self.entries())
+            total_bytes = sum(n_bytes for _, n_bytes, _ in entries)
+            for _, n_bytes, entry_dir in entries:
+                if total_bytes <= max_bytes:
+                    break
+                # renaming is atomic, so readers see either the full entry or none
+                trash_dir = os.path.join(self.location, ".tmp", uuid.uuid4().hex)
+                os.makedirs(os.path.dirname(trash_dir), exist_ok=True)
+                try:
+                    os.rename(entry_dir, trash_dir)
+                except FileNotFoundError:
+                    continue
+                shutil.rmtree(trash_dir, ignore_errors=True)
+                total_bytes -= n_bytes
+                self.stats['evictions'] += 1
+            self._estimated_bytes = total_bytes
+            self._writes_since_scan = 0
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+    def cache(self, func=None, *, namespace=None):
+        """Decorator that stores the results of `func` in this store"""
+        if func is None:
+            return functools.partial(self.cache, namespace=namespace)
+        return cache_artifact(func, namespace=namespace, store=self)
+
+_default_store = None
+def get_artifact_store():
+    """Returns the default `ArtifactStore`"""
+    global _default_store
+    if _default_store is None:
+        _default_store = ArtifactStore()
+    return _default_store
+
+def configure_artifact_store(location=None, max_bytes=None, **kwargs):
+    """Sets the location and size budget of the default `ArtifactStore`"""
+    global _default_store
+    _default_store = ArtifactStore(location=location, max_bytes=max_bytes, **kwargs)
+    return _default_store
+
+def cache_artifact(func=None, *, namespace=None, store=None):
+    """
+    Decorator that stores results in an `ArtifactStore` (the default
+    store, looked up at call time, if `store` is None). Keys are a stable hash
+    of the function's source code and its arguments with defaults applied.
+    """
+    if func is None:
+        return functools.partial(cache_artifact, namespace=namespace, store=store)
+    if namespace is None:
+        namespace = f"{func.__module__}.{func.__qualname__}".replace("<locals>.", "")
+    try:
+        func_code = inspect.getsource(func)
+    except (OSError, TypeError):
+        func_code = ""
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        artifact_store = get_artifact_store() if store is None else store
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = stable_hash([func_code, bound.args, bound.kwargs])
+        found, value = artifact_store.get(namespace, key)
+        if found:
+            return value
+        value = func(*args, **kwargs)
+        artifact_store.put(namespace, key, value)
+        return value
+    wrapped.namespace = namespace
+    return wrapped
@@ -0,0 +1,134 @@
+"""
+Policy and value iteration over a batch of MDPs that share the same
+state and action spaces (e.g., the construals of a maze). Every Bellman
+backup and policy evaluation step is done for all MDPs at once with
+batched `einsum` and `linalg.solve` calls.
+
+Transition matrices are stacked into a dense `(C, S, A, S)` array,
+terminal states should have no outgoing transitions, and state-action
+rewards are either `(C, S, A)` or a shared `(S, A)` array.
+"""
+from types import SimpleNamespace
+import numpy as np
+
+def batched_policy_iteration(
+    transition_matrices,
+    state_action_reward_matrices,
+    discount_rate,
+    initial_state_vec=None,
+    max_iterations=int(1e5),
+    value_decimals=10,
+    initial_policies=None
+):
+    n_mdps, n_states, n_actions, _ = transition_matrices.shape
+    sa_rf = np.broadcast_to(state_action_reward_matrices, (n_mdps, n_states, n_actions))
+    if initial_policies is None:
+        pi = np.zeros((n_mdps, n_states), dtype=int)
+    else:
+        pi = np.array(initial_policies, dtype=int)
+    ss_eye = np.eye(n_states)
+    s_range = np.arange(n_states)[None, :]
+
+    v = np.zeros((n_mdps, n_states))
+    q = np.zeros((n_mdps, n_states, n_actions))
+    iterations = np.zeros(n_mdps, dtype=int)
+    converged = np.zeros(n_mdps, dtype=bool)
+    active = np.arange(n_mdps)
+    for i in range(max_iterations):
+        # avoid copying the full stack while every MDP is still active
+        if len(active) == n_mdps:
+            a_tf = transition_matrices
+        else:
+            a_tf = transition_matrices[active]
+        a_rf, a_pi = sa_rf[active], pi[active]
+        mp = transition_matrices[active[:, None], s_range, a_pi]
+        s_rf = a_rf[np.arange(len(active))[:, None], s_range, a_pi]
+        a_v = np.linalg.solve(ss_eye[None] - discount_rate*mp, s_rf[..., None])[..., 0]
+        if np.isnan(a_v).any():
+            raise ValueError("Error solving for values - discount*transition_matrix might be singular")
+        a_q = a_rf + discount_rate*(
+            a_tf.reshape(len(active), n_states*n_actions, n_states)@a_v[..., None]
+        ).reshape(len(active), n_states, n_actions)
+        new_pi = np.round(a_q, decimals=value_decimals).argmax(-1)
+        v[active], q[active], iterations[active] = a_v, a_q, i
+        done = (new_pi == a_pi).all(-1)
+        converged[active[done]] = True
+        pi[active[~done]] = new_pi[~done]
+        active = active[~done]
+        if len(active) == 0:
+            break
+    res = SimpleNamespace(
+        state_value_vecs=v,
+        state_action_value_matrices=q,
+        policies=pi,
+        iterations=iterations,
+        converged=converged
+    )
+    if initial_state_vec is not None:
+        res.initial_values = v@initial_state_vec
+    return res
+
+def batched_value_iteration(
+    transition_matrices,
+    state_action_reward_matrices,
+    discount_rate,
+    initial_state_vec=None,
+    max_iterations=int(1e5),
+    convergence_diff=1e-8
+):
+    n_mdps, n_states, n_actions, _ = transition_matrices.shape
+    sa_rf = np.broadcast_to(state_action_reward_matrices, (n_mdps, n_states, n_actions))
+    v = np.zeros((n_mdps, n_states))
+    q = np.zeros((n_mdps, n_states, n_actions))
+    iterations = np.zeros(n_mdps, dtype=int)
+    converged = np.zeros(n_mdps, dtype=bool)
+    active = np.arange(n_mdps)
+    for i in range(max_iterations):
+        a_q = sa_rf[active] + discount_rate*np.einsum("csan,cn->csa", transition_matrices[active], v[active])
+        a_v = a_q.max(-1)
+        done = np.abs(a_v - v[active]).max(-1) < convergence_diff
+        v[active], q[active], iterations[active] = a_v, a_q, i
+        converged[active[done]] = True
+        active = active[~done]
+        if len(active) == 0:
+            break
+    res = SimpleNamespace(
+        state_value_vecs=v,
+        state_action_value_matrices=q,
+        policies=q.argmax(-1),
+        iterations=iterations,
+        converged=converged
+    )
+    if initial_state_vec is not None:
+        res.initial_values = v@initial_state_vec
+    return res
+
+def greedy_policy_matrices(state_action_value_matrices, value_decimals=10):
+    """
+    Converts `(..., S, A)` Q-values into policy matrices that choose
+    uniformly among the actions with maximal (rounded) value.
+    """
+    q = np.round(state_action_value_matrices, decimals=value_decimals)
+    pi = (q == q.max(-1, keepdims=True)).astype(float)
+    return pi/pi.sum(-1, keepdims=True)
+
+def batched_policy_evaluation(
+    policy_matrices,
+    transition_matrix,
+    reward_matrix,
+    discount_rate,
+    nonterminal_state_vec,
+    initial_state_vec
+):
+    """
+    Evaluates a `(C, S, A)` stack of policy matrices on a single MDP
+    with one batched linear solve and returns the `(C,)` initial values.
+    """
+    nt = nonterminal_state_vec.astype(bool)
+    tf = transition_matrix*nt[:, None, None]
+    sa_rf = np.einsum("san,san->sa", tf, reward_matrix)
+    mp = np.einsum("csa,san->csn", policy_matrices, tf)
+    s_rf = np.einsum("csa,sa->cs", policy_matrices, sa_rf)
+    ss_eye = np.eye(len(initial_state_vec))
+    v = np.linalg.solve(ss_eye[None] - discount_rate*mp, s_rf[..., None])[..., 0]
+    return v@initial_state_vec
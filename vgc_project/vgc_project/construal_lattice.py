@@ -0,0 +1,106 @@
+"""
+Plans on every construal in a lattice of construals, warm-starting
+policy iteration on each construal from the optimal policy of an
+already-solved construal with one fewer obstacle.
+
+Neighbouring construals differ by a single obstacle, so their optimal
+policies are usually nearly identical and policy iteration only needs
+a few improvement steps to converge.
+"""
+from types import SimpleNamespace
+import numpy as np
+from scipy.sparse import csr_matrix
+from msdm.core.problemclasses.mdp import TabularPolicy
+
+from vgc_project.sparse import sparse_policy_iteration
+from vgc_project.sparse.sparse_solvers import sparse_planning_matrices
+
+def construal_lattice_parents(construals):
+    """
+    Orders construals from smallest to largest and maps each one to an
+    earlier construal with exactly one fewer obstacle (or None).
+    """
+    construals = sorted(construals, key=lambda c: (len(c), ''.join(sorted(c))))
+    by_obstacles = {frozenset(c): c for c in construals}
+    parents = {}
+    for c in construals:
+        parents[c] = None
+        for o in sorted(c):
+            parent = by_obstacles.get(frozenset(c) - {o})
+            if parent is not None:
+                parents[c] = parent
+                break
+    return parents
+
+def plan_construal_lattice(
+    construals,
+    make_mdp,
+    compare_to_cold_start=False,
+    max_iterations=int(1e20),
+    value_decimals=10
+):
+    """
+    Solves `make_mdp(c)` for every construal `c` with sparse policy
+    iteration, starting each solve from the policy of its lattice parent.
+    The smallest construal starts from always taking the first action.
+
+    Each result has `_qvaluemat`, `_valuevec`, `policy`, `initial_value`,
+    `converged` and `iterations` like the msdm planning results.
+    If `compare_to_cold_start` is True, every construal is also solved
+    from the cold-start policy so that iterations saved can be reported.
+    """
+    parents = construal_lattice_parents(construals)
+    results = {}
+    iterations = {}
+    cold_start_iterations = {}
+    for c, parent in parents.items():
+        mdp = make_mdp(c)
+        tf, sa_rf = sparse_planning_matrices(mdp)
+        n_states, n_actions = sa_rf.shape
+        cold_start_pi = np.zeros(n_states, dtype=int)
+        if parent is None:
+            initial_pi = cold_start_pi
+        else:
+            initial_pi = results[parent]._qvaluemat.argmax(-1)
+        solver_kwargs = dict(
+            transition_matrix=tf,
+            state_action_reward_matrix=csr_matrix(sa_rf),
+            n_states=n_states,
+            n_actions=n_actions,
+            discount_rate=mdp.discount_rate,
+            max_iterations=max_iterations,
+            value_decimals=value_decimals
+        )
+        res = sparse_policy_iteration(**solver_kwargs, initial_pi=initial_pi)
+        results[c] = SimpleNamespace(
+            mdp=mdp,
+            _qvaluemat=res.state_action_value_matrix,
+            _valuevec=res.state_value_vec,
+            policy=TabularPolicy.from_q_matrix(
+                mdp.state_list,
+                mdp.action_list,
+                res.state_action_value_matrix
+            ),
+            initial_value=res.state_value_vec@mdp.initial_state_vec,
+            converged=res.converged,
+            iterations=res.iterations,
+            warm_start_parent=parent
+        )
+        iterations[c] = res.iterations
+        if compare_to_cold_start:
+            cold_res = sparse_policy_iteration(**solver_kwargs, initial_pi=cold_start_pi)
+            cold_start_iterations[c] = cold_res.iterations
+    stats = dict(
+        total_iterations=sum(iterations.values()),
+        iterations=iterations
+    )
+    if compare_to_cold_start:
+        stats['cold_start_iterations'] = cold_start_iterations
+        stats['total_cold_start_iterations'] = sum(cold_start_iterations.values())
+        stats['iterations_saved'] = \
+            stats['total_cold_start_iterations'] - stats['total_iterations']
+    return SimpleNamespace(
+        results=results,
+        parents=parents,
+        stats=stats
+    )
@@ -74,7 +74,15 @@ class ConstrualSearch(ABC):
         
         #assume that we do not re-compute construals
         assert i == len(construal_values) - 1 
+        return self.search_result(construal_values, construal_planner)
 
+    def construal_value(self, c, construal_planner):
+        """Plans with construal `c` (tracked by `construal_planner`) and returns its value"""
+        construal_planner(c)
+        c_utility = evaluate_construal(c, self.gw_params).initial_value #cachable func
+        return c_utility - len(c)
+
+    def search_result(self, construal_values, construal_planner):
         total_construal_cost = sum([len(c) for c in construal_planner.results.keys()])
         max_value = max(construal_values.values())
         max_construals = set(c for c, v in construal_values.items() if v == max_value)
@@ -84,7 +92,7 @@ class ConstrualSearch(ABC):
         return SimpleNamespace(
             construal_values=construal_values,
             total_construal_cost=total_construal_cost,
-            iterations=i,
+            iterations=len(construal_values) - 1,
             max_construals=max_construals,
             max_construals_utilities=max_construals_utilities,
             max_value=max_value
@@ -108,28 +116,38 @@ class ExhaustiveSearch(ConstrualSearch):
     def next_construal(self, c, construal_planner, rng=random):
         pass
     def search(self, event_listener=None, rng=random):
-        gw = create_gridworld(self.gw_params)
         construal_planner = self.make_construal_planner()
         construal_values = {}
-        for i, c in enumerate(powerset(self.effects_features)):
-            cpi = construal_planner(c) #just for counting
-            c_utility = evaluate_construal(c, self.gw_params).initial_value #cachable func
-            construal_values[c] = c_utility - len(c)
-        total_construal_cost = sum([len(c) for c in construal_planner.results.keys()])
-        max_value = max(construal_values.values())
-        max_construals = set(c for c, v in construal_values.items() if v == max_value)
-        max_construals_utilities = {}
-        for c in max_construals:
-            max_construals_utilities[c] = evaluate_construal(c, self.gw_params).initial_value
-        return SimpleNamespace(
-            construal_values=construal_values,
-            total_construal_cost=total_construal_cost,
-            iterations=i,
-            max_construals=max_construals,
-            max_construals_utilities=max_construals_utilities,
-            max_value=max_value
-        )
+        for c in powerset(self.effects_features):
+            construal_values[c] = self.construal_value(c, construal_planner)
+        return self.search_result(construal_values, construal_planner)
     
+class BranchAndBoundSearch(ExhaustiveSearch):
+    """
+    Exhaustive search that evaluates construals in order of increasing size
+    and stops once `U - len(c)`, where `U` is the optimal value of the
+    true gridworld, is below the best construal value found. This returns
+    the same maximal construals as `ExhaustiveSearch`. Computing `U` takes
+    one solve of the true gridworld (`bound_solves`), so the search saves
+    `skipped_solves - bound_solves` solves.
+    """
+    bound_slack = 1e-6
+    def search(self, event_listener=None, rng=random):
+        construal_planner = self.make_construal_planner()
+        utility_upper_bound = solve_gridworld(self.gw_params).initial_value + self.bound_slack
+        construals = sorted(powerset(self.effects_features), key=len)
+        construal_values = {}
+        for c in construals:
+            # construals are ordered by size, so no later construal can do better
+            if construal_values and utility_upper_bound - len(c) < max(construal_values.values()):
+                break
+            construal_values[c] = self.construal_value(c, construal_planner)
+        res = self.search_result(construal_values, construal_planner)
+        res.utility_upper_bound = utility_upper_bound
+        res.skipped_solves = len(construals) - len(construal_values)
+        res.bound_solves = 1
+        return res
+
 class BreadthFirstSearch(ConstrualSearch):
     def initialize(self, rng=random):
         self._queue = deque([])
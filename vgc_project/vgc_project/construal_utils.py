@@ -1,32 +1,44 @@
-from functools import lru_cache
 from itertools import combinations
 from frozendict import frozendict
 from msdm.domains import GridWorld
 from msdm.algorithms import PolicyIteration
+from vgc_project.sparse import PrioritizedValueIteration
+from vgc_project.memory_cache import memory_cache
 
 ##
 ## These functions cache computations for reuse
 ## across simulations.
 ##
-@lru_cache(maxsize=int(1e7))
+@memory_cache
 def _create_gridworld(gw_params):
-    return GridWorld(**gw_params)
+    gw = GridWorld(**gw_params)
+    # build the lazily computed matrices so they count towards the cache budget
+    for name in ("transition_matrix", "reward_matrix", "state_action_reward_matrix"):
+        getattr(gw, name)
+    return gw
 def create_gridworld(gw_params):
     if not isinstance(gw_params['tile_array'], tuple):
         gw_params = {**gw_params, 'tile_array': tuple(gw_params['tile_array'])}
     return _create_gridworld(frozendict(gw_params))
 
-@lru_cache(maxsize=int(1e7))
-def _solve_gridworld(gw_params):
+@memory_cache
+def _solve_gridworld(gw_params, planning_alg="policy_iteration"):
     gw = GridWorld(**gw_params)
-    res = PolicyIteration().plan_on(gw)
+    if planning_alg == "policy_iteration":
+        res = PolicyIteration().plan_on(gw)
+    elif planning_alg == "prioritized_value_iteration":
+        res = PrioritizedValueIteration(order="priority").plan_on(gw)
+    elif planning_alg == "topological_value_iteration":
+        res = PrioritizedValueIteration(order="topological").plan_on(gw)
+    else:
+        raise ValueError("Unknown planning alg")
     return res
-def solve_gridworld(gw_params):
+def solve_gridworld(gw_params, planning_alg="policy_iteration"):
     if not isinstance(gw_params['tile_array'], tuple):
         gw_params = {**gw_params, 'tile_array': tuple(gw_params['tile_array'])}
-    return _solve_gridworld(frozendict(gw_params))
+    return _solve_gridworld(frozendict(gw_params), planning_alg=planning_alg)
 
-@lru_cache(maxsize=int(1e7))
+@memory_cache
 def _evaluate_construal(c, gw_params):
     if not isinstance(gw_params['tile_array'], tuple):
         gw_params = {**gw_params, 'tile_array': tuple(gw_params['tile_array'])}
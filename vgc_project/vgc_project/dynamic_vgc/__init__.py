@@ -1,7 +1,8 @@
 from vgc_project.dynamic_vgc.utils import \
     create_maze, solve_maze, evaluate_construal, \
-    powerset, softmax_epsilon_policy_matrix
-from vgc_project.dynamic_vgc.switching_mdp import ConstrualSwitchingMDP
+    powerset, softmax_epsilon_policy_matrix, ground_policy_matrix
+from vgc_project.dynamic_vgc.switching_mdp import ConstrualSwitchingMDP, \
+    FactoredSwitchingPolicyIteration
 from vgc_project.dynamic_vgc.dynamic_vgc import dynamic_vgc
  
     
\ No newline at end of file
@@ -1,5 +1,8 @@
 import numpy as np 
 import random
+import inspect
+import scipy.sparse as sparse
+from scipy.sparse.linalg import spsolve
 from functools import lru_cache
 from frozendict import frozendict
 from types import SimpleNamespace
@@ -8,9 +11,11 @@ from msdm.algorithms import PolicyIteration, ValueIteration
 from msdm.core.problemclasses.mdp import TabularPolicy
 
 from vgc_project.sparse import SparsePolicyIteration, SparseTabularPolicy
-from vgc_project.dynamic_vgc import ConstrualSwitchingMDP
+from vgc_project.sparse.sparse_solvers import iterative_solve
+from vgc_project.dynamic_vgc import ConstrualSwitchingMDP, FactoredSwitchingPolicyIteration
 from vgc_project.maze import Maze, Location
 from vgc_project.dynamic_vgc import powerset, softmax_epsilon_policy_matrix, solve_maze
+from vgc_project.artifact_store import cache_artifact
 from collections import defaultdict
 
 
@@ -27,9 +32,23 @@ def make_construal_switching_mdp(switching_mdp_params):
 def solve_construal_switching_mdp(switching_mdp_params):
     max_iterations = 200
     cs_mdp = make_construal_switching_mdp(switching_mdp_params)
-    cs_mdp_res = SparsePolicyIteration(iterations=max_iterations).plan_on(cs_mdp)
+    cs_mdp_res = FactoredSwitchingPolicyIteration(iterations=max_iterations).plan_on(cs_mdp)
     return cs_mdp_res
 
+@cache_artifact(namespace="switching_mdp_solution")
+def solve_construal_switching_mdp_arrays(switching_mdp_params):
+    """
+    Q-values, state values and convergence of `solve_construal_switching_mdp`,
+    persisted in the artifact store
+    """
+    res = solve_construal_switching_mdp(switching_mdp_params)
+    return SimpleNamespace(
+        _qvaluemat=np.asarray(res._qvaluemat),
+        _valuevec=np.asarray(res._valuevec),
+        converged=bool(res.converged),
+        iterations=res.iterations
+    )
+
 def policy_evaluation_stats(policy_eval):
     # Calculates:
     # obstacle awareness count: occ(obs) = sum_c occ(obs, c)*1[obs \in c]
@@ -78,90 +97,195 @@ def policy_evaluation_stats(policy_eval):
         total_occ=total_occ
     )
 
-def evaluate_sparse_policy_matrix(policy_mat, mdp, n_simulations, max_sim_length):
+def cumulative_csr_rows(matrix):
+    """
+    Returns a CSR matrix with the same sparsity structure as `matrix` in
+    which every entry is the cumulative sum of its row up to that entry.
+    """
+    matrix = sparse.csr_matrix(matrix)
+    row_starts = matrix.indptr[:-1]
+    row_lengths = np.diff(matrix.indptr)
+    cum_data = matrix.data.astype(float)
+    for k in range(1, row_lengths.max(initial=0)):
+        idx = row_starts[row_lengths > k] + k
+        cum_data[idx] += cum_data[idx - 1]
+    return sparse.csr_matrix((cum_data, matrix.indices, matrix.indptr), shape=matrix.shape)
+
+def sample_csr_rows(cumulative_matrix, rows, u):
+    """
+    Inverse-CDF sampling of one column from each of `rows` of a
+    matrix returned by `cumulative_csr_rows`, given uniform draws `u`.
+    """
+    starts = cumulative_matrix.indptr[rows]
+    ends = cumulative_matrix.indptr[rows + 1]
+    cum_data = cumulative_matrix.data
+    targets = u*cum_data[ends - 1]
+    offsets = np.zeros(len(rows), dtype=int)
+    for k in range((ends - starts).max(initial=1) - 1):
+        has_k = starts + k < ends - 1
+        offsets += has_k & (cum_data[np.where(has_k, starts + k, 0)] <= targets)
+    return cumulative_matrix.indices[starts + offsets]
+
+def policy_transition_matrix(policy_mat, transition_matrix):
+    """Sparse `(S, S)` state transition matrix under a `(S, A)` policy matrix"""
+    if hasattr(transition_matrix, "policy_transition_matrix"):
+        return transition_matrix.policy_transition_matrix(policy_mat)
     n_states, n_actions = policy_mat.shape
-    terminal_states = (mdp.nonterminal_state_vec == 0)
+    policy_s_sa = sparse.csr_matrix(
+        (
+            policy_mat.reshape(-1),
+            (np.repeat(np.arange(n_states), n_actions), np.arange(n_states*n_actions))
+        ),
+        shape=(n_states, n_states*n_actions)
+    )
+    return sparse.csr_matrix(policy_s_sa@transition_matrix)
+
+def _transition_matrix(mdp):
+    # prefer matrix-free transition operators (e.g., of construal switching MDPs)
+    transition_operator = getattr(mdp, "transition_operator", None)
+    if transition_operator is not None:
+        return transition_operator
+    return mdp.transition_matrix
 
-    @lru_cache(maxsize=int(1e5))
-    def next_state_probs(sa_i):
-        ns_probs = mdp.transition_matrix[sa_i, :].A.flatten()
-        return ns_probs
-
-    def run_simulation():
-        state_traj = []
-        reward_traj = []
-        s_i = np.random.choice(n_states, p=mdp.initial_state_vec)
-        for timestep in range(max_sim_length):
-
-            a_i = np.random.choice(n_actions, p=policy_mat[s_i])
-            sa_i = s_i*n_actions + a_i #need to get state/action index
-            r = mdp.state_action_reward_matrix[s_i, a_i]
-
-            state_traj.append(mdp.state_list[s_i])
-            reward_traj.append(r)
-
-            ns_i = np.random.choice(n_states, p=next_state_probs(sa_i))
-            if terminal_states[ns_i]:
-                break
-            s_i = ns_i
-        if timestep == max_sim_length - 1:
-            raise ValueError("Maximum simulation length reached")
-        return state_traj, reward_traj
-
-    state_occ = {s: [] for s in mdp.state_list}
-    initial_value = []
-    for sim_i in np.arange(n_simulations):
-        state_traj, reward_traj = run_simulation()
-        for s in state_occ.keys():
-            state_occ[s].append(0)
-        for s in state_traj:
-            state_occ[s][-1] += 1
-        discounted_return = 0
-        discount = 1.0
-        for r in reward_traj:
-            discounted_return += r*discount
-            discount *= mdp.discount_rate
-        initial_value.append(discounted_return)
+def solve_sparse_linear_system(a, b, solver="spsolve", tol=1e-10):
+    """Solves `a x = b` with a direct (`spsolve`) or iterative (`gmres`, `bicgstab`) solver"""
+    a = sparse.csc_matrix(a)
+    if solver == "spsolve":
+        return spsolve(a, b)
+    x, info, _ = iterative_solve(solver, a, b, tol=tol)
+    if info != 0:
+        raise ValueError(f"{solver} did not converge (info={info})")
+    return x
 
+def evaluate_sparse_policy_matrix_exact(policy_mat, mdp, solver="spsolve"):
+    """
+    Exact evaluation of a policy matrix. The initial value solves
+    `(I - discount*P) v = r` and the occupancy (the expected number of
+    visits to each non-terminal state, as estimated by simulation)
+    solves `(I - P)^T d = s0`. Standard errors are zero.
+    """
+    n_states, n_actions = policy_mat.shape
+    nonterminal = mdp.nonterminal_state_vec.astype(bool)
+    mp = policy_transition_matrix(policy_mat, _transition_matrix(mdp))
+    eye = sparse.eye(n_states, format='csr')
+    s_rf = (policy_mat*np.asarray(mdp.state_action_reward_matrix)).sum(-1)
+    initial_state_vec = np.asarray(mdp.initial_state_vec, dtype=float)
+    state_values = solve_sparse_linear_system(eye - mdp.discount_rate*mp, s_rf, solver=solver)
+    # the occupancy is deliberately undiscounted (not `(I - discount*P)^T d = s0`) so that it
+    # counts expected visits like the Monte Carlo estimate. It is singular if the policy
+    # can loop forever without reaching a terminal state.
+    occupancy = solve_sparse_linear_system((eye - mp).T, initial_state_vec, solver=solver)
+    if not (np.isfinite(state_values).all() and np.isfinite(occupancy).all()):
+        raise ValueError("Error solving for values or occupancy - the policy might never reach a terminal state")
+    occupancy = occupancy*nonterminal
     return SimpleNamespace(
-        initial_value=np.mean(initial_value),
-        initial_value_sem=np.std(initial_value)/np.sqrt(n_simulations),
-        occupancy={s: np.mean(occ) for s, occ in state_occ.items()},
-        occupancy_sem={s: np.std(occ)/np.sqrt(n_simulations) for s, occ in state_occ.items()},
+        initial_value=state_values@initial_state_vec,
+        initial_value_sem=0.,
+        occupancy=dict(zip(mdp.state_list, occupancy)),
+        occupancy_sem=dict.fromkeys(mdp.state_list, 0.),
         mdp=mdp,
-        n_simulations=n_simulations
+        n_simulations=None
     )
 
-from joblib import Memory
-import functools
+def evaluate_sparse_policy_matrix(
+    policy_mat,
+    mdp,
+    n_simulations=None,
+    max_sim_length=None,
+    method="monte_carlo",
+    solver="spsolve",
+    rng=None
+):
+    """
+    Monte Carlo evaluation of a policy matrix with `n_simulations`
+    trajectories that are advanced in lockstep. Actions and next states
+    are sampled for all running trajectories at once by inverse-CDF
+    sampling from cumulative policy and transition rows. Samples are
+    drawn from `rng` (a `np.random.RandomState` or `Generator`), or from
+    numpy's global random state if it is None.
+
+    With `method="exact"`, the value and occupancy are instead
+    computed by sparse linear solves (see `evaluate_sparse_policy_matrix_exact`).
+    """
+    assert method in ("monte_carlo", "exact")
+    if method == "exact":
+        return evaluate_sparse_policy_matrix_exact(policy_mat, mdp, solver=solver)
+    n_states, n_actions = policy_mat.shape
+    terminal_states = (mdp.nonterminal_state_vec == 0)
+    cum_policy = np.cumsum(policy_mat, axis=-1)
+    transition_matrix = _transition_matrix(mdp)
+    if hasattr(transition_matrix, "block_matrix"):
+        # sample from the rows of the operator's block matrix
+        cum_transitions = cumulative_csr_rows(transition_matrix.block_matrix)
+        row_index = transition_matrix.row_index
+    else:
+        cum_transitions = cumulative_csr_rows(transition_matrix)
+        row_index = lambda rows: rows
+    sa_rf = np.asarray(mdp.state_action_reward_matrix)
+    random_sample = np.random.random_sample if rng is None else rng.random
 
-joblib_mem = Memory("./_cache", verbose=0)
+    cum_initial = np.cumsum(mdp.initial_state_vec)
+    s_i = np.searchsorted(cum_initial, random_sample(n_simulations)*cum_initial[-1], side='right')
+    s_i = np.minimum(s_i, n_states - 1)
+    sims = np.arange(n_simulations)
+    discounted_returns = np.zeros(n_simulations)
+    visited_sims, visited_states = [], []
+    discount = 1.0
+    for timestep in range(max_sim_length):
+        visited_sims.append(sims)
+        visited_states.append(s_i)
 
-@functools.lru_cache(maxsize=int(1e3))
-@joblib_mem.cache()
-def dynamic_vgc(
+        u = random_sample(len(sims))
+        s_cum_policy = cum_policy[s_i]
+        a_i = (s_cum_policy <= (u*s_cum_policy[:, -1])[:, None]).sum(-1)
+        a_i = np.minimum(a_i, n_actions - 1)
+        discounted_returns[sims] += discount*sa_rf[s_i, a_i]
+        discount *= mdp.discount_rate
+
+        sa_i = s_i*n_actions + a_i
+        ns_i = sample_csr_rows(cum_transitions, row_index(sa_i), random_sample(len(sims)))
+        running = ~terminal_states[ns_i]
+        sims, s_i = sims[running], ns_i[running]
+        if len(sims) == 0:
+            break
+    if len(sims) > 0:
+        raise ValueError("Maximum simulation length reached")
+
+    # per-simulation visit counts for every visited (simulation, state) pair
+    sim_state, counts = np.unique(
+        np.concatenate(visited_sims)*n_states + np.concatenate(visited_states),
+        return_counts=True
+    )
+    visited = sim_state % n_states
+    occ_mean = np.bincount(visited, weights=counts, minlength=n_states)/n_simulations
+    occ_sq_mean = np.bincount(visited, weights=counts**2, minlength=n_states)/n_simulations
+    occ_std = np.sqrt(np.maximum(occ_sq_mean - occ_mean**2, 0))
+
+    return SimpleNamespace(
+        initial_value=np.mean(discounted_returns),
+        initial_value_sem=np.std(discounted_returns)/np.sqrt(n_simulations),
+        occupancy=dict(zip(mdp.state_list, occ_mean)),
+        occupancy_sem=dict(zip(mdp.state_list, occ_std/np.sqrt(n_simulations))),
+        mdp=mdp,
+        n_simulations=n_simulations
+    )
+
+def dynamic_vgc_mdp_params(
     tile_array,
-    ground_policy_inv_temp=None,
-    ground_policy_rand_choose=0.,
-    ground_discount_rate=1.0-1e-5,
-    action_deviation_reward=0,
-    wall_bias=0.,
-    wall_bump_cost=0.,
-    added_obs_cost=1,
-    removed_obs_cost=0,
-    continuing_obs_cost=0,
-    construal_switch_cost=0,
-    switching_inv_temp=5,
-    switching_rand_choose=0.,
-    switching_discount_rate=1-1e-5,
-    max_construal_size=3,
-    n_simulations=1000,
-    seed=None
+    ground_policy_inv_temp,
+    ground_policy_rand_choose,
+    ground_discount_rate,
+    action_deviation_reward,
+    wall_bias,
+    wall_bump_cost,
+    added_obs_cost,
+    removed_obs_cost,
+    continuing_obs_cost,
+    construal_switch_cost,
+    switching_discount_rate,
+    max_construal_size
 ):
-    assert seed is not None, "`seed` cannot be none (bc of caching)"
-
-    rng = random.Random(seed)
-    np.random.seed(seed)
+    """Returns the true (ground) MDP parameters and the switching MDP parameters"""
     true_mdp_params = dict(
         tile_array=tile_array,
         feature_rewards=(("G", 0), ),
@@ -179,7 +303,7 @@ def dynamic_vgc(
         true_mdp_params['action_deviation_reward'] = action_deviation_reward
 
     obstacles = set(''.join(tile_array)) & set("0123456789")
-    construals = tuple([''.join(sorted(c)) for c in powerset(obstacles, maxsize=max_construal_size)])
+    construals = tuple([''.join(sorted(c)) for c in powerset(sorted(obstacles), maxsize=max_construal_size)])
 
     switching_mdp_params = frozendict(
         construals=construals, 
@@ -194,23 +318,33 @@ def dynamic_vgc(
         construal_switch_cost=construal_switch_cost,
         discount_rate=switching_discount_rate,
     )
-    res = solve_construal_switching_mdp(switching_mdp_params)
+    return true_mdp_params, switching_mdp_params
+
+def evaluate_switching_policy(
+    switch_policy_mat,
+    solver_res,
+    true_mdp_params,
+    switching_mdp_params,
+    n_simulations,
+    seed,
+    evaluation
+):
+    """Evaluates a switching policy and returns the `dynamic_vgc` statistics"""
+    # only Monte Carlo evaluation samples
+    rng = np.random.RandomState(seed) if evaluation == "monte_carlo" else None
     switching_mdp = make_construal_switching_mdp(switching_mdp_params)
     switch_mdp_properties = dict(
-        transition_matrix_entries = switching_mdp.transition_matrix.size,
+        transition_matrix_entries = switching_mdp.transition_operator.nnz,
         n_states = len(switching_mdp.state_list),
         n_actions = len(switching_mdp.action_list),
     )
-    switch_policy_mat = softmax_epsilon_policy_matrix(
-        res._qvaluemat,
-        inv_temp=switching_inv_temp,
-        rand_choose=switching_rand_choose
-    )
     pi_eval = evaluate_sparse_policy_matrix(
         policy_mat=switch_policy_mat,
         mdp=switching_mdp,
         n_simulations=n_simulations,
-        max_sim_length=10000
+        max_sim_length=10000,
+        method=evaluation,
+        rng=rng
     )
     # for debugging purposes
     # switch_policy = TabularPolicy.from_matrix(
@@ -223,7 +357,7 @@ def dynamic_vgc(
 
     eval_stats['initial_value'] = pi_eval.initial_value
     eval_stats['initial_value_sem'] = pi_eval.initial_value_sem
-    eval_stats['switching_mdp_solver_converged'] = res.converged
+    eval_stats['switching_mdp_solver_converged'] = solver_res.converged
 
     # calculate optimality gap
     no_aux_costs_true_mdp_params = {**true_mdp_params}
@@ -245,7 +379,9 @@ def dynamic_vgc(
         policy_mat=switch_policy_mat,
         mdp=switching_no_costs_mdp,
         n_simulations=n_simulations,
-        max_sim_length=10000
+        max_sim_length=10000,
+        method=evaluation,
+        rng=rng
     )
     no_aux_cost_ground_mdp = solve_maze(frozendict(no_aux_costs_true_mdp_params))
     eval_stats['no_aux_cost_ground_initial_value'] = no_aux_cost_ground_mdp.initial_value
@@ -258,6 +394,164 @@ def dynamic_vgc(
         'ground_mdp_params': true_mdp_params
     }
     eval_stats['switch_mdp_properties'] = switch_mdp_properties
-    eval_stats['obstacles'] = obstacles
-
+    eval_stats['obstacles'] = set(''.join(true_mdp_params['tile_array'])) & set("0123456789")
     return eval_stats
+
+import functools
+
+@functools.lru_cache(maxsize=int(1e3))
+@cache_artifact(namespace="dynamic_vgc")
+def dynamic_vgc(
+    tile_array,
+    ground_policy_inv_temp=None,
+    ground_policy_rand_choose=0.,
+    ground_discount_rate=1.0-1e-5,
+    action_deviation_reward=0,
+    wall_bias=0.,
+    wall_bump_cost=0.,
+    added_obs_cost=1,
+    removed_obs_cost=0,
+    continuing_obs_cost=0,
+    construal_switch_cost=0,
+    switching_inv_temp=5,
+    switching_rand_choose=0.,
+    switching_discount_rate=1-1e-5,
+    max_construal_size=3,
+    n_simulations=1000,
+    seed=None,
+    evaluation="monte_carlo"
+):
+    assert evaluation in ("monte_carlo", "exact")
+    assert seed is not None or evaluation == "exact", "`seed` cannot be none (bc of caching)"
+    true_mdp_params, switching_mdp_params = dynamic_vgc_mdp_params(
+        tile_array=tile_array,
+        ground_policy_inv_temp=ground_policy_inv_temp,
+        ground_policy_rand_choose=ground_policy_rand_choose,
+        ground_discount_rate=ground_discount_rate,
+        action_deviation_reward=action_deviation_reward,
+        wall_bias=wall_bias,
+        wall_bump_cost=wall_bump_cost,
+        added_obs_cost=added_obs_cost,
+        removed_obs_cost=removed_obs_cost,
+        continuing_obs_cost=continuing_obs_cost,
+        construal_switch_cost=construal_switch_cost,
+        switching_discount_rate=switching_discount_rate,
+        max_construal_size=max_construal_size
+    )
+    res = solve_construal_switching_mdp_arrays(switching_mdp_params)
+    switch_policy_mat = softmax_epsilon_policy_matrix(
+        res._qvaluemat,
+        inv_temp=switching_inv_temp,
+        rand_choose=switching_rand_choose
+    )
+    return evaluate_switching_policy(
+        switch_policy_mat=switch_policy_mat,
+        solver_res=res,
+        true_mdp_params=true_mdp_params,
+        switching_mdp_params=switching_mdp_params,
+        n_simulations=n_simulations,
+        seed=seed,
+        evaluation=evaluation
+    )
+
+# `dynamic_vgc` parameters grouped by the first stage they invalidate
+DYNAMIC_VGC_STAGE_PARAMS = dict(
+    ground_mdp=(
+        'tile_array',
+        'ground_policy_inv_temp',
+        'ground_policy_rand_choose',
+        'ground_discount_rate',
+        'action_deviation_reward',
+        'wall_bias',
+        'wall_bump_cost',
+    ),
+    switching_mdp=(
+        'added_obs_cost',
+        'removed_obs_cost',
+        'continuing_obs_cost',
+        'construal_switch_cost',
+        'switching_discount_rate',
+        'max_construal_size',
+    ),
+    switching_policy=(
+        'switching_inv_temp',
+        'switching_rand_choose',
+    ),
+    evaluation=(
+        'n_simulations',
+        'seed',
+        'evaluation',
+    )
+)
+
+def dynamic_vgc_sweep(param_sets):
+    """
+    Runs `dynamic_vgc` on every dict of keyword arguments in `param_sets`
+    while only recomputing the stages affected by each parameter change
+    (see `DYNAMIC_VGC_STAGE_PARAMS`). Parameter sets are grouped so that each
+    switching MDP is solved once and each switching policy is built once,
+    e.g., sweeping only `switching_inv_temp` and `switching_rand_choose`
+    needs a single solve.
+
+    Returns the `dynamic_vgc` results in the order of `param_sets` and
+    the number of distinct ground MDPs, switching MDP solves, switching
+    policies built and evaluations run.
+    """
+    defaults = {
+        name: p.default
+        for name, p in inspect.signature(dynamic_vgc).parameters.items()
+        if p.default is not inspect.Parameter.empty
+    }
+    param_sets = [{**defaults, **params} for params in param_sets]
+    for params in param_sets:
+        params['tile_array'] = tuple(params['tile_array'])
+        assert params['evaluation'] in ("monte_carlo", "exact")
+        assert params['seed'] is not None or params['evaluation'] == "exact", \
+            "`seed` cannot be none (bc of caching)"
+
+    def stage_key(params, *stages):
+        return tuple(params[name] for stage in stages for name in DYNAMIC_VGC_STAGE_PARAMS[stage])
+
+    solve_groups = defaultdict(list)
+    for i, params in enumerate(param_sets):
+        solve_groups[stage_key(params, "ground_mdp", "switching_mdp")].append(i)
+
+    results = [None]*len(param_sets)
+    n_policies = 0
+    n_evaluations = 0
+    for group in solve_groups.values():
+        params = param_sets[group[0]]
+        true_mdp_params, switching_mdp_params = dynamic_vgc_mdp_params(**{
+            name: params[name]
+            for name in DYNAMIC_VGC_STAGE_PARAMS['ground_mdp'] + DYNAMIC_VGC_STAGE_PARAMS['switching_mdp']
+        })
+        res = solve_construal_switching_mdp_arrays(switching_mdp_params)
+        switch_policy_mats = {}
+        for i in group:
+            params = param_sets[i]
+            policy_key = stage_key(params, "switching_policy")
+            if policy_key not in switch_policy_mats:
+                switch_policy_mats[policy_key] = softmax_epsilon_policy_matrix(
+                    res._qvaluemat,
+                    inv_temp=params['switching_inv_temp'],
+                    rand_choose=params['switching_rand_choose']
+                )
+            results[i] = evaluate_switching_policy(
+                switch_policy_mat=switch_policy_mats[policy_key],
+                solver_res=res,
+                true_mdp_params=true_mdp_params,
+                switching_mdp_params=switching_mdp_params,
+                n_simulations=params['n_simulations'],
+                seed=params['seed'],
+                evaluation=params['evaluation']
+            )
+            n_evaluations += 1
+        n_policies += len(switch_policy_mats)
+    stats = dict(
+        param_sets=len(param_sets),
+        ground_mdps=len(set(stage_key(p, "ground_mdp") for p in param_sets)),
+        switching_mdp_solves=len(solve_groups),
+        switching_policies=n_policies,
+        evaluations=n_evaluations
+    )
+    return SimpleNamespace(results=results, stats=stats)
@@ -1,8 +1,9 @@
+import time
 from collections import namedtuple, defaultdict
 from types import SimpleNamespace
-from functools import lru_cache
 from itertools import combinations, product
 import scipy.sparse as sparse
+from scipy.sparse.linalg import LinearOperator, spsolve
 import numpy as np 
 from frozendict import frozendict
 
@@ -13,11 +14,73 @@ from msdm.core.utils.funcutils import method_cache, cached_property
 
 from vgc_project.dynamic_vgc import \
     create_maze, solve_maze, evaluate_construal,\
-    powerset, softmax_epsilon_policy_matrix
-from vgc_project.sparse import SparsePolicyIteration, SparseTabularMDP, SparseValueIteration
+    powerset, softmax_epsilon_policy_matrix, ground_policy_matrix
+from vgc_project.sparse import SparsePolicyIteration, SparseTabularMDP, SparseValueIteration, \
+    assemble_transition_reward_matrices
+from vgc_project.sparse.sparse_solvers import Solver
 
 ConstrualState = namedtuple("ConstrualState", "construal ground_state")
 
+class SwitchingTransitionOperator(LinearOperator):
+    """
+    Matrix-free `(C*S*C, C*S)` transition matrix of a construal switching MDP.
+
+    Choosing construal `x` in state `(c, s)` leads to `(x, n)` with probability
+    `G_x[s, n]`, where `G_x` is the ground transition matrix under the policy
+    of construal `x`. This does not depend on `c`, so every row of the full
+    matrix is a row of the block-diagonal `(C*S, C*S)` matrix `diag(G_x)`,
+    and only that matrix is stored.
+    """
+    def __init__(self, ground_transition_matrices):
+        self.block_matrix = sparse.block_diag(ground_transition_matrices, format='csr')
+        self.n_construals = len(ground_transition_matrices)
+        self.n_ground_states = ground_transition_matrices[0].shape[0]
+        n_states = self.n_construals*self.n_ground_states
+        super().__init__(dtype=self.block_matrix.dtype, shape=(n_states*self.n_construals, n_states))
+
+    def row_index(self, rows):
+        """Maps rows `(c*S + s)*C + x` of the full matrix to rows `x*S + s` of `block_matrix`"""
+        rows = np.asarray(rows)
+        s = (rows//self.n_construals) % self.n_ground_states
+        x = rows % self.n_construals
+        return x*self.n_ground_states + s
+
+    @cached_property
+    def _all_row_index(self):
+        return self.row_index(np.arange(self.shape[0]))
+
+    def __getitem__(self, key):
+        rows, cols = key
+        assert cols == slice(None), "Only row selection is supported"
+        return self.block_matrix[self.row_index(rows)]
+
+    def _matvec(self, v):
+        return (self.block_matrix@np.ravel(v))[self._all_row_index]
+
+    def _rmatvec(self, v):
+        block_v = np.bincount(self._all_row_index, weights=np.ravel(v), minlength=self.shape[1])
+        return self.block_matrix.T@block_v
+
+    def policy_transition_matrix(self, policy_mat):
+        """Sparse `(C*S, C*S)` state transition matrix under a `(C*S, C)` policy matrix"""
+        n_states, n_construals = policy_mat.shape
+        policy_block = sparse.csr_matrix(
+            (
+                policy_mat.reshape(-1),
+                (np.repeat(np.arange(n_states), n_construals), self._all_row_index)
+            ),
+            shape=(n_states, n_states)
+        )
+        return sparse.csr_matrix(policy_block@self.block_matrix)
+
+    @property
+    def nnz(self):
+        """Number of non-zero entries of the full matrix"""
+        return np.diff(self.block_matrix.indptr)[self._all_row_index].sum()
+
+    def tocsr(self):
+        return self.block_matrix[self._all_row_index]
+
 class ConstrualSwitchingMDPBase(TabularMarkovDecisionProcess):
     def __init__(
         self,
@@ -91,21 +154,28 @@ class ConstrualSwitchingMDPBase(TabularMarkovDecisionProcess):
     @cached_property
     def ground_policies(self):
         policies = {}
-        for c in self.construals:
-            cgw_params = {**self.policy_ground_mdp_params, 'wall_features':"#"+c}
-            cplan_res = solve_maze(cgw_params, planning_alg="policy_iteration")
-            cplan = softmax_epsilon_policy_matrix(
-                cplan_res._qvaluemat,
-                self.ground_policy_inv_temp,
-                self.ground_policy_rand_choose
-            )
-            cplan = TabularPolicy.from_matrix(
+        for c, cplan in zip(self.construals, self.ground_policy_matrix):
+            policies[c] = TabularPolicy.from_matrix(
                 self.ground_mdp.state_list,
                 self.ground_mdp.action_list,
                 cplan
             )
-            policies[c] = cplan
         return policies
+
+    @cached_property
+    def ground_policy_matrix(self):
+        """`(C, S, A)` ground policies, built from the shared policy bank"""
+        ground_pis = np.stack([
+            ground_policy_matrix(
+                self.policy_ground_mdp_params,
+                c,
+                self.ground_policy_inv_temp,
+                self.ground_policy_rand_choose
+            )
+            for c in self.construals
+        ]).astype(float)
+        # banked policies are float32, so renormalize in double precision
+        return ground_pis/ground_pis.sum(-1, keepdims=True)
     
     def switch_reward(self, c, nc):
         added_obs = len(set(nc) - set(c))
@@ -145,8 +215,72 @@ class ConstrualSwitchingMDPBase(TabularMarkovDecisionProcess):
     @cached_property
     def action_list(self):
         return self.construals
-    
-    
+
+    @cached_property
+    def ground_transition_matrices(self):
+        """`(S, S)` ground transition matrix under each construal's policy"""
+        gtf_san = self.ground_mdp.transition_matrix
+        nonterminal = self.ground_mdp.nonterminal_state_vec.astype(bool)
+        ground_tfs = []
+        for gpi_sa in self.ground_policy_matrix:
+            gtf_sn = np.einsum("sa,san->sn", gpi_sa, gtf_san)*nonterminal[:, None]
+            ground_tfs.append(sparse.csr_matrix(gtf_sn))
+        return ground_tfs
+
+    @cached_property
+    def ground_reward_matrix(self):
+        """`(S, C)` expected ground reward under each construal's policy"""
+        rf_san = self.ground_mdp.reward_matrix*self.ground_mdp.transition_matrix
+        rf_sx = np.einsum("san,xsa->sx", rf_san, self.ground_policy_matrix)
+        return rf_sx*self.ground_mdp.nonterminal_state_vec[:, None]
+
+    @cached_property
+    def switch_reward_matrix(self):
+        construal_switch_rewards = np.zeros((len(self.construals), len(self.construals)))
+        for (ci, c), (nci, nc) in product(enumerate(self.construals), repeat=2):
+            construal_switch_rewards[ci, nci] = self.switch_reward(c, nc)
+        return construal_switch_rewards
+
+    def transition_reward_chunks(self):
+        """
+        Yields `(rows, cols, probs, rewards)` arrays of transition matrix
+        entries (see `SparseTabularMDP.transition_reward_chunks`), one chunk
+        per chosen construal `x`. Choosing `x` in `(c, s)` leads to `(x, n)`
+        following the ground transitions under `x`'s policy, so each chunk
+        repeats those entries for every current construal `c`.
+        """
+        ncc = len(self.construals)
+        nss = len(self.ground_mdp.state_list)
+        for x, gtf_sn in enumerate(self.ground_transition_matrices):
+            gtf_sn = gtf_sn.tocoo()
+            c = np.repeat(np.arange(ncc), gtf_sn.nnz)
+            s = np.tile(gtf_sn.row, ncc)
+            yield (
+                (c*nss + s)*ncc + x,
+                np.tile(x*nss + gtf_sn.col, ncc),
+                np.tile(gtf_sn.data, ncc),
+                self.ground_reward_matrix[s, x] + self.switch_reward_matrix[c, x]
+            )
+
+    @cached_property
+    def _transition_reward_matrices(self):
+        return assemble_transition_reward_matrices(
+            self.transition_reward_chunks(),
+            len(self.state_list),
+            len(self.action_list)
+        )
+
+    @cached_property
+    def transition_matrix(self):
+        nss, naa = len(self.state_list), len(self.action_list)
+        return self._transition_reward_matrices[0].toarray().reshape(nss, naa, nss)
+
+    @cached_property
+    def reward_matrix(self):
+        nss, naa = len(self.state_list), len(self.action_list)
+        return self._transition_reward_matrices[1].toarray().reshape(nss, naa, nss)
+
+
 class ConstrualSwitchingMDP(ConstrualSwitchingMDPBase, SparseTabularMDP):
     """
     This overwrites matrix creation methods of the base switching MDP
@@ -201,37 +335,101 @@ class ConstrualSwitchingMDP(ConstrualSwitchingMDPBase, SparseTabularMDP):
         tf_csx_dn = sparse.kron(stf_c_, tf_sx_dn, format='csr')
         return tf_csx_dn
     
+    @cached_property
+    def transition_operator(self):
+        """Matrix-free version of `transition_matrix`"""
+        return SwitchingTransitionOperator(self.ground_transition_matrices)
+
     @property
     def reward_matrix(self):
         raise NotImplementedError("This should only use a sparse state-action reward `self.state_action_reward_matrix`")
     
     @cached_property
     def state_action_reward_matrix(self):
-        rf_san = self.ground_mdp.reward_matrix*self.ground_mdp.transition_matrix
-        sxa_ground_pis = self.ground_policy_matrix.transpose(1, 0, 2)
-        rf_sx = np.einsum("san,xsa->sx", rf_san, self.ground_policy_matrix)
-        rf_csx = rf_sx[None, :, :] + self.switch_reward_matrix[:, None, :]
-        rf_csx = np.einsum("csx,s->csx", rf_csx, self.ground_mdp.nonterminal_state_vec)
+        nonterminal = self.ground_mdp.nonterminal_state_vec
+        rf_csx = self.ground_reward_matrix[None, :, :] + \
+            self.switch_reward_matrix[:, None, :]*nonterminal[None, :, None]
         return rf_csx.reshape(-1, len(self.construals))
-    
-    @cached_property
-    def switch_reward_matrix(self):
-        construal_switch_rewards = np.zeros((len(self.construals), len(self.construals)))
-        for (ci, c), (nci, nc) in product(enumerate(self.construals), repeat=2):
-            construal_switch_rewards[ci, nci] = self.switch_reward(c, nc)
-        return construal_switch_rewards
-    
-    @cached_property
-    def ground_policy_matrix(self):
-        ground_pis = []
-        for c in self.construals:
-            cgw_params = {**self.policy_ground_mdp_params, 'wall_features':"#"+c}
-            cplan_res = solve_maze(cgw_params, planning_alg="policy_iteration")
-            cplan = softmax_epsilon_policy_matrix(
-                cplan_res._qvaluemat,
-                self.ground_policy_inv_temp,
-                self.ground_policy_rand_choose
-            )
-            ground_pis.append(cplan)
-        ground_pis = np.stack(ground_pis)
-        return ground_pis
+
+def factored_switching_policy_iteration(
+    ground_transition_matrices,
+    ground_reward_matrix,
+    switch_reward_matrix,
+    nonterminal_state_vec,
+    discount_rate,
+    max_iterations,
+    value_decimals,
+    initial_pi=None
+):
+    """
+    Policy iteration on a construal switching MDP with values stored as
+    a `(C, S)` table. Choosing construal `x` in `(c, s)` gives reward
+    `switch_reward_matrix[c, x] + ground_reward_matrix[s, x]` (the switch
+    reward only in non-terminal states) and then follows the `(S, S)`
+    ground transitions `ground_transition_matrices[x]`. The continuation
+    value `W[s, x]` therefore does not depend on `c` and is computed with
+    one product per construal, never forming the `C*S*C` state-action space.
+
+    Returns values and Q-values in the switching MDP's state order, `(c, s)`.
+    """
+    n_construals = len(ground_transition_matrices)
+    n_ground_states = ground_transition_matrices[0].shape[0]
+    n_states = n_construals*n_ground_states
+    block_tf = sparse.block_diag(ground_transition_matrices, format='csr')
+    switch_rf = switch_reward_matrix[:, None, :]*nonterminal_state_vec[None, :, None]
+    s_range = np.arange(n_ground_states)[None, :]
+    c_range = np.arange(n_construals)[:, None]
+    ss_eye = sparse.eye(n_states, format='csr')
+    if initial_pi is None:
+        pi = np.zeros((n_construals, n_ground_states), dtype=int)
+    else:
+        pi = np.asarray(initial_pi).reshape(n_construals, n_ground_states)
+
+    start_time = time.time()
+    for i in range(max_iterations):
+        mp = block_tf[(pi*n_ground_states + s_range).reshape(-1)]
+        s_rf = switch_rf[c_range, s_range, pi] + ground_reward_matrix[s_range, pi]
+        v = spsolve(sparse.csc_matrix(ss_eye - discount_rate*mp), s_rf.reshape(-1))
+        if np.isnan(v).any():
+            raise ValueError("Error solving for values - discount*transition_matrix might be singular")
+        w = ground_reward_matrix + discount_rate*(block_tf@v).reshape(n_construals, n_ground_states).T
+        q = np.round(switch_rf + w[None, :, :], decimals=value_decimals)
+        new_pi = q.argmax(-1)
+        if (new_pi == pi).all():
+            break
+        pi = new_pi
+    return SimpleNamespace(
+        state_value_vec=v,
+        iterations=i,
+        state_action_value_matrix=q.reshape(n_states, n_construals),
+        converged=(i < max_iterations - 1),
+        run_time=time.time() - start_time
+    )
+
+class FactoredSwitchingPolicyIteration(Solver):
+    """
+    Policy iteration for `ConstrualSwitchingMDP` using per-construal
+    ground transition matrices (see `factored_switching_policy_iteration`).
+    """
+    def __init__(
+        self,
+        iterations=int(1e20),
+        value_decimals=10,
+        initial_policy=None
+    ):
+        self.iterations = iterations
+        self.value_decimals = value_decimals
+        self.initial_policy = initial_policy
+
+    def plan_on(self, mdp: ConstrualSwitchingMDP):
+        res = factored_switching_policy_iteration(
+            ground_transition_matrices=mdp.ground_transition_matrices,
+            ground_reward_matrix=mdp.ground_reward_matrix,
+            switch_reward_matrix=mdp.switch_reward_matrix,
+            nonterminal_state_vec=mdp.ground_mdp.nonterminal_state_vec,
+            discount_rate=mdp.discount_rate,
+            max_iterations=self.iterations,
+            value_decimals=self.value_decimals,
+            initial_pi=self.initial_policy
+        )
+        return self.update_result_object(res, mdp)
@@ -1,6 +1,5 @@
 from collections import namedtuple, defaultdict
 from types import SimpleNamespace
-from functools import lru_cache
 from itertools import combinations, product
 import numpy as np 
 from frozendict import frozendict
@@ -8,30 +7,48 @@ from frozendict import frozendict
 from msdm.algorithms import PolicyIteration, ValueIteration
 from msdm.core.distributions import DictDistribution
 
-from vgc_project.maze import Maze
-from vgc_project.stickyaction_maze import StickyActionMaze
+from vgc_project.maze import Maze, SparseMaze
+from vgc_project.stickyaction_maze import StickyActionMaze, SparseStickyActionMaze
+from vgc_project.sparse import SparsePolicyIteration, SparseValueIteration, SparseTabularMDP, \
+    PrioritizedValueIteration
+from vgc_project.artifact_store import cache_artifact
+from vgc_project.memory_cache import memory_cache
 
 ##
 ## These functions cache computations for reuse
 ## across simulations.
 ##
-@lru_cache(maxsize=int(1e7))
+@memory_cache
 def _create_maze(gw_params):
+    # `sparse=True` builds CSR-backed mazes for use with the sparse solvers
+    gw_params = dict(gw_params)
+    use_sparse = gw_params.pop('sparse', False)
     if 'action_deviation_reward' in gw_params:
-        return StickyActionMaze(**gw_params)
-    return Maze(**gw_params)
+        maze_class = SparseStickyActionMaze if use_sparse else StickyActionMaze
+    else:
+        maze_class = SparseMaze if use_sparse else Maze
+    maze = maze_class(**gw_params)
+    # build the lazily computed matrices so they count towards the cache budget
+    for name in ("transition_matrix", "reward_matrix", "state_action_reward_matrix"):
+        getattr(maze, name)
+    return maze
 def create_maze(gw_params):
     if not isinstance(gw_params['tile_array'], tuple):
         gw_params = {**gw_params, 'tile_array': tuple(gw_params['tile_array'])}
     return _create_maze(frozendict(gw_params))
 
-@lru_cache(maxsize=int(1e7))
+@memory_cache
 def _solve_maze(gw_params, planning_alg="policy_iteration"):
     gw = _create_maze(gw_params)
+    is_sparse = isinstance(gw, SparseTabularMDP)
     if planning_alg == "policy_iteration":
-        res = PolicyIteration().plan_on(gw)
+        res = (SparsePolicyIteration() if is_sparse else PolicyIteration()).plan_on(gw)
     elif planning_alg == "value_iteration":
-        res = ValueIteration().plan_on(gw)
+        res = (SparseValueIteration() if is_sparse else ValueIteration()).plan_on(gw)
+    elif planning_alg == "prioritized_value_iteration":
+        res = PrioritizedValueIteration(order="priority").plan_on(gw)
+    elif planning_alg == "topological_value_iteration":
+        res = PrioritizedValueIteration(order="topological").plan_on(gw)
     else:
         raise ValueError("Unknown planning alg")
     assert res.converged
@@ -41,7 +58,7 @@ def solve_maze(gw_params, planning_alg = "policy_iteration"):
         gw_params = {**gw_params, 'tile_array': tuple(gw_params['tile_array'])}
     return _solve_maze(frozendict(gw_params), planning_alg=planning_alg)
 
-@lru_cache(maxsize=int(1e7))
+@memory_cache
 def _evaluate_construal(c, gw_params, planning_alg="policy_iteration"):
     if not isinstance(gw_params['tile_array'], tuple):
         gw_params = {**gw_params, 'tile_array': tuple(gw_params['tile_array'])}
@@ -53,6 +70,35 @@ def _evaluate_construal(c, gw_params, planning_alg="policy_iteration"):
 def evaluate_construal(c, gw_params):
     return _evaluate_construal(frozenset(c), frozendict(gw_params))
 
+@cache_artifact(namespace="maze_qvalues")
+def _maze_qvalue_matrix(gw_params, planning_alg="policy_iteration"):
+    # persists the solved Q-values of `_solve_maze` across sessions
+    return np.asarray(_solve_maze(gw_params, planning_alg=planning_alg)._qvaluemat)
+
+@memory_cache
+def _ground_policy_matrix(policy_ground_mdp_params, construal, inv_temp, rand_choose):
+    cgw_params = {**policy_ground_mdp_params, 'wall_features':"#"+construal}
+    qvalues = _maze_qvalue_matrix(frozendict(cgw_params), planning_alg="policy_iteration")
+    cplan = softmax_epsilon_policy_matrix(qvalues, inv_temp, rand_choose)
+    cplan = cplan.astype(np.float32)
+    cplan.setflags(write=False)
+    return cplan
+def ground_policy_matrix(policy_ground_mdp_params, construal, inv_temp, rand_choose):
+    """
+    Returns the (shared, read-only) `(S, A)` float32 softmax-epsilon policy
+    matrix of a construal. Policies are banked by ground parameters,
+    construal, `inv_temp` and `rand_choose`, so switching MDPs that plan
+    with the same ground parameters reuse them.
+    """
+    if not isinstance(policy_ground_mdp_params['tile_array'], tuple):
+        policy_ground_mdp_params = {
+            **policy_ground_mdp_params,
+            'tile_array': tuple(policy_ground_mdp_params['tile_array'])
+        }
+    return _ground_policy_matrix(
+        frozendict(policy_ground_mdp_params), construal, inv_temp, rand_choose
+    )
+
 def powerset(S, maxsize=float('inf'), minsize=0):
     for n in range(minsize, len(S) + 1):
         if n > maxsize:
@@ -1,12 +1,14 @@
 from itertools import product
 import numpy as np
 import matplotlib.pyplot as plt
+import scipy.sparse as sparse
 from collections import namedtuple, defaultdict
 from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
 from msdm.core.distributions import DictDistribution
 
 from vgc_project.gridmdp import GridMDP, Location, GridAction
 from vgc_project.gridmdp.plotting import GridMDPPlotter
+from vgc_project.sparse import SparseTabularMDP
 
 class Maze(GridMDP, TabularMarkovDecisionProcess):
     def __init__(
@@ -122,6 +124,38 @@ class Maze(GridMDP, TabularMarkovDecisionProcess):
     def on_board(self, s):
         return (0 <= s.x < self._width) and (0 <= s.y < self._height)
 
+    def _state_action_next_state_indices(self):
+        """
+        Returns `(S, A)` arrays of state, action, and (deterministic)
+        next state indices. Moving off the board leaves you in place.
+        """
+        nss, naa = len(self._state_list), len(self._action_list)
+        locs = np.array(self._state_list)
+        loc_index = np.zeros((self._width, self._height), dtype=int)
+        loc_index[locs[:, 0], locs[:, 1]] = np.arange(nss)
+        nlocs = locs[:, None, :] + np.array(self._action_list)[None, :, :]
+        on_board = \
+            (0 <= nlocs[..., 0]) & (nlocs[..., 0] < self._width) & \
+            (0 <= nlocs[..., 1]) & (nlocs[..., 1] < self._height)
+        nlocs = np.where(on_board[..., None], nlocs, locs[:, None, :])
+        si = np.repeat(np.arange(nss)[:, None], naa, axis=1)
+        ai = np.repeat(np.arange(naa)[None, :], nss, axis=0)
+        nsi = loc_index[nlocs[..., 0], nlocs[..., 1]]
+        return si, ai, nsi
+
+    def _wall_bump_mask(self, si, nsi, wall_features=None):
+        """State-actions that move from a non-wall into a wall"""
+        if wall_features is None:
+            wall_features = self.wall_features
+        wall_vec = np.array([self.feature_at(s) in wall_features for s in self._state_list], dtype=bool)
+        return ~wall_vec[si] & wall_vec[nsi]
+
+    def _wall_bias_reward_vec(self):
+        center = np.array([(self._width - 1)/2, (self._height - 1)/2])
+        max_center_dist = center.sum()
+        wall_bias_reward = np.abs(center - np.array(self._state_list)).sum(-1) - max_center_dist
+        return wall_bias_reward*self.wall_bias
+
     def _set_up_transition_reward_matrices(
         self,
         move_prob,
@@ -133,38 +167,39 @@ class Maze(GridMDP, TabularMarkovDecisionProcess):
         include_wall_effect,
         include_terminal_state_effect
     ):
-        ss = self._state_list
-        aa = self._action_list
-        center = np.array([(self._width - 1)/2, (self._height - 1)/2])
-        max_center_dist = center.sum()
+        """
+        Builds the transition and reward matrices using array indexing
+        over all state-actions at once. Effects are accumulated in the same
+        order as a per-state-action loop would, so the resulting matrices
+        are identical to building them one state-action at a time.
+        """
+        nss, naa = len(self._state_list), len(self._action_list)
+        si, ai, nsi = self._state_action_next_state_indices()
 
         # default transition potential
-        tf_logits = np.ones((len(ss), len(aa), len(ss)))
+        tf_logits = np.ones((nss, naa, nss))
         tf_logits = np.log(tf_logits/tf_logits.sum(-1, keepdims=True))
-        rf = np.zeros((len(ss), len(aa), len(ss)))
-
-        for (si, s), (ai, a) in product(enumerate(ss), enumerate(aa)):
-            ns = Location(s.x + a.dx, s.y + a.dy)
-            if not self.on_board(ns):
-                ns = s
-            nsi = self._state_index[ns]
-            if include_action_effect:
-                tf_logits[si, ai, :] = -float('inf')
-                tf_logits[si, ai, si] = np.log(1 - move_prob)
-                tf_logits[si, ai, nsi] = np.log(move_prob)
-                rf[si, ai, si] += step_cost
-                if si != nsi:
-                    rf[si, ai, nsi] += step_cost
-
-            if include_wall_effect and not self.is_wall(s) and self.is_wall(ns):
-                tf_logits[si, ai, si] += np.log(wall_block_prob)
-                tf_logits[si, ai, nsi] += np.log(1 - wall_block_prob)
-                rf[si, ai, si] += wall_bump_cost
-            
-            if self.wall_bias > 0.:
-                wall_bias_reward = np.abs(center - s).sum() - max_center_dist
-                rf[si, ai, si] += wall_bias_reward*self.wall_bias
-                rf[si, ai, nsi] += wall_bias_reward*self.wall_bias
+        rf = np.zeros((nss, naa, nss))
+
+        if include_action_effect:
+            tf_logits[:, :, :] = -float('inf')
+            tf_logits[si, ai, si] = np.log(1 - move_prob)
+            tf_logits[si, ai, nsi] = np.log(move_prob)
+            rf[si, ai, si] += step_cost
+            moved = si != nsi
+            rf[si[moved], ai[moved], nsi[moved]] += step_cost
+
+        if include_wall_effect:
+            bump = self._wall_bump_mask(si, nsi)
+            b_si, b_ai, b_nsi = si[bump], ai[bump], nsi[bump]
+            tf_logits[b_si, b_ai, b_si] += np.log(wall_block_prob)
+            tf_logits[b_si, b_ai, b_nsi] += np.log(1 - wall_block_prob)
+            rf[b_si, b_ai, b_si] += wall_bump_cost
+
+        if self.wall_bias > 0.:
+            wall_bias_reward = self._wall_bias_reward_vec()[si]
+            rf[si, ai, si] += wall_bias_reward
+            rf[si, ai, nsi] += wall_bias_reward
         assert not np.isnan(tf_logits).any()
 
         nt = self.nonterminal_state_vec.astype(bool)
@@ -178,7 +213,6 @@ class Maze(GridMDP, TabularMarkovDecisionProcess):
         assert not np.isnan(tf).any()
         tf[nt,:,:] = tf[nt,:,:]/tf[nt,:,:].sum(-1, keepdims=True)
         assert np.isclose(tf[nt,:,:].sum(-1), 1).all()
-        # assert (tf[nt,:,:].sum(-1) == 1).all()
         self._transition_matrix = tf
         self._reward_matrix = rf
 
@@ -254,6 +288,83 @@ class Maze(GridMDP, TabularMarkovDecisionProcess):
         plotter.plot_outer_box()
         return plotter
 
+class SparseMaze(Maze, SparseTabularMDP):
+    """
+    A Maze that stores its transition and reward functions as
+    `(S*A, S)` CSR matrices (rows are indexed by `si*n_actions + ai`),
+    following the `SparseTabularMDP` convention that terminal states
+    have no outgoing transitions. This never allocates the dense
+    `(S, A, S)` tensors and can be passed directly to
+    `SparsePolicyIteration`/`SparseValueIteration`.
+    """
+    def next_state_dist(self, s, a):
+        sai = self._state_index[s]*len(self._action_list) + self._action_index[a]
+        row = self.transition_matrix[sai]
+        return DictDistribution({self._state_list[i]: p for i, p in zip(row.indices, row.data)})
+
+    def reward(self, s, a, ns):
+        sai = self._state_index[s]*len(self._action_list) + self._action_index[a]
+        return self.reward_matrix[sai, self._state_index[ns]]
+
+    def _set_up_transition_reward_matrices(
+        self,
+        move_prob,
+        wall_block_prob,
+        feature_rewards,
+        step_cost,
+        wall_bump_cost,
+        include_action_effect,
+        include_wall_effect,
+        include_terminal_state_effect
+    ):
+        if not include_action_effect:
+            raise ValueError("SparseMaze requires `include_action_effect`")
+        nss, naa = len(self._state_list), len(self._action_list)
+        si, ai, nsi = self._state_action_next_state_indices()
+        moved = si != nsi
+
+        # each state-action has at most two next states: staying and moving
+        stay_logit = np.full((nss, naa), np.log(1 - move_prob))
+        move_logit = np.full((nss, naa), np.log(move_prob))
+        stay_reward = np.zeros((nss, naa)) + step_cost
+        move_reward = np.zeros((nss, naa)) + step_cost
+        if include_wall_effect:
+            bump = self._wall_bump_mask(si, nsi)
+            stay_logit[bump] += np.log(wall_block_prob)
+            move_logit[bump] += np.log(1 - wall_block_prob)
+            stay_reward[bump] += wall_bump_cost
+        if self.wall_bias > 0.:
+            wall_bias_reward = self._wall_bias_reward_vec()[si]
+            stay_reward += wall_bias_reward
+            move_reward += wall_bias_reward
+            # not moving means both the origin and destination bias apply
+            move_reward[~moved] += wall_bias_reward[~moved]
+        stay_tf = np.where(moved, np.exp(stay_logit), 0.)
+        move_tf = np.exp(move_logit)
+        norm = stay_tf + move_tf
+        stay_tf, move_tf = stay_tf/norm, move_tf/norm
+        assert not np.isnan(norm).any()
+
+        nt = self.nonterminal_state_vec.astype(bool)
+        keep_stay = (stay_tf > 0) & nt[:, None]
+        keep_move = (move_tf > 0) & nt[:, None]
+        sai = si*naa + ai
+        rows = np.concatenate([sai[keep_stay], sai[keep_move]])
+        cols = np.concatenate([si[keep_stay], nsi[keep_move]])
+        shape = (nss*naa, nss)
+        tf = sparse.coo_matrix(
+            (np.concatenate([stay_tf[keep_stay], move_tf[keep_move]]), (rows, cols)),
+            shape=shape
+        ).tocsr()
+        rf = sparse.coo_matrix(
+            (np.concatenate([stay_reward[keep_stay], move_reward[keep_move]]), (rows, cols)),
+            shape=shape
+        ).tocsr()
+        tf.sort_indices()
+        rf.sort_indices()
+        self._transition_matrix = tf
+        self._reward_matrix = rf
+
 class MazePlotter(GridMDPPlotter):
     def plot_policy(self, policy, arrow_width=.1):
         return self.plot_location_action_map(
@@ -0,0 +1,219 @@
+"""
+Byte-budgeted, in-process LRU caches.
+
+`functools.lru_cache` bounds the number of entries, but entries here range
+from a few floats to dense `S x A x S` tensors and full planning results.
+Functions decorated with `memory_cache` instead share a single LRU that
+evicts entries once their estimated total size exceeds a memory budget.
+
+The budget is set with `configure_memory_cache` or the
+`VGC_MEMORY_CACHE_MAX_BYTES` environment variable (default 2GB).
+
+Cached objects can grow after they are stored (e.g., msdm MDPs fill in
+their matrices through `cached_property` on first use), so entries are
+re-measured on their 1st, 2nd, 4th, 8th, ... hit.
+"""
+import os
+import sys
+import types
+import threading
+import functools
+from collections import OrderedDict, namedtuple
+import numpy as np
+import scipy.sparse as sparse
+
+DEFAULT_MAX_BYTES = 2*2**30
+
+_SKIPPED_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+    types.MethodType, functools.partial
+)
+
+def estimate_nbytes(obj):
+    """
+    Estimates the memory held by `obj` by walking its containers and
+    attributes. NumPy arrays count their `nbytes` (views count their base
+    array) and sparse matrices count their data and index arrays. Objects
+    reachable along several paths are counted once.
+    """
+    seen = set()
+    stack = [obj]
+    n_bytes = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            if obj.base is None:
+                n_bytes += obj.nbytes
+            elif isinstance(obj.base, np.ndarray):
+                # a view keeps its whole base array alive
+                stack.append(obj.base)
+            if obj.dtype.hasobject:
+                stack.extend(obj.ravel().tolist())
+            continue
+        if sparse.issparse(obj):
+            stack.extend(
+                getattr(obj, name) for name in ("data", "indices", "indptr", "row", "col", "offsets")
+                if hasattr(obj, name)
+            )
+            continue
+        n_bytes += sys.getsizeof(obj, 0)
+        if isinstance(obj, (str, bytes, int, float, complex, bool)) or obj is None:
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "items") and callable(obj.items):
+            try:
+                for k, v in obj.items():
+                    stack.append(k)
+                    stack.append(v)
+            except TypeError:
+                pass
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for name in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, name):
+                stack.append(getattr(obj, name))
+    return n_bytes
+
+class MemoryCache:
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = int(os.environ.get("VGC_MEMORY_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict() # (namespace, key) -> [value, n_bytes, hits]
+        self._lock = threading.RLock()
+        self._stats = {}
+
+    def _namespace_stats(self, namespace):
+        if namespace not in self._stats:
+            self._stats[namespace] = dict(hits=0, misses=0, evictions=0, entries=0, n_bytes=0)
+        return self._stats[namespace]
+
+    def get(self, namespace, key):
+        """Returns `(True, value)` for a cached entry and `(False, None)` otherwise"""
+        with self._lock:
+            stats = self._namespace_stats(namespace)
+            try:
+                entry = self._entries[namespace, key]
+            except KeyError:
+                stats['misses'] += 1
+                return False, None
+            self._entries.move_to_end((namespace, key))
+            stats['hits'] += 1
+            entry[2] += 1
+            if entry[2] & (entry[2] - 1) == 0:
+                self._remeasure(namespace, key, entry)
+            return True, entry[0]
+
+    def _remeasure(self, namespace, key, entry):
+        n_bytes = estimate_nbytes(entry[0])
+        stats = self._namespace_stats(namespace)
+        stats['n_bytes'] += n_bytes - entry[1]
+        self.n_bytes += n_bytes - entry[1]
+        entry[1] = n_bytes
+        if n_bytes > self.max_bytes:
+            self._remove(namespace, key)
+        self.evict()
+
+    def _remove(self, namespace, key):
+        _, n_bytes, _ = self._entries.pop((namespace, key))
+        stats = self._namespace_stats(namespace)
+        stats['entries'] -= 1
+        stats['n_bytes'] -= n_bytes
+        self.n_bytes -= n_bytes
+
+    def put(self, namespace, key, value, n_bytes=None):
+        if n_bytes is None:
+            n_bytes = estimate_nbytes(value)
+        with self._lock:
+            if (namespace, key) in self._entries or n_bytes > self.max_bytes:
+                return
+            self._entries[namespace, key] = [value, n_bytes, 0]
+            stats = self._namespace_stats(namespace)
+            stats['entries'] += 1
+            stats['n_bytes'] += n_bytes
+            self.n_bytes += n_bytes
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """Removes least recently used entries until the cache fits in `max_bytes`"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            while self.n_bytes > max_bytes:
+                namespace, key = next(iter(self._entries))
+                self._remove(namespace, key)
+                self._namespace_stats(namespace)['evictions'] += 1
+
+    def clear(self, namespace=None):
+        with self._lock:
+            for entry_key in list(self._entries.keys()):
+                if namespace is None or entry_key[0] == namespace:
+                    self._remove(*entry_key)
+
+    def stats(self):
+        """Hit, miss and eviction counts and cached bytes for each namespace"""
+        with self._lock:
+            return {namespace: dict(stats) for namespace, stats in self._stats.items()}
+
+_default_cache = MemoryCache()
+def get_memory_cache():
+    """Returns the `MemoryCache` shared by functions decorated with `memory_cache`"""
+    return _default_cache
+
+def configure_memory_cache(max_bytes):
+    """Sets the budget of the shared `MemoryCache`, evicting entries if needed"""
+    _default_cache.max_bytes = max_bytes
+    _default_cache.evict()
+    return _default_cache
+
+CacheInfo = namedtuple("CacheInfo", "hits misses max_bytes currsize")
+
+_KWARGS_MARK = object()
+def memory_cache(func=None, *, namespace=None, cache=None):
+    """
+    Drop-in replacement for `functools.lru_cache` that stores results in a
+    byte-budgeted `MemoryCache` (by default, the shared one). Like
+    `lru_cache`, arguments must be hashable. The wrapper has `cache_info`,
+    `cache_clear` and `cache_stats` methods.
+    """
+    if func is None:
+        return functools.partial(memory_cache, namespace=namespace, cache=cache)
+    if namespace is None:
+        namespace = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        memcache = _default_cache if cache is None else cache
+        key = args
+        if kwargs:
+            key += (_KWARGS_MARK, ) + tuple(kwargs.items())
+        found, value = memcache.get(namespace, key)
+        if found:
+            return value
+        value = func(*args, **kwargs)
+        memcache.put(namespace, key, value)
+        return value
+
+    def cache_stats():
+        memcache = _default_cache if cache is None else cache
+        return memcache.stats().get(
+            namespace, dict(hits=0, misses=0, evictions=0, entries=0, n_bytes=0)
+        )
+    def cache_info():
+        stats = cache_stats()
+        memcache = _default_cache if cache is None else cache
+        return CacheInfo(stats['hits'], stats['misses'], memcache.max_bytes, stats['entries'])
+    def cache_clear():
+        (_default_cache if cache is None else cache).clear(namespace)
+    wrapped.cache_stats = cache_stats
+    wrapped.cache_info = cache_info
+    wrapped.cache_clear = cache_clear
+    wrapped.namespace = namespace
+    return wrapped
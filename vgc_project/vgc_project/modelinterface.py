@@ -1,4 +1,3 @@
-import joblib
 import numpy as np
 import random
 import functools
@@ -9,14 +8,19 @@ from vgc_project.dynamic_vgc import dynamic_vgc
 from vgc_project.heuristic_search import trajectory_based_heuristic_search, graph_based_heuristic_search
 from vgc_project.successor_rep import optimal_bottleneck, successor_representation
 from vgc_project.maze_stats import maze_obstacle_statistics
+from vgc_project.artifact_store import ArtifactStore
 
 def create_modeling_interface(
     *,
     use_cache=True,
     lru_cache_maxsize=None,
+    cache_location=None,
+    cache_max_bytes=None,
     joblib_cache_location=None
 ):
-    joblibmemory = joblib.Memory(joblib_cache_location, verbose=0)
+    # `joblib_cache_location` is the name used before the artifact store
+    cache_location = cache_location or joblib_cache_location
+    artifact_store = ArtifactStore(cache_location, cache_max_bytes) if cache_location else None
     model_functions = [
         value_guided_construal,
         dynamic_vgc,
@@ -29,8 +33,8 @@ def create_modeling_interface(
     mods = SimpleNamespace()
     for mod in model_functions:
         if use_cache:
-            joblib_func = joblibmemory.cache()(mod)
-            mod = functools.wraps(mod)(joblib_func)
+            if artifact_store is not None:
+                mod = artifact_store.cache(mod)
             mod = functools.lru_cache(maxsize=lru_cache_maxsize)(mod)
         setattr(mods, mod.__name__, mod)
 
@@ -23,48 +23,133 @@ default_parameter_bounds = dict(
     obs_awareness_prior=Bound(0., 1.),
 )
 
+# parameters whose gradients `make_minimize_kwargs(jac=True)` computes
+gradient_parameters = (
+    "construal_inverse_temp",
+    "construal_rand_choose",
+    "construal_weight",
+    "obs_awareness_prior",
+    "policy_inverse_temp",
+    "policy_rand_choose",
+)
+
+bound_margin = 1e-6
+
+def group_trials_by_maze(trials : Sequence[Trial]):
+    """
+    Groups trials by maze into arrays of obstacle indices and responses.
+    Obstacle indices refer to the sorted obstacles of the maze (the order of
+    `SoftValueGuidedConstrualModel.obstacles`).
+    """
+    maze_trials = {}
+    for t in trials:
+        maze_trials.setdefault(t.maze, []).append(t)
+    groups = []
+    for maze, m_trials in maze_trials.items():
+        obstacles = sorted(set(''.join(maze)) & set("0123456789"))
+        real = [t for t in m_trials if t.type == 'real']
+        binomial = [t for t in m_trials if t.type == 'binomial']
+        if len(real) + len(binomial) != len(m_trials):
+            raise ValueError(f"Unknown trial types: {set(t.type for t in m_trials)}")
+        groups.append(SimpleNamespace(
+            maze=maze,
+            real_obstacle_idx=np.array([obstacles.index(t.obstacle) for t in real], dtype=int),
+            real_values=np.array([t.value for t in real], dtype=float),
+            binomial_obstacle_idx=np.array([obstacles.index(t.obstacle) for t in binomial], dtype=int),
+            binomial_counts=np.array([t.value[0] for t in binomial], dtype=float),
+            binomial_totals=np.array([t.value[1] for t in binomial], dtype=float),
+        ))
+    return groups
+
+def maze_trials_nll(obstacle_prob_vec, group, return_logit_grad=False):
+    """
+    Negative log-likelihood of the trials in a maze group given obstacle
+    probabilities. With `return_logit_grad=True`, also returns its gradient
+    with respect to the log-odds of the obstacle probabilities.
+    """
+    assert (group.binomial_counts <= group.binomial_totals).all()
+    nll = 0
+    logit_grad = np.zeros(len(obstacle_prob_vec))
+    if len(group.real_obstacle_idx):
+        p = obstacle_prob_vec[group.real_obstacle_idx]
+        residuals = np.log(p/(1-p)) - group.real_values
+        nll += np.sum(residuals**2)
+        np.add.at(logit_grad, group.real_obstacle_idx, 2*residuals)
+    if len(group.binomial_obstacle_idx):
+        p = obstacle_prob_vec[group.binomial_obstacle_idx]
+        nll -= np.sum(
+            np.log(p)*group.binomial_counts + \
+            np.log(1 - p)*(group.binomial_totals - group.binomial_counts)
+        )
+        np.add.at(logit_grad, group.binomial_obstacle_idx, group.binomial_totals*p - group.binomial_counts)
+    if return_logit_grad:
+        return nll, logit_grad
+    return nll
+
 def make_minimize_kwargs(
     *,
     trials : Sequence[Trial],
     default_vgc_parameters : dict,
     parameters_to_fit: list,
     parameter_bounds : dict=None,
+    jac : bool=False,
 ):
+    """
+    Keyword arguments for `scipy.optimize.minimize`. With `jac=True`, `fun`
+    also returns the analytic gradient (e.g., for `method="L-BFGS-B"`),
+    which is available for the parameters in `gradient_parameters`.
+    """
     if parameter_bounds is None:
         parameter_bounds = default_parameter_bounds
+    if jac and not set(parameters_to_fit) <= set(gradient_parameters):
+        raise ValueError(f"Gradients are only available for {gradient_parameters}")
+    policy_gradients = jac and bool({"policy_inverse_temp", "policy_rand_choose"} & set(parameters_to_fit))
+    maze_groups = group_trials_by_maze(trials)
     def fun(x):
         x_params = dict(zip(parameters_to_fit, x))
         
         # penalize for being outside of bounds
         for k, v in x_params.items():
-            if parameter_bounds[k].min is not None and v < parameter_bounds[k].min:
-                return np.inf
-            if parameter_bounds[k].max is not None and v > parameter_bounds[k].max:
-                return np.inf
+            if (parameter_bounds[k].min is not None and v < parameter_bounds[k].min) or \
+                    (parameter_bounds[k].max is not None and v > parameter_bounds[k].max):
+                return (np.inf, np.zeros(len(x))) if jac else np.inf
             
+        vgc_parameters = {**default_vgc_parameters, **x_params}
         nll = 0
-        for t in trials:
+        grad = np.zeros(len(parameters_to_fit))
+        for group in maze_groups:
             model = soft_value_guided_construal(
-                tile_array=t.maze,
-                **{
-                    **default_vgc_parameters,
-                    **x_params
-                }
+                tile_array=group.maze,
+                **vgc_parameters,
+                gradients=policy_gradients
             )
-            if t.type == 'real':
-                nll += model.nll_logodds(t.obstacle, t.value)
-            elif t.type == 'binomial':
-                nll += model.nll_binomial(t.obstacle, *t.value)
-            else:
-                raise
+            if not jac:
+                nll += maze_trials_nll(model.obstacle_prob_vec, group)
+                continue
+            group_nll, logit_grad = maze_trials_nll(model.obstacle_prob_vec, group, return_logit_grad=True)
+            param_grads = model.parameter_gradients(logit_grad)
+            nll += group_nll
+            grad += [param_grads[p] for p in parameters_to_fit]
+        if jac:
+            return nll, grad
         return nll
     x0 = [default_vgc_parameters[p] for p in parameters_to_fit]
     bounds = [tuple(parameter_bounds[k]) for k in parameters_to_fit]
-    return {
+    if jac:
+        # gradient-based methods evaluate the bounds themselves, where
+        # some parameters are degenerate (e.g., `policy_inverse_temp=0`)
+        bounds = [
+            (None if lo is None else lo + bound_margin, None if hi is None else hi - bound_margin)
+            for lo, hi in bounds
+        ]
+    minimize_kwargs = {
         'fun': fun,
         'x0': x0,
         'bounds': bounds
     }
+    if jac:
+        minimize_kwargs['jac'] = True
+    return minimize_kwargs
 
 def synthetic_trials(
     *,
@@ -102,10 +187,17 @@ def synthetic_trials(
                     raise
     return trials
 
-import joblib
 import functools
+from vgc_project.artifact_store import ArtifactStore
 
-def create_recover_parameters(joblib_cache_location=None, lru_cache_maxsize=int(1e7)):
+def create_recover_parameters(
+    cache_location=None,
+    lru_cache_maxsize=int(1e7),
+    cache_max_bytes=None,
+    joblib_cache_location=None
+):
+    # `joblib_cache_location` is the name used before the artifact store
+    cache_location = cache_location or joblib_cache_location
     def recover_parameters(
         *,
         mazes : dict,
@@ -140,6 +232,8 @@ def create_recover_parameters(joblib_cache_location=None, lru_cache_maxsize=int(
             assert 'x0' not in minimize_kwargs
             assert 'bounds' not in minimize_kwargs
         parameters_to_fit = tuple(sorted(parameters_to_fit_initial_values.keys()))
+        jac = minimize_kwargs.get('jac') is True
+        minimize_kwargs = {k: v for k, v in minimize_kwargs.items() if k != 'jac'}
         main_minimize_kwargs = make_minimize_kwargs(
             trials=trials,
             default_vgc_parameters={
@@ -148,6 +242,7 @@ def create_recover_parameters(joblib_cache_location=None, lru_cache_maxsize=int(
             },
             parameters_to_fit=parameters_to_fit,
             parameter_bounds=None,
+            jac=jac,
         )
         minimize_result = minimize(
             **main_minimize_kwargs,
@@ -160,15 +255,20 @@ def create_recover_parameters(joblib_cache_location=None, lru_cache_maxsize=int(
             minimize_result=minimize_result
         )
     
-    if joblib_cache_location:
-        joblibmemory = joblib.Memory(joblib_cache_location, verbose=0)
-        joblib_func = joblibmemory.cache()(recover_parameters)
-        recover_parameters = functools.wraps(recover_parameters)(joblib_func)
+    if cache_location:
+        recover_parameters = ArtifactStore(cache_location, cache_max_bytes).cache(recover_parameters)
         recover_parameters = functools.lru_cache(maxsize=lru_cache_maxsize)(recover_parameters)
         return recover_parameters
     return recover_parameters
 
-def create_fit_vgc_model_to_trials(joblib_cache_location=None, lru_cache_maxsize=int(1e7)):
+def create_fit_vgc_model_to_trials(
+    cache_location=None,
+    lru_cache_maxsize=int(1e7),
+    cache_max_bytes=None,
+    joblib_cache_location=None
+):
+    # `joblib_cache_location` is the name used before the artifact store
+    cache_location = cache_location or joblib_cache_location
     def fit_vgc_model_to_trials(
         *,
         trials : Sequence[Trial],
@@ -186,11 +286,15 @@ def create_fit_vgc_model_to_trials(joblib_cache_location=None, lru_cache_maxsize
             assert 'fun' not in minimize_kwargs
             assert 'x0' not in minimize_kwargs
             assert 'bounds' not in minimize_kwargs
+        # `jac=True` uses the analytic gradient of the objective
+        jac = minimize_kwargs.get('jac') is True and len(parameters_to_fit) > 0
+        minimize_kwargs = {k: v for k, v in minimize_kwargs.items() if k != 'jac'}
         main_minimize_kwargs = make_minimize_kwargs(
             trials=trials,
             default_vgc_parameters=default_vgc_parameters,
             parameters_to_fit=parameters_to_fit,
             parameter_bounds=None,
+            jac=jac,
         )
 
         if len(parameters_to_fit) == 0:
@@ -210,9 +314,148 @@ def create_fit_vgc_model_to_trials(joblib_cache_location=None, lru_cache_maxsize
                 minimize_result=minimize_result
             )
         return fit_result
-    if joblib_cache_location:
-        joblibmemory = joblib.Memory(joblib_cache_location, verbose=0)
-        joblib_func = joblibmemory.cache()(fit_vgc_model_to_trials)
-        fit_vgc_model_to_trials = functools.wraps(fit_vgc_model_to_trials)(joblib_func)
+    if cache_location:
+        fit_vgc_model_to_trials = ArtifactStore(cache_location, cache_max_bytes).cache(fit_vgc_model_to_trials)
         fit_vgc_model_to_trials = functools.lru_cache(maxsize=lru_cache_maxsize)(fit_vgc_model_to_trials)
     return fit_vgc_model_to_trials
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from vgc_project.artifact_store import configure_artifact_store
+
+def sample_initial_values(parameters_to_fit, rng):
+    """Random initial values of the kind used for multi-start fitting"""
+    initial_values = {}
+    for p in parameters_to_fit:
+        if p in ['construal_rand_choose', 'policy_rand_choose', 'obs_awareness_prior']:
+            initial_values[p] = rng.random()
+        elif p in ['construal_inverse_temp', 'policy_inverse_temp', 'construal_weight']:
+            initial_values[p] = rng.random()*rng.choice([1, 10])
+        else:
+            raise ValueError(f"No initial value distribution for {p}")
+    return initial_values
+
+class _RestartDominated(Exception):
+    pass
+
+_multistart_worker = {}
+def _init_multistart_worker(best_score, fit_kwargs, cache_location):
+    if cache_location is not None:
+        # construal utilities are shared between workers through this store
+        configure_artifact_store(cache_location)
+    _multistart_worker.clear()
+    _multistart_worker.update(best_score=best_score, **fit_kwargs)
+
+def _multistart_restart_worker(initial_values):
+    w = _multistart_worker
+    best_score = w['best_score']
+    main_minimize_kwargs = make_minimize_kwargs(
+        trials=w['trials'],
+        default_vgc_parameters={**w['default_vgc_parameters'], **initial_values},
+        parameters_to_fit=w['parameters_to_fit'],
+        jac=w['jac'],
+    )
+    fun = main_minimize_kwargs['fun']
+    restart = SimpleNamespace(n_evaluations=0, score=np.inf, x=main_minimize_kwargs['x0'])
+    def tracked_fun(x):
+        res = fun(x)
+        score = res[0] if w['jac'] else res
+        restart.n_evaluations += 1
+        if score < restart.score:
+            restart.score, restart.x = score, np.array(x)
+        # read the shared best score once so the update and the check below agree
+        with best_score.get_lock():
+            current_best = best_score.value
+            if restart.score < current_best:
+                best_score.value = current_best = restart.score
+        if w['dominance_margin'] is not None and \
+                restart.n_evaluations >= w['min_evaluations'] and \
+                restart.score > current_best + w['dominance_margin']:
+            raise _RestartDominated
+        return res
+    main_minimize_kwargs['fun'] = tracked_fun
+    try:
+        minimize_result = minimize(**main_minimize_kwargs, **w['minimize_kwargs'])
+        cancelled = False
+    except _RestartDominated:
+        minimize_result = None
+        cancelled = True
+    if minimize_result is not None:
+        fitted_x, score = minimize_result.x, minimize_result.fun
+    else:
+        fitted_x, score = restart.x, restart.score
+    return dict(
+        initial_parameters=initial_values,
+        fitted_parameters=dict(zip(w['parameters_to_fit'], fitted_x)),
+        score=score,
+        minimize_result=minimize_result,
+        cancelled=cancelled,
+        n_evaluations=restart.n_evaluations
+    )
+
+def fit_vgc_model_multistart(
+    *,
+    trials : Sequence[Trial],
+    default_vgc_parameters : dict,
+    parameters_to_fit : Sequence,
+    n_starts : int,
+    seed : int,
+    minimize_kwargs : dict=None,
+    n_jobs : int=1,
+    cache_location : str=None,
+    dominance_margin : float=None,
+    min_evaluations : int=50,
+):
+    """
+    Fits parameters from `n_starts` initial values: the values in
+    `default_vgc_parameters` followed by random ones (`sample_initial_values`),
+    run over a pool of `n_jobs` processes. Workers share construal utilities
+    through the artifact store at `cache_location` (default: the default store).
+
+    If `dominance_margin` is set, a restart is cancelled once it has made
+    `min_evaluations` objective evaluations and its best score is worse than
+    the best score of any restart by more than `dominance_margin`.
+
+    Returns the best fit (in the format of `fit_vgc_model_to_trials`) and the
+    results of all restarts, in the order they were started.
+    """
+    if minimize_kwargs is None:
+        minimize_kwargs = dict(
+            method="Nelder-Mead",
+            options=dict(
+                maxiter=1000,
+            ),
+        )
+    assert len(parameters_to_fit) > 0
+    rng = random.Random(seed)
+    initial_values = [{p: default_vgc_parameters[p] for p in parameters_to_fit}]
+    initial_values += [sample_initial_values(parameters_to_fit, rng) for _ in range(n_starts - 1)]
+    fit_kwargs = dict(
+        trials=tuple(trials),
+        default_vgc_parameters=dict(default_vgc_parameters),
+        parameters_to_fit=tuple(parameters_to_fit),
+        jac=minimize_kwargs.get('jac') is True,
+        minimize_kwargs={k: v for k, v in minimize_kwargs.items() if k != 'jac'},
+        dominance_margin=dominance_margin,
+        min_evaluations=min_evaluations,
+    )
+    best_score = multiprocessing.Value('d', np.inf)
+    if n_jobs == 1:
+        # in-process, construal utilities are already shared by the memory cache
+        _init_multistart_worker(best_score, fit_kwargs, None)
+        restarts = [_multistart_restart_worker(values) for values in initial_values]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_multistart_worker,
+            initargs=(best_score, fit_kwargs, cache_location)
+        ) as executor:
+            restarts = list(executor.map(_multistart_restart_worker, initial_values))
+    best = min(restarts, key=lambda r: r['score'])
+    return dict(
+        fitted_parameters=best['fitted_parameters'],
+        score=best['score'],
+        minimize_result=best['minimize_result'],
+        restarts=restarts,
+        n_cancelled=sum(r['cancelled'] for r in restarts)
+    )
@@ -1,10 +1,10 @@
 import functools
-import joblib
 import hashlib
 import pandas as pd
 import numpy as np
 import logging
 from types import SimpleNamespace
+from vgc_project.artifact_store import ArtifactStore
 
 class ImmutableDataFrame(pd.DataFrame):
     """A wrapper around pandas dataframe to prevent changes and allow hashing"""
@@ -29,9 +29,13 @@ def create_R_model_interface(
     *, 
     use_cache=True,
     always_load_data=False,
+    cache_location=None,
+    cache_max_bytes=None,
     joblib_cache_location=None
 ):
-    joblibmemory = joblib.Memory(joblib_cache_location, verbose=0)
+    # `joblib_cache_location` is the name used before the artifact store
+    cache_location = cache_location or joblib_cache_location
+    artifact_store = ArtifactStore(cache_location, cache_max_bytes) if cache_location else None
     
     from rpy2 import robjects as ro
     from rpy2.robjects import numpy2ri, pandas2ri
@@ -182,8 +186,8 @@ def create_R_model_interface(
     rmods = SimpleNamespace()
     for mod in [lm, glm, lmer, glmer]:
         if use_cache:
-            joblib_func = joblibmemory.cache()(mod)
-            mod = functools.wraps(mod)(joblib_func)
+            if artifact_store is not None:
+                mod = artifact_store.cache(mod)
             mod = simple_cache(mod)
         setattr(rmods, mod.__name__, mod)
     return rmods
\ No newline at end of file
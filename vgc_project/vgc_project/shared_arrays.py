@@ -0,0 +1,27 @@
+"""
+Shares large, read-only NumPy arrays with worker processes through
+memory-mapped `.npy` files so that they are not pickled for every task.
+"""
+import os
+import tempfile
+import contextlib
+import numpy as np
+
+@contextlib.contextmanager
+def shared_arrays(arrays, dir=None):
+    """
+    Writes `arrays` (a dict of name to array) to a temporary directory
+    that is removed on exit. Yields the directory, which workers pass to
+    `load_shared_arrays`. On Linux, `dir="/dev/shm"` keeps the files in memory.
+    """
+    with tempfile.TemporaryDirectory(dir=dir) as array_dir:
+        for name, array in arrays.items():
+            np.save(os.path.join(array_dir, f"{name}.npy"), array)
+        yield array_dir
+
+def load_shared_arrays(array_dir, names):
+    """Memory-maps the named arrays written by `shared_arrays`"""
+    return {
+        name: np.load(os.path.join(array_dir, f"{name}.npy"), mmap_mode='r')
+        for name in names
+    }
@@ -1,8 +1,9 @@
 """
 Version of VGC for doing parameter fitting.
 """
-from functools import lru_cache
 import numpy as np
+import scipy.linalg
+from types import SimpleNamespace
 from frozendict import frozendict
 
 from msdm.domains import GridWorld
@@ -10,6 +11,9 @@ from msdm.core.distributions import SoftmaxDistribution, DictDistribution, Deter
 from msdm.core.utils.funcutils import cached_property
 
 from vgc_project.construal_utils import create_gridworld, solve_gridworld, evaluate_construal, powerset
+from vgc_project.construal_lattice import plan_construal_lattice
+from vgc_project.memory_cache import memory_cache
+from vgc_project.artifact_store import cache_artifact
 
 
 def epsilon_softmax_policy_matrix(q, am, softmax_temp, rand_choose):
@@ -22,6 +26,20 @@ def epsilon_softmax_policy_matrix(q, am, softmax_temp, rand_choose):
     assert np.isclose(pi.sum(axis=-1), 1).all(), pi
     return pi
 
+def epsilon_softmax_policy_matrix_gradients(q, am, softmax_temp, rand_choose):
+    """
+    Derivatives of `epsilon_softmax_policy_matrix` with respect to the
+    inverse temperature (`1/softmax_temp`) and `rand_choose`
+    """
+    pi = q/softmax_temp
+    pi = pi - pi.max(axis=-1, keepdims=True)
+    pi = np.exp(pi)
+    pi = pi/pi.sum(axis=-1, keepdims=True)
+    return dict(
+        policy_inverse_temp=(1 - rand_choose)*pi*(q - (pi*q).sum(axis=-1, keepdims=True)),
+        policy_rand_choose=am/am.sum(axis=-1, keepdims=True) - pi
+    )
+
 def evaluate_policy_matrix(pi, tf, rf, discount_rate, nt, s0):
     mp = np.einsum("sa,san->sn", pi, tf)
     assert np.isclose(mp.sum(-1), 1).all()
@@ -30,18 +48,38 @@ def evaluate_policy_matrix(pi, tf, rf, discount_rate, nt, s0):
     v0 = v@s0
     return v0
 
+def evaluate_policy_matrix_gradients(pi, pi_grads, tf, rf, discount_rate, s0):
+    """
+    Initial value of `pi` and its derivatives given the derivatives of `pi`
+    (a dict of arrays shaped like `pi`). Differentiating `(I - γP)v = r`
+    gives `dv0 = occ @ (dpi*q).sum(-1)`, where `q` are the action values
+    of `pi` and `occ` solves `(I - γP)^T occ = s0`.
+    """
+    mp = np.einsum("sa,san->sn", pi, tf)
+    s_rf = np.einsum("sa,san,san->s", pi, tf, rf)
+    lu = scipy.linalg.lu_factor(np.eye(len(s0)) - discount_rate*mp)
+    v = scipy.linalg.lu_solve(lu, s_rf)
+    occ = scipy.linalg.lu_solve(lu, s0, trans=1)
+    q = np.einsum("san,san->sa", tf, rf) + discount_rate*tf@v
+    v0_grads = {param: occ@(dpi*q).sum(-1) for param, dpi in pi_grads.items()}
+    return v@s0, v0_grads
+
 class SoftValueGuidedConstrualModel:
     def __init__(
         self,
         vor,
         construal_inverse_temp,
         construal_rand_choose,
-        obs_awareness_prior
+        obs_awareness_prior,
+        utility_gradients=None
     ):
         self.vor = vor
         self.construal_inverse_temp = construal_inverse_temp
         self.construal_rand_choose = construal_rand_choose
         self.obs_awareness_prior = obs_awareness_prior
+        # derivatives of each construal's utility (in `vor` order)
+        # with respect to policy parameters
+        self.utility_gradients = utility_gradients
         
     @cached_property
     def construal_prob(self):
@@ -50,15 +88,63 @@ class SoftValueGuidedConstrualModel:
         construal_prob = rand_construal*self.construal_rand_choose | construal_prob*(1 - self.construal_rand_choose)
         return construal_prob
     
+    @cached_property
+    def obstacles(self):
+        return tuple(sorted(set.union(*[set(c) for c in self.vor.keys()])))
+
+    @cached_property
+    def _obstacle_prob_terms(self):
+        construals = list(self.vor.keys())
+        vor = np.array([self.vor[c] for c in construals])
+        logits = self.construal_inverse_temp*vor
+        softmax_prob = np.exp(logits - logits.max())
+        softmax_prob = softmax_prob/softmax_prob.sum()
+        construal_prob = self.construal_rand_choose/len(construals) + \
+            (1 - self.construal_rand_choose)*softmax_prob
+        in_construal = np.array([[o in c for o in self.obstacles] for c in construals])
+        p = construal_prob@in_construal
+        logit = np.log(p/(1-p)) + np.log(self.obs_awareness_prior/(1-self.obs_awareness_prior))
+        return SimpleNamespace(
+            vor=vor,
+            construal_sizes=np.array([len(c) for c in construals]),
+            softmax_prob=softmax_prob,
+            in_construal=in_construal,
+            construal_obstacle_prob=p,
+            logit=logit
+        )
+
+    @cached_property
+    def obstacle_prob_vec(self):
+        """Awareness probabilities of `self.obstacles` (same values as `obstacle_probs`)"""
+        return 1/(1 + np.exp(-self._obstacle_prob_terms.logit))
+
+    def parameter_gradients(self, obstacle_logit_grad):
+        """
+        Gradients of a loss with respect to the model parameters, given its
+        gradient with respect to the log-odds of `obstacle_prob_vec`. Policy
+        parameters are included if the model has `utility_gradients`.
+        """
+        terms = self._obstacle_prob_terms
+        p = terms.construal_obstacle_prob
+        construal_prob_grad = terms.in_construal@(obstacle_logit_grad/(p*(1 - p)))
+        softmax_prob_grad = (1 - self.construal_rand_choose)*construal_prob_grad
+        logits_grad = terms.softmax_prob*(softmax_prob_grad - softmax_prob_grad@terms.softmax_prob)
+        vor_grad = self.construal_inverse_temp*logits_grad
+        prior = self.obs_awareness_prior
+        grads = dict(
+            construal_inverse_temp=logits_grad@terms.vor,
+            construal_rand_choose=construal_prob_grad@(1/len(terms.vor) - terms.softmax_prob),
+            construal_weight=-vor_grad@terms.construal_sizes,
+            obs_awareness_prior=obstacle_logit_grad.sum()/(prior*(1 - prior)),
+        )
+        if self.utility_gradients is not None:
+            for param, utility_grad in self.utility_gradients.items():
+                grads[param] = vor_grad@utility_grad
+        return grads
+
     @cached_property
     def obstacle_probs(self):
-        obstacles = set.union(*[set(c) for c in self.vor.keys()])
-        construal_obs_probs = {o: self.construal_prob.marginalize(lambda c: o in c)[True] for o in obstacles}
-        obs_probs = {}
-        for o, p in construal_obs_probs.items():
-            logit = np.log(p/(1-p)) + np.log(self.obs_awareness_prior/(1-self.obs_awareness_prior))
-            obs_probs[o] = 1/(1 + np.exp(-logit))
-        return obs_probs
+        return dict(zip(self.obstacles, self.obstacle_prob_vec))
     
     def nll_binomial(self, obstacle, count, total):
         assert count <= total
@@ -70,16 +156,13 @@ class SoftValueGuidedConstrualModel:
         logodds = np.log(p/(1-p))
         return (logodds - val)**2
     
-@lru_cache(maxsize=int(1e7))
-def soft_value_guided_construal(
+@memory_cache
+@cache_artifact(namespace="soft_vgc_construal_utilities")
+def construal_utilities(
     *,
     tile_array,
-    construal_inverse_temp,
-    construal_rand_choose,
     policy_inverse_temp,
     policy_rand_choose,
-    construal_weight,
-    obs_awareness_prior=.5,
     success_prob=1-1e-5,
     
     feature_rewards=(("G", 0), ),
@@ -88,8 +171,24 @@ def soft_value_guided_construal(
     default_features=(".",),
     initial_features=("S",),
     step_cost=-1,
-    discount_rate=1.0
+    discount_rate=1.0,
+    planning_alg="policy_iteration",
+    gradients=False
 ):
+    """
+    Initial-state value in the true gridworld of the epsilon-softmax policy
+    planned with each construal. This is the expensive stage of
+    `soft_value_guided_construal`, and it is cached on only the parameters
+    that affect planning and policy evaluation. With `gradients=True`, the
+    derivatives of the utilities with respect to `policy_inverse_temp` and
+    `policy_rand_choose` are also returned.
+    """
+    assert planning_alg in (
+        "policy_iteration",
+        "lattice_policy_iteration",
+        "prioritized_value_iteration",
+        "topological_value_iteration"
+    )
     gw_params = dict(
         tile_array=tile_array,
         feature_rewards=frozendict(feature_rewards),
@@ -103,33 +202,110 @@ def soft_value_guided_construal(
     )
     gw = create_gridworld(gw_params)
     obstacles = [t for t in set(tuple("".join(tile_array))) if t in "0123456789"]
-    vor = {}
-    for construal in list(powerset(obstacles)):
-        cgw_params = {
-            **gw_params,
-            "wall_features": "#"+''.join(sorted(construal))
-        }
+    construals = list(powerset(obstacles))
+    construal_gw_params = {
+        construal: {**gw_params, "wall_features": "#"+''.join(sorted(construal))}
+        for construal in construals
+    }
+    if planning_alg == "lattice_policy_iteration":
+        plan_results = plan_construal_lattice(
+            construals,
+            make_mdp=lambda c: create_gridworld(construal_gw_params[c])
+        ).results
+    utilities = []
+    utility_gradients = {"policy_inverse_temp": [], "policy_rand_choose": []}
+    for construal in construals:
+        cgw_params = construal_gw_params[construal]
         cgw = create_gridworld(cgw_params)
-        cpi = solve_gridworld(cgw_params)
+        if planning_alg == "lattice_policy_iteration":
+            cpi = plan_results[construal]
+        else:
+            cpi = solve_gridworld(cgw_params, planning_alg=planning_alg)
         eps_soft_pi = epsilon_softmax_policy_matrix(
             q = cpi._qvaluemat,
             am = cgw.action_matrix,
             softmax_temp = 1/policy_inverse_temp,
             rand_choose = policy_rand_choose
         )
-        initial_value = evaluate_policy_matrix(
-            pi=eps_soft_pi,
-            tf=gw.transition_matrix,
-            rf=gw.reward_matrix,
-            discount_rate=gw.discount_rate,
-            nt=gw.nonterminal_state_vec,
-            s0=gw.initial_state_vec,
-        )
+        if gradients:
+            initial_value, initial_value_grads = evaluate_policy_matrix_gradients(
+                pi=eps_soft_pi,
+                pi_grads=epsilon_softmax_policy_matrix_gradients(
+                    q = cpi._qvaluemat,
+                    am = cgw.action_matrix,
+                    softmax_temp = 1/policy_inverse_temp,
+                    rand_choose = policy_rand_choose
+                ),
+                tf=gw.transition_matrix,
+                rf=gw.reward_matrix,
+                discount_rate=gw.discount_rate,
+                s0=gw.initial_state_vec,
+            )
+            for param, grad in initial_value_grads.items():
+                utility_gradients[param].append(grad)
+        else:
+            initial_value = evaluate_policy_matrix(
+                pi=eps_soft_pi,
+                tf=gw.transition_matrix,
+                rf=gw.reward_matrix,
+                discount_rate=gw.discount_rate,
+                nt=gw.nonterminal_state_vec,
+                s0=gw.initial_state_vec,
+            )
         assert initial_value < -10
-        vor[construal] = initial_value - construal_weight*len(construal)
+        utilities.append(initial_value)
+    return SimpleNamespace(
+        construals=construals,
+        utilities=np.array(utilities),
+        construal_sizes=np.array([len(c) for c in construals]),
+        utility_gradients={
+            param: np.array(grads) for param, grads in utility_gradients.items()
+        } if gradients else None
+    )
+
+def soft_value_guided_construal(
+    *,
+    tile_array,
+    construal_inverse_temp,
+    construal_rand_choose,
+    policy_inverse_temp,
+    policy_rand_choose,
+    construal_weight,
+    obs_awareness_prior=.5,
+    success_prob=1-1e-5,
+    
+    feature_rewards=(("G", 0), ),
+    absorbing_features=("G",),
+    wall_features="#0123456789",
+    default_features=(".",),
+    initial_features=("S",),
+    step_cost=-1,
+    discount_rate=1.0,
+    planning_alg="policy_iteration",
+    gradients=False
+):
+    # planning is cached by `construal_utilities`, so changing only
+    # the construal-level parameters does not re-solve any construal
+    utils = construal_utilities(
+        tile_array=tile_array,
+        policy_inverse_temp=policy_inverse_temp,
+        policy_rand_choose=policy_rand_choose,
+        success_prob=success_prob,
+        feature_rewards=feature_rewards,
+        absorbing_features=absorbing_features,
+        wall_features=wall_features,
+        default_features=default_features,
+        initial_features=initial_features,
+        step_cost=step_cost,
+        discount_rate=discount_rate,
+        planning_alg=planning_alg,
+        gradients=gradients
+    )
+    vor = utils.utilities - construal_weight*utils.construal_sizes
     return SoftValueGuidedConstrualModel(
-        vor=vor,
+        vor=dict(zip(utils.construals, vor)),
         construal_inverse_temp=construal_inverse_temp,
         construal_rand_choose=construal_rand_choose,
-        obs_awareness_prior=obs_awareness_prior
-    )
\ No newline at end of file
+        obs_awareness_prior=obs_awareness_prior,
+        utility_gradients=utils.utility_gradients
+    )
@@ -1,8 +1,9 @@
 from vgc_project.sparse.sparse_solvers import \
     sparse_value_iteration, SparseValueIteration, \
-    sparse_policy_iteration, SparsePolicyIteration
+    sparse_policy_iteration, SparsePolicyIteration, \
+    prioritized_value_iteration, PrioritizedValueIteration
 from vgc_project.sparse.sparse_tabularmdp import \
-    SparseTabularMDP
+    SparseTabularMDP, assemble_transition_reward_matrices
 from vgc_project.sparse.sparse_policy import \
     SparseTabularPolicy
     
\ No newline at end of file
@@ -1,31 +1,65 @@
 import time
+import heapq
 from types import SimpleNamespace
 import numpy as np
 from scipy.sparse import lil_matrix, csr_matrix
 import scipy.sparse as sparse
-from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import spsolve, splu, spilu, gmres, bicgstab, LinearOperator
 from msdm.core.algorithmclasses import Plans, PlanningResult
+from msdm.core.problemclasses.mdp import TabularPolicy
+from msdm.core.utils.funcutils import cached_property
 
 from vgc_project.sparse.sparse_tabularmdp import SparseTabularMDP
 from vgc_project.sparse.sparse_policy import SparseTabularPolicy
 
+class SparsePlanningResult(SimpleNamespace):
+    """
+    Planning result whose primary representation is `state_value_vec` and
+    `state_action_value_matrix`. The policy, the dict views of the values
+    and the initial value are built on first access.
+    """
+    @property
+    def _valuevec(self):
+        return self.state_value_vec
+
+    @property
+    def _qvaluemat(self):
+        return self.state_action_value_matrix
+
+    @cached_property
+    def policy(self):
+        # dense MDPs get msdm policies, whose `evaluate_on` is exact
+        policy_class = SparseTabularPolicy if isinstance(self.mdp, SparseTabularMDP) else TabularPolicy
+        return policy_class.from_q_matrix(
+            self.mdp.state_list, self.mdp.action_list, self.state_action_value_matrix
+        )
+
+    @cached_property
+    def state_value_dict(self):
+        return dict(zip(self.mdp.state_list, self.state_value_vec))
+
+    @cached_property
+    def actionvaluefunc(self):
+        aa = self.mdp.action_list
+        return {
+            s: dict(zip(aa, qs))
+            for s, qs in zip(self.mdp.state_list, np.asarray(self.state_action_value_matrix))
+        }
+
+    @cached_property
+    def initial_value(self):
+        s0 = np.asarray(self.mdp.initial_state_vec, dtype=float)
+        # skipping states with zero probability avoids 0*inf
+        s0_idx = s0.nonzero()[0]
+        return s0[s0_idx]@np.asarray(self.state_value_vec)[s0_idx]
+
+    pi = property(lambda self: self.policy)
+    valuefunc = V = property(lambda self: self.state_value_dict)
+    Q = property(lambda self: self.actionvaluefunc)
+
 class Solver(Plans):
     def update_result_object(self, res, mdp):
-        res.mdp = mdp
-        res._valuevec = res.state_value_vec
-        res._qvaluemat = res.state_action_value_matrix
-        policy = SparseTabularPolicy.from_q_matrix(mdp.state_list, mdp.action_list, res.state_action_value_matrix)
-        res.policy = res.pi = policy
-        vf = dict(zip(mdp.state_list, res.state_value_vec))
-        res.state_value_dict = res.valuefunc = res.V = vf
-        q = {}
-        for si, s in enumerate(mdp.state_list):
-            q[s] = {}
-            for ai, a in enumerate(mdp.action_list):
-                q[s][a] = res.state_action_value_matrix[si, ai]
-        res.actionvaluefunc = res.Q = q
-        res.initial_value = sum([res.V[s0]*p for s0, p in mdp.initial_state_dist().items()])
-        return res
+        return SparsePlanningResult(**{**vars(res), 'mdp': mdp})
     
 def sparse_value_iteration(
     transition_matrix,
@@ -34,38 +68,94 @@ def sparse_value_iteration(
     n_actions,
     discount_rate,
     max_iterations,
-    convergence_diff
+    convergence_diff,
+    sweep_order="jacobi",
+    block_size=256
 ):
-    v = csr_matrix((n_states, 1), dtype=transition_matrix.dtype)
-    for i in range(max_iterations):
-        q = state_action_reward_matrix + \
-            (discount_rate*transition_matrix*v).reshape(n_states, n_actions)
-        nv = q.max(-1)
-        diff = np.abs(v - nv)
-        if np.max(diff) < convergence_diff:
-            break
-        v = csr_matrix(nv)
+    """
+    Value iteration with dense value and Q-value arrays. Only the
+    `(S*A, S)` transition matrix is sparse.
+
+    sweep_order :
+        - `"jacobi"`: every state is backed up from the previous sweep's values
+        - `"gauss_seidel"`: states are backed up in blocks of `block_size`
+          states, each using the values updated earlier in the same sweep
+        - `"prioritized"`: Gauss-Seidel, but blocks are visited in order of
+          their largest value change in the previous sweep
+    """
+    sa_rf = np.asarray(
+        state_action_reward_matrix.todense() if sparse.issparse(state_action_reward_matrix)
+        else state_action_reward_matrix,
+        dtype=float
+    ).reshape(n_states, n_actions)
+    v = np.zeros(n_states)
+    if sweep_order == "jacobi":
+        # buffers reused across sweeps
+        q = np.empty((n_states, n_actions))
+        nv = np.empty(n_states)
+        diff = np.empty(n_states)
+        for i in range(max_iterations):
+            q_flat = q.reshape(-1)
+            np.multiply(transition_matrix@v, discount_rate, out=q_flat)
+            np.add(q, sa_rf, out=q)
+            np.max(q, axis=-1, out=nv)
+            np.subtract(nv, v, out=diff)
+            np.abs(diff, out=diff)
+            v, nv = nv, v
+            bellman_error = diff.max()
+            if bellman_error < convergence_diff:
+                break
+    elif sweep_order in ("gauss_seidel", "prioritized"):
+        starts = np.arange(0, n_states, block_size)
+        ends = np.minimum(starts + block_size, n_states)
+        block_tfs = [transition_matrix[start*n_actions:end*n_actions] for start, end in zip(starts, ends)]
+        block_diffs = np.full(len(starts), np.inf)
+        for i in range(max_iterations):
+            if sweep_order == "prioritized":
+                block_order = np.argsort(-block_diffs, kind='stable')
+            else:
+                block_order = range(len(starts))
+            for b in block_order:
+                start, end = starts[b], ends[b]
+                block_q = sa_rf[start:end] + \
+                    discount_rate*(block_tfs[b]@v).reshape(end - start, n_actions)
+                block_v = block_q.max(-1)
+                block_diffs[b] = np.abs(block_v - v[start:end]).max()
+                v[start:end] = block_v
+            if block_diffs.max() < convergence_diff:
+                break
+        q = sa_rf + discount_rate*(transition_matrix@v).reshape(n_states, n_actions)
+        bellman_error = np.abs(q.max(-1) - v).max()
+    else:
+        raise ValueError(f"Unknown sweep order: {sweep_order}")
     return SimpleNamespace(
-        state_value_vec=np.array(v.toarray()).flatten(),
+        state_value_vec=v,
         iterations=i,
-        state_action_value_matrix=np.array(q.toarray()),
+        state_action_value_matrix=q,
         converged=(i < max_iterations - 1),
-        max_bellman_error=np.max(diff)
+        max_bellman_error=bellman_error
     )
     
 class SparseValueIteration(Solver):
     def __init__(
         self,
         iterations=int(1e20),
-        convergence_diff=1e-8
+        convergence_diff=1e-8,
+        sweep_order="jacobi",
+        block_size=256
     ):
+        """
+        `sweep_order` selects the order of Bellman backups
+        (see `sparse_value_iteration`).
+        """
         self.iterations = iterations
         self.convergence_diff = convergence_diff
+        self.sweep_order = sweep_order
+        self.block_size = block_size
     
     def plan_on(self, mdp: SparseTabularMDP):
         sa_rf = mdp.state_action_reward_matrix
         sa_rf += np.log(mdp.action_matrix)
-        sa_rf = csr_matrix(sa_rf)
         res = sparse_value_iteration(
             transition_matrix=mdp.transition_matrix,
             state_action_reward_matrix=sa_rf,
@@ -73,13 +163,112 @@ class SparseValueIteration(Solver):
             n_actions=len(mdp.action_list),
             discount_rate=mdp.discount_rate,
             max_iterations=self.iterations,
-            convergence_diff=self.convergence_diff
+            convergence_diff=self.convergence_diff,
+            sweep_order=self.sweep_order,
+            block_size=self.block_size
         )
         return self.update_result_object(res, mdp)
 
 class SuccessfulResult(SimpleNamespace): pass
 class ErrorResult(SimpleNamespace): pass
     
+def iterative_solve(solver, a, b, x0=None, M=None, tol=1e-10, maxiter=None, restart=None):
+    """
+    Solves `a x = b` with `gmres` or `bicgstab`. Returns the solution,
+    scipy's convergence flag (0 on success) and the number of iterations.
+    """
+    n_iterations = [0]
+    def count_iterations(_):
+        n_iterations[0] += 1
+    kwargs = dict(x0=x0, M=M, atol=0., maxiter=maxiter, callback=count_iterations)
+    if solver == "gmres":
+        kwargs.update(restart=restart, callback_type='pr_norm')
+    iterative_solver = dict(gmres=gmres, bicgstab=bicgstab)[solver]
+    try:
+        x, info = iterative_solver(a, b, rtol=tol, **kwargs)
+    except TypeError:
+        # older scipy versions call the relative tolerance `tol`
+        x, info = iterative_solver(a, b, tol=tol, **kwargs)
+    return x, info, n_iterations[0]
+
+def sparse_policy_evaluation(
+    policy_transition_matrix,
+    policy_reward_vec,
+    discount_rate,
+    method="spsolve",
+    initial_values=None,
+    tol=1e-10,
+    n_sweeps=10,
+    factorization=None,
+    max_reuse_iterations=20
+):
+    """
+    Computes the values of a policy, `(I - discount_rate*P) v = r`.
+
+    method :
+        - `"spsolve"`: direct sparse solve
+        - `"splu"`: LU factorization that is kept and reused (passed back in
+          as `factorization`) to precondition GMRES on the next policy's
+          system. The system is refactored once the preconditioned solve
+          needs more than `max_reuse_iterations` iterations.
+        - `"gmres"`/`"bicgstab"`: iterative solve warm-started from
+          `initial_values` with an incomplete LU preconditioner
+        - `"modified"`: `n_sweeps` Bellman backups from `initial_values`
+          (modified policy iteration)
+
+    Returns the values, the number of solver iterations (or sweeps), the
+    infinity norm of the Bellman residual `r + discount_rate*P v - v`,
+    and the current factorization (for `"splu"`).
+    """
+    n_states = policy_transition_matrix.shape[0]
+    if initial_values is None:
+        initial_values = np.zeros(n_states)
+    a = sparse.csc_matrix(sparse.eye(n_states) - discount_rate*policy_transition_matrix)
+    solver_iterations = 0
+    if method == "spsolve":
+        v = spsolve(a, policy_reward_vec)
+    elif method == "splu":
+        info = None
+        if factorization is not None:
+            v, info, solver_iterations = iterative_solve(
+                "gmres", a, policy_reward_vec,
+                x0=initial_values,
+                M=LinearOperator(a.shape, factorization.solve),
+                tol=tol,
+                restart=max_reuse_iterations,
+                maxiter=1
+            )
+        if info != 0:
+            factorization = splu(a)
+            v = factorization.solve(policy_reward_vec)
+    elif method in ("gmres", "bicgstab"):
+        try:
+            ilu = spilu(a, drop_tol=1e-5, fill_factor=10)
+            M = LinearOperator(a.shape, ilu.solve)
+        except RuntimeError:
+            # the incomplete factorization is singular
+            M = None
+        v, info, solver_iterations = iterative_solve(
+            method, a, policy_reward_vec, x0=initial_values, M=M, tol=tol
+        )
+        if info != 0:
+            raise ValueError(f"{method} did not converge (info={info})")
+    elif method == "modified":
+        v = initial_values
+        for _ in range(n_sweeps):
+            v = policy_reward_vec + discount_rate*(policy_transition_matrix@v)
+        solver_iterations = n_sweeps
+    else:
+        raise ValueError(f"Unknown policy evaluation method: {method}")
+    v = np.asarray(v).flatten()
+    residual = policy_reward_vec + discount_rate*(policy_transition_matrix@v) - v
+    return SimpleNamespace(
+        state_value_vec=v,
+        solver_iterations=solver_iterations,
+        residual=np.abs(residual).max() if n_states > 0 else 0.,
+        factorization=factorization
+    )
+
 def sparse_policy_iteration(
     transition_matrix,
     state_action_reward_matrix,
@@ -88,42 +277,71 @@ def sparse_policy_iteration(
     discount_rate,
     max_iterations,
     value_decimals,
-    initial_pi=None
+    initial_pi=None,
+    evaluation="spsolve",
+    evaluation_tol=1e-10,
+    evaluation_sweeps=10
 ):
+    """
+    Policy iteration where each policy is evaluated with
+    `sparse_policy_evaluation` using the `evaluation` method. Iterative
+    methods are warm-started from the previous policy's values. With
+    `"modified"` evaluation, planning stops once the policy is stable and
+    the Bellman residual is below `evaluation_tol`.
+
+    The result's `iteration_stats` records, for each iteration, the
+    evaluation time, solver iterations, residual and number of states
+    whose action changed.
+    """
     sa_idx = np.arange(n_states*n_actions).reshape(n_states, n_actions)
-    pi_sel_mat = np.zeros(n_states*n_actions)
-    ss_eye = sparse.eye(n_states)
     nss_range = np.arange(n_states)
-    sa_rf_flat = state_action_reward_matrix.reshape(n_states*n_actions, 1).tocsr()
+    sa_rf = np.asarray(state_action_reward_matrix.todense())
     if initial_pi is not None:
         pi = initial_pi
     else:
         pi = np.random.randint(0, n_actions, size=n_states)
     
     start_time = time.time()
+    v, factorization = None, None
+    iteration_stats = []
     for i in range(max_iterations):
         pi_sa_idx = sa_idx[nss_range, pi]
         mp = transition_matrix[pi_sa_idx, :]
-        s_rf = sa_rf_flat[pi_sa_idx, :]
-        v = spsolve(ss_eye - discount_rate*mp, s_rf)
+        eval_start_time = time.time()
+        eval_res = sparse_policy_evaluation(
+            mp, sa_rf[nss_range, pi], discount_rate,
+            method=evaluation,
+            initial_values=v,
+            tol=evaluation_tol,
+            n_sweeps=evaluation_sweeps,
+            factorization=factorization
+        )
+        v, factorization = eval_res.state_value_vec, eval_res.factorization
         if np.isnan(v).any():
             raise ValueError("Error solving for values - discount*transition_matrix might be singular")
-        v = csr_matrix(v).transpose()
-        q = state_action_reward_matrix + \
-            (discount_rate*transition_matrix*v).reshape(n_states, n_actions)
-        q = np.round(q, decimals=value_decimals)
-        new_pi = np.array(q.argmax(-1)).flatten()
-        old_pi = pi
-        if (new_pi == pi).all():
+        # `transition_matrix` can also be a (matrix-free) LinearOperator
+        q = sa_rf + (discount_rate*(transition_matrix@v)).reshape(n_states, n_actions)
+        q = np.asarray(np.round(q, decimals=value_decimals))
+        new_pi = q.argmax(-1)
+        policy_changes = int((new_pi != pi).sum())
+        iteration_stats.append(dict(
+            evaluation_time=time.time() - eval_start_time,
+            solver_iterations=eval_res.solver_iterations,
+            residual=eval_res.residual,
+            policy_changes=policy_changes
+        ))
+        if policy_changes == 0 and \
+                (evaluation != "modified" or eval_res.residual < evaluation_tol):
             break
         pi = new_pi
         
     return SuccessfulResult(
-        state_value_vec=np.array(v.toarray()).flatten(),
+        state_value_vec=v,
         iterations=i,
-        state_action_value_matrix=np.array(q.toarray()),
+        state_action_value_matrix=q,
         converged=(i < max_iterations - 1),
-        run_time=time.time() - start_time
+        run_time=time.time() - start_time,
+        iteration_stats=iteration_stats
     )
     
 class SparsePolicyIteration(Solver):
@@ -131,26 +349,276 @@ class SparsePolicyIteration(Solver):
         self,
         iterations=int(1e20),
         value_decimals=10,
-        initial_policy=None
+        initial_policy=None,
+        matrix_free=False,
+        evaluation="spsolve",
+        evaluation_tol=1e-10,
+        evaluation_sweeps=10
     ):
+        """
+        If `matrix_free` is True, planning uses the MDP's
+        `transition_operator` instead of its `transition_matrix`.
+        `evaluation` selects how policies are evaluated (see
+        `sparse_policy_evaluation`).
+        """
         self.iterations = iterations
         self.value_decimals = value_decimals
         self.initial_policy = initial_policy
+        self.matrix_free = matrix_free
+        self.evaluation = evaluation
+        self.evaluation_tol = evaluation_tol
+        self.evaluation_sweeps = evaluation_sweeps
     
     def plan_on(self, mdp: SparseTabularMDP):
         sa_rf = mdp.state_action_reward_matrix
         sa_rf += np.log(mdp.action_matrix)
         sa_rf = csr_matrix(sa_rf)
+        if self.matrix_free:
+            transition_matrix = mdp.transition_operator
+        else:
+            transition_matrix = mdp.transition_matrix
         res = sparse_policy_iteration(
-            transition_matrix=mdp.transition_matrix,
+            transition_matrix=transition_matrix,
             state_action_reward_matrix=sa_rf,
             n_states=len(mdp.state_list),
             n_actions=len(mdp.action_list),
             discount_rate=mdp.discount_rate,
             max_iterations=self.iterations,
             value_decimals=self.value_decimals,
-            initial_pi=self.initial_policy
+            initial_pi=self.initial_policy,
+            evaluation=self.evaluation,
+            evaluation_tol=self.evaluation_tol,
+            evaluation_sweeps=self.evaluation_sweeps
         )
         if isinstance(res, ErrorResult):
             return res
-        return self.update_result_object(res, mdp)
\ No newline at end of file
+        return self.update_result_object(res, mdp)
+
+def sparse_planning_matrices(mdp):
+    """
+    Returns the `(S*A, S)` CSR transition matrix and `(S, A)`
+    state-action reward matrix used by the sparse solvers. Terminal
+    states have no outgoing transitions and zero reward.
+    """
+    n_states, n_actions = len(mdp.state_list), len(mdp.action_list)
+    nt = mdp.nonterminal_state_vec.astype(bool)
+    if isinstance(mdp, SparseTabularMDP):
+        tf = csr_matrix(mdp.transition_matrix)
+    else:
+        tf = mdp.transition_matrix*nt[:, None, None]
+        tf = csr_matrix(tf.reshape(n_states*n_actions, n_states))
+    sa_rf = np.asarray(mdp.state_action_reward_matrix)*nt[:, None]
+    sa_rf = sa_rf + np.log(mdp.action_matrix)
+    return tf, sa_rf
+
+def goal_distance_layers(transition_matrix, n_actions, nonterminal_state_vec):
+    """
+    Groups states by the number of steps they need to reach a terminal
+    state, following transitions with nonzero probability. The first
+    layer holds the terminal states. Also returns the predecessors of each
+    state, as a `(S, S)` CSR matrix, and the states that cannot reach a
+    terminal state.
+    """
+    n_states = transition_matrix.shape[1]
+    tf = transition_matrix.tocoo()
+    predecessors = csr_matrix(
+        (np.ones(tf.nnz, dtype=bool), (tf.col, tf.row//n_actions)),
+        shape=(n_states, n_states)
+    )
+    depth = np.full(n_states, -1)
+    frontier = np.flatnonzero(~np.asarray(nonterminal_state_vec).astype(bool))
+    depth[frontier] = 0
+    layers = []
+    while len(frontier) > 0:
+        layers.append(frontier)
+        preds = np.unique(predecessors[frontier].indices)
+        frontier = preds[depth[preds] < 0]
+        depth[frontier] = len(layers)
+    return layers, predecessors, np.flatnonzero(depth < 0)
+
+def _self_loop_backup(num, self_prob, discount_rate):
+    # solves v = max_a num[a] + discount_rate*self_prob[a]*v, treating
+    # actions that stay in the state forever as never reaching the goal
+    denom = 1 - discount_rate*self_prob
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.where(denom > 0, num/denom, -np.inf)
+    return q.max(-1)
+
+def prioritized_value_iteration(
+    transition_matrix,
+    state_action_reward_matrix,
+    nonterminal_state_vec,
+    discount_rate,
+    order="priority",
+    convergence_diff=1e-10,
+    max_backups=int(1e8)
+):
+    """
+    Value iteration for goal-directed MDPs that backs up states in an
+    order that follows how values propagate back from the terminal states.
+
+    order :
+        - `"priority"`: states are backed up in order of their Bellman
+          error, kept in a priority queue. After each backup the errors of
+          the state's predecessors are recomputed.
+        - `"topological"`: states are grouped into layers by their
+          distance to a terminal state (see `goal_distance_layers`), and
+          each sweep backs up the layers in order, nearest first.
+
+    Values start at `-inf` so that only transitions into already backed
+    up states are considered. Self-transitions are solved for exactly in
+    each backup (each action's value is `num/(1 - discount_rate*p_stay)`),
+    so near-deterministic mazes converge in very few backups per state.
+    States that cannot reach a terminal state form a closed MDP that is
+    solved first with `sparse_policy_iteration`.
+
+    Terminal states should have no outgoing transitions. `iterations`
+    counts sweeps (`"topological"`) or backups (`"priority"`).
+    """
+    n_states = transition_matrix.shape[1]
+    n_actions = transition_matrix.shape[0]//n_states
+    tf = csr_matrix(transition_matrix)
+    sa_rf = np.asarray(state_action_reward_matrix, dtype=float).reshape(n_states, n_actions)
+    nonterminal = np.asarray(nonterminal_state_vec).astype(bool)
+    start_time = time.time()
+
+    # split off self-transitions
+    tf_coo = tf.tocoo()
+    is_self = tf_coo.col == tf_coo.row//n_actions
+    self_prob = np.zeros((n_states, n_actions))
+    np.add.at(self_prob, (tf_coo.col[is_self], tf_coo.row[is_self] % n_actions), tf_coo.data[is_self])
+    off_tf = csr_matrix(
+        (tf_coo.data[~is_self], (tf_coo.row[~is_self], tf_coo.col[~is_self])),
+        shape=tf.shape
+    )
+    off_tf.eliminate_zeros()
+    off_tf.sort_indices()
+    layers, predecessors, closed = goal_distance_layers(tf, n_actions, nonterminal)
+
+    v = np.where(nonterminal, -np.inf, 0.)
+    n_backups = 0
+    if len(closed) > 0:
+        closed_rows = (closed[:, None]*n_actions + np.arange(n_actions)).reshape(-1)
+        closed_res = sparse_policy_iteration(
+            transition_matrix=tf[closed_rows][:, closed],
+            state_action_reward_matrix=csr_matrix(sa_rf[closed]),
+            n_states=len(closed),
+            n_actions=n_actions,
+            discount_rate=discount_rate,
+            max_iterations=int(1e20),
+            value_decimals=10,
+            initial_pi=np.zeros(len(closed), dtype=int)
+        )
+        v[closed] = closed_res.state_value_vec
+        n_backups += len(closed)*(closed_res.iterations + 1)
+
+    converged = True
+    if order == "topological":
+        layer_rows = [(l[:, None]*n_actions + np.arange(n_actions)).reshape(-1) for l in layers[1:]]
+        layer_tfs = [off_tf[rows] for rows in layer_rows]
+        iterations = 0
+        while True:
+            max_diff = 0.
+            for layer, layer_tf in zip(layers[1:], layer_tfs):
+                num = sa_rf[layer] + \
+                    discount_rate*(layer_tf@v).reshape(len(layer), n_actions)
+                layer_v = _self_loop_backup(num, self_prob[layer], discount_rate)
+                if np.isinf(v[layer]).any() or np.isinf(layer_v).any():
+                    max_diff = np.inf
+                else:
+                    max_diff = max(max_diff, np.abs(layer_v - v[layer]).max())
+                v[layer] = layer_v
+                n_backups += len(layer)
+            iterations += 1
+            if max_diff < convergence_diff:
+                break
+            if n_backups >= max_backups:
+                converged = False
+                break
+    elif order == "priority":
+        indptr, indices, data = off_tf.indptr, off_tf.indices, off_tf.data
+        entry_action = np.repeat(np.arange(tf.shape[0]), np.diff(indptr)) % n_actions
+        def backup(s):
+            start, end = indptr[s*n_actions], indptr[(s + 1)*n_actions]
+            num = sa_rf[s] + discount_rate*np.bincount(
+                entry_action[start:end],
+                weights=data[start:end]*v[indices[start:end]],
+                minlength=n_actions
+            )
+            return _self_loop_backup(num, self_prob[s], discount_rate)
+
+        priority = np.zeros(n_states)
+        queue = []
+        push_count = 0
+        if len(layers) > 1:
+            for s in layers[1]:
+                priority[s] = np.inf
+                queue.append((-np.inf, push_count, s))
+                push_count += 1
+        iterations = 0
+        while queue:
+            neg_priority, _, s = heapq.heappop(queue)
+            if -neg_priority != priority[s]:
+                continue
+            priority[s] = 0.
+            new_v = backup(s)
+            changed = new_v != v[s]
+            v[s] = new_v
+            n_backups += 1
+            iterations += 1
+            if n_backups >= max_backups:
+                converged = False
+                break
+            if not changed:
+                continue
+            for p in predecessors.indices[predecessors.indptr[s]:predecessors.indptr[s + 1]]:
+                if p == s or not nonterminal[p]:
+                    continue
+                new_pv = backup(p)
+                error = 0. if new_pv == v[p] else abs(new_pv - v[p])
+                if error >= convergence_diff and error != priority[p]:
+                    priority[p] = error
+                    heapq.heappush(queue, (-error, push_count, p))
+                    push_count += 1
+    else:
+        raise ValueError(f"Unknown backup order: {order}")
+
+    q = sa_rf + discount_rate*(tf@v).reshape(n_states, n_actions)
+    return SimpleNamespace(
+        state_value_vec=v,
+        state_action_value_matrix=q,
+        iterations=iterations,
+        n_backups=n_backups,
+        converged=converged,
+        max_bellman_error=np.abs(q.max(-1) - v).max(),
+        run_time=time.time() - start_time
+    )
+
+class PrioritizedValueIteration(Solver):
+    def __init__(
+        self,
+        order="priority",
+        convergence_diff=1e-10,
+        max_backups=int(1e8)
+    ):
+        """
+        Value iteration for goal-directed MDPs that backs up states in
+        priority or topological order (see `prioritized_value_iteration`).
+        Can also plan on dense MDPs.
+        """
+        self.order = order
+        self.convergence_diff = convergence_diff
+        self.max_backups = max_backups
+
+    def plan_on(self, mdp):
+        tf, sa_rf = sparse_planning_matrices(mdp)
+        res = prioritized_value_iteration(
+            transition_matrix=tf,
+            state_action_reward_matrix=sa_rf,
+            nonterminal_state_vec=mdp.nonterminal_state_vec,
+            discount_rate=mdp.discount_rate,
+            order=self.order,
+            convergence_diff=self.convergence_diff,
+            max_backups=self.max_backups
+        )
+        return self.update_result_object(res, mdp)
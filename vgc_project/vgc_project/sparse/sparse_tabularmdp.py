@@ -1,46 +1,89 @@
 import numpy as np
 from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
 from msdm.core.utils.funcutils import method_cache, cached_property
-from scipy.sparse import lil_matrix, csr_matrix, dok_matrix
+from scipy.sparse import lil_matrix, csr_matrix, dok_matrix, coo_matrix
+
+def assemble_transition_reward_matrices(chunks, n_states, n_actions):
+    """
+    Builds the `(S*A, S)` CSR transition and reward matrices from an
+    iterable of `(rows, cols, probs, rewards)` arrays, where rows are
+    indexed by `si*n_actions + ai`. Entries with zero probability are
+    dropped and both matrices share the same sparsity structure.
+    """
+    chunks = [tuple(np.asarray(a) for a in chunk) for chunk in chunks]
+    if len(chunks) > 0:
+        rows, cols, probs, rewards = [np.concatenate(a) for a in zip(*chunks)]
+    else:
+        rows, cols = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        probs, rewards = np.zeros(0), np.zeros(0)
+    keep = probs != 0.
+    rows, cols = rows[keep], cols[keep]
+    shape = (n_states*n_actions, n_states)
+    tf = coo_matrix((probs[keep].astype(float), (rows, cols)), shape=shape).tocsr()
+    rf = coo_matrix((rewards[keep].astype(float), (rows, cols)), shape=shape).tocsr()
+    tf.sort_indices()
+    rf.sort_indices()
+    return tf, rf
 
 class SparseTabularMDP(TabularMarkovDecisionProcess):
     """
-    Uses sparse matrices for transition and reward functions
+    Uses sparse matrices for transition and reward functions.
+
+    Both matrices are assembled in a single pass from the
+    `(rows, cols, probs, rewards)` chunks yielded by
+    `transition_reward_chunks`, which subclasses can override
+    with a vectorized version.
     """
-    @cached_property
-    def transition_matrix(self) -> np.array:
-        ss = self.state_list
+    assembly_chunk_states = 1024
+
+    def transition_reward_chunks(self):
+        """
+        Yields `(rows, cols, probs, rewards)` arrays of transition matrix
+        entries, where rows are indexed by `si*n_actions + ai`. This
+        version iterates over states in Python and yields one chunk
+        per `assembly_chunk_states` states.
+        """
         ssi = self.state_index
-        aa = self.action_list
         aai = self.action_index
-        tf = dok_matrix((len(ss)*len(aa), len(ss)), dtype=float)
+        naa = len(self.action_list)
+        rows, cols, probs, rewards = [], [], [], []
         for s, si in ssi.items():
+            n_entries = len(rows)
             for a in self._cached_actions(s):
-                sai = si*len(aa) + aai[a]
+                sai = si*naa + aai[a]
                 for ns, nsp in self._cached_next_state_dist(s, a).items():
-                    if self.is_terminal(s):
-                        assert nsp == 0., "Terminal states have zero outgoing probabilities"
-                    tf[sai, ssi[ns]] = nsp
-        return csr_matrix(tf)
+                    if nsp == 0.:
+                        continue
+                    rows.append(sai)
+                    cols.append(ssi[ns])
+                    probs.append(nsp)
+                    rewards.append(self.reward(s, a, ns))
+            if self.is_terminal(s):
+                assert len(rows) == n_entries, "Terminal states have zero outgoing probabilities"
+            if (si + 1) % self.assembly_chunk_states == 0:
+                yield np.array(rows, dtype=int), np.array(cols, dtype=int), np.array(probs), np.array(rewards)
+                rows, cols, probs, rewards = [], [], [], []
+        if rows:
+            yield np.array(rows, dtype=int), np.array(cols, dtype=int), np.array(probs), np.array(rewards)
+
+    @cached_property
+    def _transition_reward_matrices(self):
+        return assemble_transition_reward_matrices(
+            self.transition_reward_chunks(),
+            len(self.state_list),
+            len(self.action_list)
+        )
+
+    @cached_property
+    def transition_matrix(self) -> np.array:
+        return self._transition_reward_matrices[0]
 
     @cached_property
     def reward_matrix(self):
-        ss = self.state_list
-        ssi = self.state_index
-        aa = self.action_list
-        aai = self.action_index
-        rf = dok_matrix((len(ss)*len(aa), len(ss)), dtype=float)
-        for s, si in ssi.items():
-            for a in self._cached_actions(s):
-                sai = si*len(aa) + aai[a]
-                for ns, p in self._cached_next_state_dist(s, a).items():
-                    if p == 0.:
-                        continue
-                    rf[sai, ssi[ns]] = self.reward(s, a, ns)
-        return csr_matrix(rf)
+        return self._transition_reward_matrices[1]
 
     @cached_property
     def state_action_reward_matrix(self):
         rf = self.reward_matrix
         tf = self.transition_matrix
-        return np.sum(rf.multiply(tf), -1).reshape(len(self.state_list), len(self.action_list))
\ No newline at end of file
+        return np.sum(rf.multiply(tf), -1).reshape(len(self.state_list), len(self.action_list))
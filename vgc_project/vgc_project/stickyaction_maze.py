@@ -1,6 +1,9 @@
 from collections import namedtuple
 from itertools import product
-from vgc_project.maze import Maze, Location
+import numpy as np
+import scipy.sparse as sparse
+from vgc_project.maze import Maze, SparseMaze, Location
+from vgc_project.sparse import SparseTabularMDP, assemble_transition_reward_matrices
 from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
 from msdm.core.utils.funcutils import cached_property
 from msdm.core.distributions import DictDistribution
@@ -8,12 +11,13 @@ from msdm.core.distributions import DictDistribution
 StickyActionState = namedtuple("StickyActionState", "last_dx_nonzero last_dy_nonzero x y")
 
 class StickyActionMaze(TabularMarkovDecisionProcess):
+    ground_maze_class = Maze
     def __init__(
         self,
         action_deviation_reward=-1,
         **kwargs
     ):
-        self.maze= Maze(**kwargs)
+        self.maze= self.ground_maze_class(**kwargs)
         self.action_deviation_reward = action_deviation_reward
         self.discount_rate = self.maze.discount_rate
     
@@ -65,4 +69,86 @@ class StickyActionMaze(TabularMarkovDecisionProcess):
 
     def is_terminal(self, s):
         return self.maze.is_terminal((s.x, s.y))
-    
\ No newline at end of file
+
+    def transition_reward_chunks(self):
+        """
+        Yields `(rows, cols, probs, rewards)` arrays of transition matrix
+        entries (see `SparseTabularMDP.transition_reward_chunks`), one chunk
+        per last-action indicator. Entries are the ground maze's, with
+        columns shifted into the block of the last-action indicator that
+        each action leads to.
+        """
+        last_dxdy_nonzero = [
+            (s.last_dx_nonzero, s.last_dy_nonzero)
+            for s in self.state_list[::len(self.maze.state_list)]
+        ]
+        nss, naa = len(self.maze.state_list), len(self.action_list)
+        # ground actions can be ordered differently from this mdp's actions
+        ground_action_list = self.maze.action_list
+        action_idx = np.array([self.action_index[a] for a in ground_action_list])
+        action_dxdy_nonzero = [(a.dx != 0, a.dy != 0) for a in ground_action_list]
+        next_last_idx = np.array([last_dxdy_nonzero.index(d) for d in action_dxdy_nonzero])
+        deviation_reward = np.array([
+            [self.action_deviation_reward if d != ad else 0 for ad in action_dxdy_nonzero]
+            for d in last_dxdy_nonzero
+        ])
+
+        # ground entries, without the outgoing transitions of terminal states
+        ground_tf = sparse.coo_matrix(self.maze.transition_matrix.reshape(nss*naa, nss))
+        ground_rf = self.maze.reward_matrix.reshape(nss*naa, nss)
+        nonterminal = self.maze.nonterminal_state_vec.astype(bool)[ground_tf.row//naa]
+        ground_si_ai, ground_nsi = ground_tf.row[nonterminal], ground_tf.col[nonterminal]
+        ground_probs = ground_tf.data[nonterminal]
+        ground_rewards = np.asarray(ground_rf[ground_si_ai, ground_nsi]).reshape(-1)
+        ground_ai = ground_si_ai % naa
+        rows = (ground_si_ai//naa)*naa + action_idx[ground_ai]
+        cols = next_last_idx[ground_ai]*nss + ground_nsi
+        for k in range(len(last_dxdy_nonzero)):
+            yield (
+                k*nss*naa + rows,
+                cols,
+                ground_probs,
+                ground_rewards + deviation_reward[k][ground_ai]
+            )
+
+    @cached_property
+    def _transition_reward_matrices(self):
+        return assemble_transition_reward_matrices(
+            self.transition_reward_chunks(),
+            len(self.state_list),
+            len(self.action_list)
+        )
+
+    @cached_property
+    def transition_matrix(self):
+        nss, naa = len(self.state_list), len(self.action_list)
+        return self._transition_reward_matrices[0].toarray().reshape(nss, naa, nss)
+
+    @cached_property
+    def reward_matrix(self):
+        nss, naa = len(self.state_list), len(self.action_list)
+        return self._transition_reward_matrices[1].toarray().reshape(nss, naa, nss)
+
+class SparseStickyActionMaze(StickyActionMaze, SparseTabularMDP):
+    """
+    StickyActionMaze on top of a `SparseMaze`, with `(S*A, S)` CSR
+    transition and reward matrices.
+    """
+    ground_maze_class = SparseMaze
+
+    @cached_property
+    def action_list(self):
+        return self.maze.action_list
+
+    @cached_property
+    def nonterminal_state_vec(self):
+        return np.tile(self.maze.nonterminal_state_vec, 3)
+
+    @cached_property
+    def transition_matrix(self):
+        return self._transition_reward_matrices[0]
+
+    @cached_property
+    def reward_matrix(self):
+        return self._transition_reward_matrices[1]
+
@@ -0,0 +1,14 @@
+import pytest
+from vgc_project import artifact_store
+
+@pytest.fixture(autouse=True, scope="session")
+def isolated_artifact_store(tmp_path_factory):
+    """Keeps artifacts persisted during the tests out of the working directory"""
+    location = tmp_path_factory.mktemp("artifact_store")
+    default_store = artifact_store._default_store
+    with pytest.MonkeyPatch.context() as mp:
+        # worker processes configure their own default store from the environment
+        mp.setenv("VGC_CACHE_DIR", str(location))
+        artifact_store.configure_artifact_store(location)
+        yield location
+    artifact_store._default_store = default_store
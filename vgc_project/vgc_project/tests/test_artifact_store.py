@@ -0,0 +1,43 @@
+import numpy as np
+from types import SimpleNamespace
+from frozendict import frozendict
+from vgc_project.artifact_store import ArtifactStore, stable_hash, cache_artifact
+
+def test_stable_hash():
+    assert stable_hash({'a': 1, 'b': (1., 2)}) == stable_hash(frozendict(b=(1., 2), a=1))
+    assert stable_hash({'a': 1}) != stable_hash({'a': 1.})
+    assert stable_hash(np.arange(10)) == stable_hash(np.arange(10))
+    assert stable_hash(np.arange(10)) != stable_hash(np.arange(10.))
+
+def test_artifact_store_roundtrip_and_eviction(tmp_path):
+    store = ArtifactStore(tmp_path, max_bytes=int(1e6))
+    value = SimpleNamespace(qvalues=np.random.random((100, 5)), converged=True)
+    store.put("test", stable_hash("a"), value)
+    found, loaded = store.get("test", stable_hash("a"))
+    assert found
+    assert isinstance(loaded.qvalues, np.memmap)
+    assert np.all(loaded.qvalues == value.qvalues) and loaded.converged
+    assert store.get("test", stable_hash("b")) == (False, None)
+
+    # entries are evicted in least recently used order
+    store.put("test", stable_hash("b"), np.zeros(1000))
+    store.get("test", stable_hash("a"))
+    store.evict(max_bytes=store.size() - 1)
+    assert store.get("test", stable_hash("a"))[0]
+    assert not store.get("test", stable_hash("b"))[0]
+    store.clear()
+    assert store.size() == 0
+
+def test_cache_artifact(tmp_path):
+    store = ArtifactStore(tmp_path)
+    calls = []
+    @cache_artifact(store=store)
+    def f(x, scale=2):
+        calls.append(x)
+        return np.arange(1000)*x*scale
+    assert np.all(f(3) == np.arange(1000)*6)
+    assert np.all(f(x=3, scale=2) == np.arange(1000)*6)
+    assert calls == [3]
+    f(3, scale=3)
+    assert calls == [3, 3]
+    assert store.stats['hits'] == 1 and store.stats['writes'] == 2
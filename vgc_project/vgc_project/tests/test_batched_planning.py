@@ -0,0 +1,73 @@
+import numpy as np
+from msdm.algorithms import PolicyIteration
+
+from vgc_project.vgc import value_guided_construal, ConstruedMaze
+from vgc_project.batched_planning import batched_policy_iteration, batched_value_iteration
+
+tile_array = (
+    '.2..G',
+    '.##.3',
+    'S.1..',
+    '..1..',
+    '0....',
+)
+true_maze_params = dict(
+    tile_array=tile_array,
+    feature_rewards=(("G", 0), ),
+    absorbing_features=("G",),
+    wall_features="#0123456789",
+    default_features=(".",),
+    initial_features=("S",),
+    step_cost=-1,
+    discount_rate=1.0-1e-5,
+    success_prob=1-1e-5,
+)
+
+def test_batched_solvers_match_policy_iteration():
+    construals = ("", "1", "13", "0123")
+    mazes = [ConstruedMaze(true_maze_params, c) for c in construals]
+    nt = mazes[0].nonterminal_state_vec
+    tfs = np.stack([m.transition_matrix for m in mazes])*nt[None, :, None, None]
+    sa_rfs = np.stack([m.state_action_reward_matrix for m in mazes])
+    s0 = mazes[0].initial_state_vec
+    pi_res = batched_policy_iteration(tfs, sa_rfs, mazes[0].discount_rate, initial_state_vec=s0)
+    vi_res = batched_value_iteration(tfs, sa_rfs, mazes[0].discount_rate, initial_state_vec=s0)
+    assert pi_res.converged.all() and vi_res.converged.all()
+    for ci, m in enumerate(mazes):
+        res = PolicyIteration().plan_on(m)
+        assert np.isclose(pi_res.initial_values[ci], res.initial_value)
+        assert np.isclose(vi_res.initial_values[ci], res.initial_value)
+        # msdm's PolicyIteration only solves for values of reachable states
+        rs = nt & m.reachable_state_vec.astype(bool)
+        assert np.isclose(pi_res.state_value_vecs[ci][rs], res._valuevec[rs]).all()
+
+def test_batched_vgc_matches_vgc():
+    vgc_res = value_guided_construal(
+        tile_array=tile_array,
+        construal_inverse_temp=10,
+    )
+    batched_vgc_res = value_guided_construal(
+        tile_array=tile_array,
+        construal_inverse_temp=10,
+        planning_alg="batched_policy_iteration"
+    )
+    for c, v in vgc_res['value_of_representation'].items():
+        assert np.isclose(v, batched_vgc_res['value_of_representation'][c])
+
+def test_batched_policy_evaluation_matches_evaluate_on():
+    vgc_res = value_guided_construal(
+        tile_array=tile_array,
+        construal_inverse_temp=10,
+    )
+    for planning_alg in ["policy_iteration", "batched_policy_iteration"]:
+        batched_eval_res = value_guided_construal(
+            tile_array=tile_array,
+            construal_inverse_temp=10,
+            planning_alg=planning_alg,
+            policy_evaluation="batched"
+        )
+        assert batched_eval_res['construals'] == vgc_res['construals']
+        assert np.isclose(
+            batched_eval_res['construal_utilities'],
+            vgc_res['construal_utilities']
+        ).all()
@@ -0,0 +1,56 @@
+import numpy as np
+from vgc_project.vgc import value_guided_construal, ConstruedMaze
+from vgc_project.construal_lattice import plan_construal_lattice, construal_lattice_parents
+from vgc_project.utils import powerset
+
+tile_array = (
+    '.2..G',
+    '.##.3',
+    'S.1..',
+    '..1..',
+    '0....',
+)
+
+def test_construal_lattice_parents():
+    construals = [''.join(c) for c in powerset('0123')]
+    parents = construal_lattice_parents(construals)
+    assert parents[''] is None
+    solved = set()
+    for c, parent in parents.items():
+        if parent is not None:
+            assert parent in solved
+            assert len(set(c) - set(parent)) == 1 and set(parent) < set(c)
+        solved.add(c)
+
+def test_lattice_policy_iteration_matches_policy_iteration():
+    vgc_res = value_guided_construal(
+        tile_array=tile_array,
+        construal_inverse_temp=10,
+    )
+    lattice_vgc_res = value_guided_construal(
+        tile_array=tile_array,
+        construal_inverse_temp=10,
+        planning_alg="lattice_policy_iteration"
+    )
+    for c, v in vgc_res['value_of_representation'].items():
+        assert np.isclose(v, lattice_vgc_res['value_of_representation'][c])
+    for o, p in vgc_res['obstacle_probs'].items():
+        assert np.isclose(p, lattice_vgc_res['obstacle_probs'][o])
+
+    true_maze_params = dict(
+        tile_array=tile_array,
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=1.0-1e-5,
+        success_prob=1-1e-5,
+    )
+    lattice = plan_construal_lattice(
+        [''.join(c) for c in powerset('0123')],
+        make_mdp=lambda c: ConstruedMaze(true_maze_params, c),
+        compare_to_cold_start=True
+    )
+    assert lattice.stats['iterations_saved'] > 0
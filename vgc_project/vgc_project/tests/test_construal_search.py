@@ -10,7 +10,7 @@ import matplotlib.pyplot as plt
 
 from vgc_project.construal_search import \
     ConstrualSearch, ExhaustiveSearch, BreadthFirstSearch, DepthFirstSearch, \
-    EventListener, BoundedDepthFirstSearch
+    EventListener, BoundedDepthFirstSearch, BranchAndBoundSearch
 
 def test_construal_search():
     mazes = {
@@ -76,4 +76,37 @@ def test_construal_search():
         with_threshold['ExhaustiveSearch'] > \
         with_threshold['BreadthFirstSearch'] > \
         with_threshold['BDFS3'] > \
-        with_threshold['DepthFirstSearch']
\ No newline at end of file
+        with_threshold['DepthFirstSearch']
+
+def test_branch_and_bound_search_matches_exhaustive_search():
+    gw_params = dict(
+        tile_array=(
+            '...3.0....G',
+            '.333.0.....',
+            '.....00.444',
+            '6....#..4..',
+            '6....#.....',
+            '6..#####...',
+            '6....#.....',
+            '..1..#.2...',
+            '111..222...',
+            '..........5',
+            'S.......555'
+        ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=.99
+    )
+    search_params = dict(gw_params=gw_params, max_iterations=1000, construal_value_threshold=0)
+    exhaustive_res = ExhaustiveSearch(**search_params).search()
+    bnb_res = BranchAndBoundSearch(**search_params).search()
+    assert bnb_res.max_construals == exhaustive_res.max_construals
+    assert bnb_res.max_value == exhaustive_res.max_value
+    assert bnb_res.skipped_solves > bnb_res.bound_solves == 1
+    assert len(bnb_res.construal_values) + bnb_res.skipped_solves == len(exhaustive_res.construal_values)
+    for c, v in bnb_res.construal_values.items():
+        assert v == exhaustive_res.construal_values[c]
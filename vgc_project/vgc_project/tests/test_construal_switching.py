@@ -3,7 +3,8 @@ import numpy as np
 from msdm.algorithms import PolicyIteration, ValueIteration
 
 from vgc_project.sparse import SparsePolicyIteration
-from vgc_project.dynamic_vgc import ConstrualSwitchingMDP
+from vgc_project.dynamic_vgc import ConstrualSwitchingMDP, FactoredSwitchingPolicyIteration, \
+    ground_policy_matrix
 from vgc_project.stickyaction_maze import StickyActionMaze
 from vgc_project.maze import Maze
 
@@ -88,4 +89,101 @@ def test_construal_switching_mdp_with_stickyactions():
     # We expect the switching mdp cost to be the ground cost minus the cost of the construal
     assert np.isclose(cs_mdp_res.initial_value, maze_res.initial_value - len("0123"))
 
-    cs_mdp._compare_to_base_implementations()
\ No newline at end of file
+    cs_mdp._compare_to_base_implementations()
+
+def test_construal_switching_transition_operator():
+    ground_mdp_params = dict(
+        tile_array=(
+            '.2..G',
+            '.##.3',
+            'S.1..',
+            '..1..',
+            '0....',
+        ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=1.0-1e-5,
+        success_prob=.8
+    )
+    cs_mdp_params = dict(
+        construals=("", "0", "13", "0123"), 
+        initial_construal="",
+        eval_ground_mdp_params=ground_mdp_params,
+        policy_ground_mdp_params=ground_mdp_params,
+        ground_policy_inv_temp=2,
+        ground_policy_rand_choose=.1,
+        added_obs_cost=1,
+        removed_obs_cost=.5,
+        continuing_obs_cost=.1,
+        construal_switch_cost=.2,
+        discount_rate=.99,
+    )
+    cs_mdp = ConstrualSwitchingMDP(**cs_mdp_params)
+    tf_op = cs_mdp.transition_operator
+    tf = cs_mdp.transition_matrix
+    assert tf_op.shape == tf.shape
+    assert tf_op.nnz == tf.nnz
+    assert (tf_op.tocsr() != tf).nnz == 0
+    v = np.random.random(tf.shape[1])
+    assert np.allclose(tf_op@v, tf@v)
+    rows = np.arange(0, tf.shape[0], 7)
+    assert (tf_op[rows, :] != tf[rows, :]).nnz == 0
+
+    initial_policy = np.zeros(len(cs_mdp.state_list), dtype=int)
+    res = SparsePolicyIteration(initial_policy=initial_policy).plan_on(cs_mdp)
+    matrix_free_res = SparsePolicyIteration(
+        initial_policy=initial_policy,
+        matrix_free=True
+    ).plan_on(ConstrualSwitchingMDP(**cs_mdp_params))
+    assert np.allclose(res._qvaluemat, matrix_free_res._qvaluemat)
+
+    factored_res = FactoredSwitchingPolicyIteration(
+        initial_policy=initial_policy
+    ).plan_on(ConstrualSwitchingMDP(**cs_mdp_params))
+    assert np.allclose(res._qvaluemat, factored_res._qvaluemat)
+    assert np.isclose(res.initial_value, factored_res.initial_value)
+
+def test_ground_policy_bank_is_shared():
+    ground_mdp_params = dict(
+        tile_array=(
+            '.2..G',
+            '.##.3',
+            'S.1..',
+            '..1..',
+            '0....',
+        ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=1.0-1e-5,
+        success_prob=1-1e-5
+    )
+    cs_mdp_params = dict(
+        construals=("", "0123", "013"), 
+        initial_construal="",
+        eval_ground_mdp_params=ground_mdp_params,
+        policy_ground_mdp_params=ground_mdp_params,
+        ground_policy_inv_temp=3,
+        ground_policy_rand_choose=.1,
+        added_obs_cost=1,
+        removed_obs_cost=0,
+        continuing_obs_cost=0,
+        construal_switch_cost=0,
+        discount_rate=1-1e-5,
+    )
+    no_cost_cs_mdp = ConstrualSwitchingMDP(**{**cs_mdp_params, 'added_obs_cost': 0})
+    cs_mdp = ConstrualSwitchingMDP(**cs_mdp_params)
+    cs_mdp.ground_policy_matrix
+    banked = ground_policy_matrix(ground_mdp_params, "013", 3, .1)
+    assert banked.dtype == np.float32
+    assert banked is ground_policy_matrix(ground_mdp_params, "013", 3, .1)
+    assert np.allclose(cs_mdp.ground_policy_matrix[2], banked)
+    assert np.allclose(cs_mdp.ground_policy_matrix.sum(-1), 1)
+    assert np.allclose(cs_mdp.ground_policy_matrix, no_cost_cs_mdp.ground_policy_matrix)
@@ -58,3 +58,84 @@ def test_dynamic_vgc_with_sticky_action_cost():
         res.no_aux_cost_ground_initial_value,
         res.no_aux_cost_switch_mdp_initial_value
     )
+
+def test_sample_csr_rows():
+    from scipy.sparse import csr_matrix
+    from vgc_project.dynamic_vgc.dynamic_vgc import cumulative_csr_rows, sample_csr_rows
+    # includes an explicitly stored zero in the first row
+    probs = csr_matrix((
+        np.array([.2, 0, .5, .3, 1., .5, .5]),
+        np.array([0, 1, 2, 4, 3, 1, 4]),
+        np.array([0, 4, 5, 7])
+    ), shape=(3, 5))
+    cum_probs = cumulative_csr_rows(probs)
+    np.random.seed(1234)
+    n_samples = 20000
+    for row in range(probs.shape[0]):
+        samples = sample_csr_rows(
+            cum_probs,
+            np.full(n_samples, row),
+            np.random.random_sample(n_samples)
+        )
+        freqs = np.bincount(samples, minlength=probs.shape[1])/n_samples
+        assert np.isclose(freqs, probs[row].toarray()[0], atol=.02).all()
+        assert freqs[probs[row].toarray()[0] == 0].sum() == 0
+
+def test_dynamic_vgc_exact_evaluation():
+    res = dynamic_vgc(**{
+        **default_dynamic_vgc_params,
+        "evaluation": "exact",
+        "seed": None
+    })
+    res = SimpleNamespace(**res)
+    expected_steps = 12
+    assert np.isclose(sum(res.loc_occ.values()), expected_steps, atol=1e-3)
+    assert np.isclose(res.loc_occ[(0, 1)], 1, atol=1e-3)
+    assert np.isclose(res.obs_occ.get('3', 0.0), 0)
+    assert np.isclose(res.initial_value, -expected_steps - len("012"), atol=1e-3)
+    assert res.initial_value_sem == 0
+
+def test_exact_evaluation_of_policy_that_never_terminates():
+    import pytest
+    from vgc_project.maze import SparseMaze
+    from vgc_project.gridmdp import GridAction
+    from vgc_project.dynamic_vgc.dynamic_vgc import evaluate_sparse_policy_matrix_exact
+    maze = SparseMaze(
+        tile_array=('S..G', ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=.99,
+        success_prob=1-1e-5
+    )
+    # always moving left from the left edge stays in the initial state forever
+    policy_mat = np.zeros((len(maze.state_list), len(maze.action_list)))
+    policy_mat[:, maze.action_list.index(GridAction(-1, 0))] = 1
+    with pytest.raises(ValueError):
+        evaluate_sparse_policy_matrix_exact(policy_mat, maze)
+
+def test_dynamic_vgc_sweep():
+    from vgc_project.dynamic_vgc.dynamic_vgc import dynamic_vgc_sweep
+    param_sets = [
+        {
+            **default_dynamic_vgc_params,
+            'ground_policy_inv_temp': ground_policy_inv_temp,
+            'switching_inv_temp': switching_inv_temp,
+            'switching_rand_choose': switching_rand_choose,
+            'n_simulations': 100
+        }
+        for ground_policy_inv_temp in [None, 5]
+        for switching_inv_temp in [1, 100]
+        for switching_rand_choose in [0, .1]
+    ]
+    sweep = dynamic_vgc_sweep(param_sets)
+    assert sweep.stats['switching_mdp_solves'] == 2
+    assert sweep.stats['switching_policies'] == len(param_sets)
+    assert sweep.stats['evaluations'] == len(param_sets)
+    for params, res in zip(param_sets, sweep.results):
+        dvgc_res = dynamic_vgc(**params)
+        assert dvgc_res['initial_value'] == res['initial_value']
+        assert dvgc_res['obs_occ'] == res['obs_occ']
@@ -1,6 +1,9 @@
 import numpy as np
 from itertools import product
-from vgc_project.maze import Maze
+from vgc_project.maze import Maze, SparseMaze, Location
+from vgc_project.stickyaction_maze import StickyActionMaze, SparseStickyActionMaze
+from vgc_project.sparse import SparsePolicyIteration
+from msdm.algorithms import PolicyIteration
 
 def test_basic_maze_properties():
     pw=.94
@@ -70,4 +73,158 @@ def test_basic_maze_properties():
     assert not m.nonterminal_state_vec[ss.index((1, 1))]
     assert m.nonterminal_state_vec.sum() == 5
     assert (tf[ss.index((1, 1)), :, ss.index((1, 1))] == 1).all()
-    assert (sa_rf[ss.index((1, 1))] == 0).all()
\ No newline at end of file
+    assert (sa_rf[ss.index((1, 1))] == 0).all()
+
+def loop_transition_reward_matrices(
+    maze,
+    move_prob,
+    wall_block_prob,
+    step_cost,
+    wall_bump_cost,
+    include_action_effect,
+    include_wall_effect,
+    include_terminal_state_effect
+):
+    """
+    Reference implementation that builds a maze's transition and reward
+    matrices one state-action at a time.
+    """
+    ss = maze._state_list
+    aa = maze._action_list
+    sidx = maze._state_index
+    center = np.array([(maze._width - 1)/2, (maze._height - 1)/2])
+    max_center_dist = center.sum()
+
+    # default transition potential
+    tf_logits = np.ones((len(ss), len(aa), len(ss)))
+    tf_logits = np.log(tf_logits/tf_logits.sum(-1, keepdims=True))
+    rf = np.zeros((len(ss), len(aa), len(ss)))
+
+    for (si, s), (ai, a) in product(enumerate(ss), enumerate(aa)):
+        ns = Location(s.x + a.dx, s.y + a.dy)
+        if not maze.on_board(ns):
+            ns = s
+        nsi = sidx[ns]
+        if include_action_effect:
+            tf_logits[si, ai, :] = -float('inf')
+            tf_logits[si, ai, si] = np.log(1 - move_prob)
+            tf_logits[si, ai, nsi] = np.log(move_prob)
+            rf[si, ai, si] += step_cost
+            if si != nsi:
+                rf[si, ai, nsi] += step_cost
+
+        if include_wall_effect and not maze.is_wall(s) and maze.is_wall(ns):
+            tf_logits[si, ai, si] += np.log(wall_block_prob)
+            tf_logits[si, ai, nsi] += np.log(1 - wall_block_prob)
+            rf[si, ai, si] += wall_bump_cost
+
+        if maze.wall_bias > 0.:
+            wall_bias_reward = np.abs(center - s).sum() - max_center_dist
+            rf[si, ai, si] += wall_bias_reward*maze.wall_bias
+            rf[si, ai, nsi] += wall_bias_reward*maze.wall_bias
+
+    nt = maze.nonterminal_state_vec.astype(bool)
+    if include_terminal_state_effect:
+        tf_logits[~nt,:,:] = -float('inf')
+        tf_logits[~nt,:,~nt] = np.log(1/(~nt).sum())
+        rf[~nt,:,:] = 0
+
+    tf = np.exp(tf_logits)
+    tf[nt,:,:] = tf[nt,:,:]/tf[nt,:,:].sum(-1, keepdims=True)
+    return tf, rf
+
+def test_vectorized_matrices_match_loop():
+    maze_params = dict(
+        tile_array=(
+            '...3.0....G',
+            '.333.0.....',
+            '.....00.444',
+            '6....#..4..',
+            '6....#.....',
+            '6..#####...',
+            '6....#.....',
+            '..1..#.2...',
+            '111..222...',
+            '..........5',
+            'S.......555'
+        ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        wall_bump_cost=-.5,
+        wall_block_prob=.9,
+        success_prob=1-1e-5,
+        discount_rate=1.0-1e-5,
+        wall_bias=.1
+    )
+    for include_action_effect, include_wall_effect, include_terminal_state_effect in \
+            product([True, False], repeat=3):
+        m = Maze(
+            **maze_params,
+            include_action_effect=include_action_effect,
+            include_wall_effect=include_wall_effect,
+            include_terminal_state_effect=include_terminal_state_effect
+        )
+        loop_tf, loop_rf = loop_transition_reward_matrices(
+            m,
+            move_prob=maze_params['success_prob'],
+            wall_block_prob=maze_params['wall_block_prob'],
+            step_cost=maze_params['step_cost'],
+            wall_bump_cost=maze_params['wall_bump_cost'],
+            include_action_effect=include_action_effect,
+            include_wall_effect=include_wall_effect,
+            include_terminal_state_effect=include_terminal_state_effect
+        )
+        assert (loop_tf == m.transition_matrix).all()
+        assert (loop_rf == m.reward_matrix).all()
+
+def test_sparse_maze_matches_dense():
+    maze_params = dict(
+        tile_array=(
+            '.2..G',
+            '.##.3',
+            'S.1..',
+            '..1..',
+            '0....',
+        ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        wall_bump_cost=-.5,
+        discount_rate=1.0-1e-5,
+        success_prob=1-1e-5,
+        wall_bias=.1
+    )
+    m = Maze(**maze_params)
+    sm = SparseMaze(**maze_params)
+    nss, naa = len(m.state_list), len(m.action_list)
+    nt = m.nonterminal_state_vec
+
+    # sparse mazes have no outgoing transitions from terminal states
+    tf = m.transition_matrix.copy()
+    tf[~nt] = 0
+    assert (sm.transition_matrix.toarray().reshape(nss, naa, nss) == tf).all()
+    assert (sm.reward_matrix.toarray().reshape(nss, naa, nss) == m.reward_matrix*(tf > 0)).all()
+    assert np.isclose(
+        SparsePolicyIteration().plan_on(sm).initial_value,
+        PolicyIteration().plan_on(m).initial_value
+    )
+
+    sticky_params = {**maze_params, 'action_deviation_reward': -.3}
+    sam = StickyActionMaze(**sticky_params)
+    ssam = SparseStickyActionMaze(**sticky_params)
+    nss = len(sam.state_list)
+    assert sam.state_list == ssam.state_list
+    # actions are matched by name since the two classes can order them differently
+    action_idx = [sam.action_index[a] for a in ssam.action_list]
+    assert np.isclose(ssam.transition_matrix.toarray().reshape(nss, naa, nss), sam.transition_matrix[:, action_idx]).all()
+    assert np.isclose(ssam.reward_matrix.toarray().reshape(nss, naa, nss), sam.reward_matrix[:, action_idx]).all()
+    assert np.isclose(
+        SparsePolicyIteration().plan_on(ssam).initial_value,
+        PolicyIteration().plan_on(sam).initial_value
+    )
@@ -0,0 +1,56 @@
+import numpy as np
+from vgc_project.memory_cache import MemoryCache, memory_cache, estimate_nbytes
+
+def test_estimate_nbytes():
+    a = np.zeros((100, 100))
+    assert estimate_nbytes(a) == a.nbytes
+    assert estimate_nbytes(a[10:]) == a.nbytes
+    assert estimate_nbytes([a, a[10:], a.reshape(-1)]) < 2*a.nbytes
+    # shared arrays are counted once
+    assert a.nbytes <= estimate_nbytes({'a': a, 'b': [a, a]}) < 2*a.nbytes
+
+def test_memory_cache_evicts_by_bytes():
+    cache = MemoryCache(max_bytes=int(2.5*8000))
+    calls = []
+    @memory_cache(cache=cache)
+    def f(i, size=1000):
+        calls.append(i)
+        return np.zeros(size)
+    f(0); f(1); f(0); f(2)
+    # 1 is the least recently used entry
+    assert f.cache_stats()['evictions'] == 1
+    f(0); f(2); f(1)
+    assert calls == [0, 1, 2, 1]
+    stats = f.cache_stats()
+    assert stats['hits'] == 3 and stats['misses'] == 4
+    assert stats['entries'] == 2 and cache.n_bytes <= cache.max_bytes
+
+    # entries larger than the budget are not stored
+    f(3, size=10000)
+    f(3, size=10000)
+    assert calls[-2:] == [3, 3]
+    f.cache_clear()
+    assert cache.n_bytes == 0
+
+def test_memory_cache_remeasures_entries_that_grow():
+    from msdm.core.utils.funcutils import cached_property
+    class Lazy:
+        @cached_property
+        def matrix(self):
+            return np.zeros(1000)
+
+    cache = MemoryCache(max_bytes=int(1.5*8000))
+    @memory_cache(cache=cache)
+    def f(i):
+        return Lazy()
+    f(0).matrix
+    f(1)
+    assert cache.n_bytes < 8000
+    # the first hit re-measures the entry, which now holds its matrix
+    f(0)
+    assert cache.n_bytes >= 8000
+    f(1).matrix
+    f(1)
+    # 0 is evicted once both entries have grown past the budget
+    assert f.cache_stats()['evictions'] == 1
+    assert f.cache_stats()['entries'] == 1 and cache.n_bytes <= cache.max_bytes
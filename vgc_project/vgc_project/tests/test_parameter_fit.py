@@ -0,0 +1,120 @@
+import numpy as np
+from itertools import combinations
+from vgc_project.soft_vgc import SoftValueGuidedConstrualModel, soft_value_guided_construal, construal_utilities
+import random
+from vgc_project.parameter_fit import Trial, group_trials_by_maze, maze_trials_nll, \
+    make_minimize_kwargs, synthetic_trials, gradient_parameters, fit_vgc_model_multistart
+
+def test_grouped_trials_nll_matches_per_trial_nll():
+    maze = ("S0.1", "2..G")
+    rng = np.random.default_rng(0)
+    construals = [frozenset(c) for n in range(4) for c in combinations("012", n)]
+    model = SoftValueGuidedConstrualModel(
+        vor={c: -10*rng.random() - len(c) for c in construals},
+        construal_inverse_temp=2.,
+        construal_rand_choose=.1,
+        obs_awareness_prior=.3
+    )
+    trials = [
+        Trial(maze, '2', 'real', .5),
+        Trial(maze, '0', 'binomial', (3, 5)),
+        Trial(maze, '1', 'real', -1.),
+        Trial(maze, '2', 'binomial', (0, 4)),
+    ]
+    per_trial_nll = sum([
+        model.nll_logodds(t.obstacle, t.value) if t.type == 'real' else \
+        model.nll_binomial(t.obstacle, *t.value)
+        for t in trials
+    ])
+    groups = group_trials_by_maze(trials)
+    assert len(groups) == 1
+    assert np.isclose(maze_trials_nll(model.obstacle_prob_vec, groups[0]), per_trial_nll)
+
+def test_soft_vgc_reuses_construal_utilities():
+    params = dict(
+        tile_array=('S0..1', '..2.G', '3....'),
+        construal_inverse_temp=1.,
+        construal_rand_choose=.1,
+        policy_inverse_temp=2.,
+        policy_rand_choose=.1,
+        construal_weight=1.,
+        discount_rate=.99
+    )
+    model = soft_value_guided_construal(**params)
+    misses = construal_utilities.cache_stats()['misses']
+    model2 = soft_value_guided_construal(**{
+        **params,
+        'construal_inverse_temp': 5.,
+        'construal_weight': 2.,
+        'obs_awareness_prior': .3
+    })
+    assert construal_utilities.cache_stats()['misses'] == misses
+    for c, v in model.vor.items():
+        assert np.isclose(model2.vor[c], v - len(c))
+
+def test_analytic_gradients_match_finite_differences():
+    vgc_parameters = dict(
+        construal_inverse_temp=1.5,
+        construal_rand_choose=.1,
+        policy_inverse_temp=2.,
+        policy_rand_choose=.1,
+        construal_weight=1.,
+        obs_awareness_prior=.4,
+        discount_rate=.99
+    )
+    trials = synthetic_trials(
+        vgc_parameters=vgc_parameters,
+        mazes={'a': ('S0.....1', '..2.....', '3.......', '......0G')},
+        n_trials=2,
+        response_type='binomial',
+        binomial_total=5,
+        rng=random.Random(0)
+    )
+    minimize_kwargs = make_minimize_kwargs(
+        trials=trials,
+        default_vgc_parameters={**vgc_parameters, 'construal_inverse_temp': 1., 'policy_inverse_temp': 1.5},
+        parameters_to_fit=gradient_parameters,
+        jac=True
+    )
+    x = np.array(minimize_kwargs['x0'])
+    _, grad = minimize_kwargs['fun'](x)
+    for i in range(len(x)):
+        dx = np.zeros(len(x))
+        dx[i] = 1e-6
+        fd_grad = (minimize_kwargs['fun'](x + dx)[0] - minimize_kwargs['fun'](x - dx)[0])/2e-6
+        assert np.isclose(grad[i], fd_grad, rtol=1e-4)
+
+def test_multistart_fit(tmp_path):
+    vgc_parameters = dict(
+        construal_inverse_temp=1.5,
+        construal_rand_choose=.1,
+        policy_inverse_temp=2.,
+        policy_rand_choose=.1,
+        construal_weight=1.,
+        obs_awareness_prior=.4,
+        discount_rate=.99
+    )
+    trials = synthetic_trials(
+        vgc_parameters=vgc_parameters,
+        mazes={'a': ('S0.....1', '..2.....', '3.......', '......0G')},
+        n_trials=2,
+        response_type='real',
+        binomial_total=1,
+        rng=random.Random(0)
+    )
+    fit_kwargs = dict(
+        trials=trials,
+        default_vgc_parameters={**vgc_parameters, 'construal_inverse_temp': 1.},
+        parameters_to_fit=('construal_inverse_temp', 'obs_awareness_prior'),
+        n_starts=4,
+        seed=1,
+    )
+    serial_res = fit_vgc_model_multistart(**fit_kwargs, n_jobs=1)
+    assert len(serial_res['restarts']) == 4 and serial_res['n_cancelled'] == 0
+    assert serial_res['score'] == min(r['score'] for r in serial_res['restarts'])
+    parallel_res = fit_vgc_model_multistart(**fit_kwargs, n_jobs=2, cache_location=tmp_path)
+    assert [r['score'] for r in serial_res['restarts']] == [r['score'] for r in parallel_res['restarts']]
+
+    cancel_res = fit_vgc_model_multistart(**fit_kwargs, dominance_margin=0., min_evaluations=1)
+    assert cancel_res['n_cancelled'] > 0
+    assert np.isclose(cancel_res['score'], serial_res['score'], atol=1e-3)
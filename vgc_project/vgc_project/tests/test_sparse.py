@@ -1,6 +1,12 @@
 import numpy as np
 from vgc_project.sparse import \
-    SparsePolicyIteration, SparseValueIteration, SparseTabularMDP
+    SparsePolicyIteration, SparseValueIteration, SparseTabularMDP, \
+    assemble_transition_reward_matrices, PrioritizedValueIteration
+from vgc_project.maze import Maze
+from vgc_project.stickyaction_maze import StickyActionMaze, SparseStickyActionMaze
+from vgc_project.dynamic_vgc import ConstrualSwitchingMDP
+from vgc_project.dynamic_vgc.switching_mdp import ConstrualSwitchingMDPBase
+from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
 from msdm.core.distributions import DictDistribution
 from msdm.algorithms import PolicyIteration, ValueIteration
 from msdm.domains import GridWorld as OriginalGridWorld
@@ -55,4 +61,125 @@ def test_sparse_nonsparse_solvers():
     spvi_res = SparseValueIteration(iterations=2000).plan_on(gw_sp)
     vi_res = ValueIteration(iterations=2000).plan_on(gw)
     assert np.isclose(spvi_res.initial_value, vi_res.initial_value)
-    assert np.isclose(spvi_res._valuevec*re, vi_res._valuevec*re).all()
\ No newline at end of file
+    assert np.isclose(spvi_res._valuevec*re, vi_res._valuevec*re).all()
+
+def test_sparse_result_views_are_lazy():
+    gw_sp = SparseGridWorld(**gw_params)
+    res = SparsePolicyIteration(iterations=200).plan_on(gw_sp)
+    lazy_attributes = {'policy', 'state_value_dict', 'actionvaluefunc', 'initial_value'}
+    assert not {'_cached_'+name for name in lazy_attributes} & set(vars(res))
+    s0 = gw_sp.initial_state_dist().support[0]
+    si = gw_sp.state_index[s0]
+    assert res.initial_value == res.V[s0] == res.state_value_vec[si]
+    assert res.Q[s0] == dict(zip(gw_sp.action_list, res.state_action_value_matrix[si]))
+    assert res.pi.action_dist(s0).prob(gw_sp.action_list[res._qvaluemat[si].argmax()]) > 0
+    assert res.V is res.valuefunc is res.state_value_dict
+    assert {'_cached_'+name for name in lazy_attributes} <= set(vars(res))
+
+def test_policy_evaluation_methods():
+    gw_sp = SparseGridWorld(**gw_params)
+    initial_policy = np.zeros(len(gw_sp.state_list), dtype=int)
+    direct_res = SparsePolicyIteration(initial_policy=initial_policy).plan_on(gw_sp)
+    for evaluation in ["splu", "gmres", "bicgstab", "modified"]:
+        res = SparsePolicyIteration(
+            initial_policy=initial_policy,
+            evaluation=evaluation,
+            evaluation_sweeps=50
+        ).plan_on(gw_sp)
+        assert res.converged
+        assert np.isclose(res.state_value_vec, direct_res.state_value_vec, atol=1e-6).all()
+        assert len(res.iteration_stats) == res.iterations + 1
+        assert res.iteration_stats[-1]['policy_changes'] == 0
+        assert res.iteration_stats[-1]['residual'] < 1e-6
+
+def test_value_iteration_sweep_orders():
+    gw_sp = SparseGridWorld(**gw_params)
+    re = gw_sp.reachable_state_vec
+    pi_res = SparsePolicyIteration(iterations=200).plan_on(gw_sp)
+    for sweep_order in ["jacobi", "gauss_seidel", "prioritized"]:
+        res = SparseValueIteration(sweep_order=sweep_order, block_size=10).plan_on(gw_sp)
+        assert res.converged and res.max_bellman_error < 1e-6
+        assert np.isclose(res._valuevec*re, pi_res._valuevec*re, atol=1e-5).all()
+
+def test_prioritized_value_iteration():
+    maze = Maze(
+        tile_array=(
+            'S.......',
+            '..000.1.',
+            '..0.0.1.',
+            '..000..G',
+        ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=1.0-1e-5,
+        success_prob=1-1e-5,
+        wall_bias=.1
+    )
+    pi_res = PolicyIteration().plan_on(maze)
+    # the walled-in state cannot reach the goal
+    re = (maze.reachable_state_vec*maze.nonterminal_state_vec).astype(bool)
+    for order in ["priority", "topological"]:
+        res = PrioritizedValueIteration(order=order).plan_on(maze)
+        assert res.converged and res.max_bellman_error < 1e-8
+        assert np.isclose(res.initial_value, pi_res.initial_value)
+        assert np.isclose(res._qvaluemat[re], pi_res._qvaluemat[re]).all()
+        assert res.n_backups <= 3*len(maze.state_list)
+
+def test_bulk_transition_reward_assembly():
+    # per-entry loops of the dense msdm implementation
+    msdm_tf = TabularMarkovDecisionProcess.transition_matrix.fget.__wrapped__
+    msdm_rf = TabularMarkovDecisionProcess.reward_matrix.fget.__wrapped__
+    ground_mdp_params = dict(
+        tile_array=(
+            'S..2',
+            '.1#.',
+            '0..G',
+        ),
+        feature_rewards=(("G", 0), ),
+        absorbing_features=("G",),
+        wall_features="#0123456789",
+        default_features=(".",),
+        initial_features=("S",),
+        step_cost=-1,
+        discount_rate=1.0-1e-5,
+        success_prob=.9
+    )
+    sticky_params = {**ground_mdp_params, 'action_deviation_reward': -.3}
+    cs_mdp_params = dict(
+        construals=("", "01", "2"),
+        initial_construal="",
+        eval_ground_mdp_params=ground_mdp_params,
+        policy_ground_mdp_params=ground_mdp_params,
+        ground_policy_inv_temp=1.,
+        ground_policy_rand_choose=.1,
+        added_obs_cost=1,
+        removed_obs_cost=.5,
+        continuing_obs_cost=.1,
+        construal_switch_cost=.2,
+        discount_rate=1-1e-5,
+    )
+    for mdp in [
+        StickyActionMaze(**sticky_params),
+        ConstrualSwitchingMDPBase(**cs_mdp_params),
+    ]:
+        assert np.isclose(mdp.transition_matrix, msdm_tf(mdp)).all()
+        assert np.isclose(mdp.reward_matrix, msdm_rf(mdp)).all()
+
+    # vectorized chunks match the generic per-state chunks
+    for mdp in [
+        SparseStickyActionMaze(**sticky_params),
+        ConstrualSwitchingMDP(**cs_mdp_params),
+    ]:
+        nss, naa = len(mdp.state_list), len(mdp.action_list)
+        tf, rf = mdp._transition_reward_matrices
+        mdp.assembly_chunk_states = 7
+        loop_tf, loop_rf = assemble_transition_reward_matrices(
+            SparseTabularMDP.transition_reward_chunks(mdp), nss, naa
+        )
+        assert np.isclose(tf.toarray(), loop_tf.toarray()).all()
+        assert np.isclose(rf.toarray(), loop_rf.toarray()).all()
+        assert (tf.indptr == loop_tf.indptr).all() and (tf.indices == loop_tf.indices).all()
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from vgc_project.vgc import TaskEffects, ConstruedMaze, value_guided_construal, \
+    generate_task_effects, create_construed_transition_matrix
+from vgc_project.utils import powerset
+
+true_maze_params = dict(
+    tile_array=(
+        '.2..G',
+        '.##.3',
+        'S.1..',
+        '..1..',
+        '0....',
+    ),
+    feature_rewards=(("G", 0), ),
+    absorbing_features=("G",),
+    wall_features="#0123456789",
+    default_features=(".",),
+    initial_features=("S",),
+    step_cost=-1,
+    discount_rate=1.0-1e-5,
+    wall_block_prob=.9,
+    success_prob=1-1e-5,
+)
+
+def test_task_effects_match_generate_task_effects():
+    task_effects = TaskEffects(true_maze_params)
+    dense_task_effects = generate_task_effects(true_maze_params)
+    for construal in powerset("0123"):
+        tf = task_effects.construed_transition_matrix(construal)
+        dense_tf = create_construed_transition_matrix(dense_task_effects, construal)
+        assert ((tf == 0) == (dense_tf == 0)).all()
+        assert np.isclose(tf, dense_tf, atol=1e-12).all()
+    assert np.isclose(
+        ConstruedMaze(true_maze_params, "13").transition_matrix,
+        create_construed_transition_matrix(dense_task_effects, "13")
+    ).all()
+
+def test_prioritized_planning_vgc_matches_vgc():
+    vgc_params = dict(
+        tile_array=true_maze_params['tile_array'],
+        construal_inverse_temp=10
+    )
+    res = value_guided_construal(**vgc_params)
+    for planning_alg in ["prioritized_value_iteration", "topological_value_iteration"]:
+        prioritized_res = value_guided_construal(**vgc_params, planning_alg=planning_alg)
+        assert np.isclose(res['construal_utilities'], prioritized_res['construal_utilities']).all()
+
+def test_parallel_vgc_matches_serial():
+    vgc_params = dict(
+        tile_array=true_maze_params['tile_array'],
+        construal_inverse_temp=10
+    )
+    serial_res = value_guided_construal(**vgc_params)
+    parallel_res = value_guided_construal(**vgc_params, n_jobs=2)
+    assert serial_res['construals'] == parallel_res['construals']
+    assert (serial_res['construal_utilities'] == parallel_res['construal_utilities']).all()
+    assert serial_res['obstacle_probs'] == parallel_res['obstacle_probs']
+    rerun_res = value_guided_construal(**vgc_params, n_jobs=3)
+    assert (parallel_res['construal_utilities'] == rerun_res['construal_utilities']).all()
+    # branch and bound evaluates each size level with the same worker pool
+    serial_bnb_res = value_guided_construal(**vgc_params, search="branch_and_bound")
+    parallel_bnb_res = value_guided_construal(**vgc_params, search="branch_and_bound", n_jobs=2)
+    assert serial_bnb_res['construals'] == parallel_bnb_res['construals']
+    assert (serial_bnb_res['construal_utilities'] == parallel_bnb_res['construal_utilities']).all()
+    with pytest.raises(ValueError):
+        value_guided_construal(**vgc_params, n_jobs=2, planning_alg="value_iteration")
+
+def test_branch_and_bound_vgc():
+    tile_array = (
+        '...3.0....G',
+        '.333.0.....',
+        '.....00.444',
+        '6....#..4..',
+        '6....#.....',
+        '6..#####...',
+        '6....#.....',
+        '..1..#.2...',
+        '111..222...',
+        '..........5',
+        'S.......555'
+    )
+    exhaustive_res = value_guided_construal(tile_array=tile_array, construal_inverse_temp=10)
+    for prob_tolerance in [None, 1e-3]:
+        bb_res = value_guided_construal(
+            tile_array=tile_array,
+            construal_inverse_temp=10,
+            search="branch_and_bound",
+            prob_tolerance=prob_tolerance
+        )
+        stats = bb_res['search_stats']
+        assert stats['skipped_solves'] > stats['bound_solves'] == 1
+        assert stats['skipped_solves'] + stats['construals_evaluated'] == 2**7
+        if prob_tolerance is not None:
+            assert stats['obstacle_probs_error'] <= prob_tolerance
+        for vgc_res in [exhaustive_res, bb_res]:
+            vor = vgc_res['value_of_representation']
+            vgc_res['best'] = {c for c, v in vor.items() if v == max(vor.values())}
+        assert exhaustive_res['best'] == bb_res['best']
+        for o, p in exhaustive_res['obstacle_probs'].items():
+            assert abs(p - bb_res['obstacle_probs'][o]) <= stats['obstacle_probs_error'] + 1e-12
@@ -5,31 +5,28 @@ Note: This uses a custom Maze MDP implementation rather than
 the GridWorld MDP implementation that comes with msdm
 in order to make it easier to calculate/combine effects.
 """
-from itertools import combinations
+import contextlib
+from itertools import combinations, groupby
+from concurrent.futures import ProcessPoolExecutor
 from types import SimpleNamespace
 import numpy as np
+import scipy.sparse as sparse
+from scipy.special import logsumexp
+from frozendict import frozendict
 from msdm.algorithms import PolicyIteration, ValueIteration
 from msdm.core.distributions import SoftmaxDistribution
+from msdm.core.problemclasses.mdp import TabularPolicy
 
 from vgc_project.utils import powerset
+from vgc_project.memory_cache import memory_cache
 from vgc_project.maze import Maze
+from vgc_project.construal_lattice import plan_construal_lattice
+from vgc_project.sparse import PrioritizedValueIteration
+from vgc_project.batched_planning import batched_policy_iteration, \
+    batched_policy_evaluation, greedy_policy_matrices
+from vgc_project.shared_arrays import shared_arrays, load_shared_arrays
 
-def generate_task_effects(true_maze_params):
-    obstacle_effects = {}
-    effect_chars = set(''.join(true_maze_params['tile_array'])) & set('0123456789')
-    for wall_char in effect_chars:
-        effect_maze = Maze(
-            **{
-                **true_maze_params,
-                **dict(
-                    wall_features=(wall_char,),
-                    include_action_effect=False,
-                    include_wall_effect=True,
-                    include_terminal_state_effect=False
-                )
-            }
-        )
-        obstacle_effects[wall_char] = effect_maze.transition_matrix
+def _base_task_effects(true_maze_params):
     action_effect = Maze(**{
         **true_maze_params,
         **dict(
@@ -57,6 +54,25 @@ def generate_task_effects(true_maze_params):
             include_terminal_state_effect=False
         )
     }).transition_matrix
+    return action_effect, goal_effect, center_wall_effect
+
+def generate_task_effects(true_maze_params):
+    obstacle_effects = {}
+    effect_chars = set(''.join(true_maze_params['tile_array'])) & set('0123456789')
+    for wall_char in effect_chars:
+        effect_maze = Maze(
+            **{
+                **true_maze_params,
+                **dict(
+                    wall_features=(wall_char,),
+                    include_action_effect=False,
+                    include_wall_effect=True,
+                    include_terminal_state_effect=False
+                )
+            }
+        )
+        obstacle_effects[wall_char] = effect_maze.transition_matrix
+    action_effect, goal_effect, center_wall_effect = _base_task_effects(true_maze_params)
     return SimpleNamespace(
         obstacle_effects=obstacle_effects,
         action_effect=action_effect,
@@ -64,6 +80,91 @@ def generate_task_effects(true_maze_params):
         center_wall_effect=center_wall_effect
     )
 
+class TaskEffects:
+    """
+    Log-space transition effects of a maze that are computed once and
+    then composed into the transition matrix of any construal.
+
+    An obstacle only changes the state-actions that bump into it, so its
+    log-effect is stored as a sparse `(S*A, S)` matrix that is zero except
+    for `log(wall_block_prob)` on staying and `log(1 - wall_block_prob)`
+    on moving into the obstacle. Terms that are constant within a row cancel
+    when rows are normalized, so a construal's transition matrix is the
+    obstacle-free matrix with only the bumped rows recomputed.
+    """
+    def __init__(self, true_maze_params):
+        action_effect, goal_effect, center_wall_effect = _base_task_effects(true_maze_params)
+        base_logits = np.zeros_like(center_wall_effect)
+        base_logits += np.log(center_wall_effect)
+        base_logits += np.log(action_effect)
+        base_logits += np.log(goal_effect)
+        base_tf = np.exp(base_logits)
+        base_tf /= base_tf.sum(-1, keepdims=True)
+        n_states, n_actions, _ = base_tf.shape
+        self.base_logits = base_logits.reshape(n_states*n_actions, n_states)
+        self.base_transition_matrix = base_tf
+
+        maze = Maze(**{
+            **true_maze_params,
+            **dict(
+                include_action_effect=False,
+                include_wall_effect=False,
+                include_terminal_state_effect=False
+            )
+        })
+        wall_block_prob = true_maze_params.get('wall_block_prob', 1.0)
+        si, ai, nsi = maze._state_action_next_state_indices()
+        obstacles = set(''.join(true_maze_params['tile_array'])) & set('0123456789')
+        self.obstacle_log_effects = {}
+        for o in sorted(obstacles):
+            bump = maze._wall_bump_mask(si, nsi, wall_features=(o,))
+            rows = si[bump]*n_actions + ai[bump]
+            n_bumps = len(rows)
+            self.obstacle_log_effects[o] = sparse.csr_matrix(
+                (
+                    np.concatenate([
+                        np.full(n_bumps, np.log(wall_block_prob)),
+                        np.full(n_bumps, np.log(1 - wall_block_prob))
+                    ]),
+                    (np.concatenate([rows, rows]), np.concatenate([si[bump], nsi[bump]]))
+                ),
+                shape=self.base_logits.shape
+            )
+
+    @classmethod
+    def from_arrays(cls, base_logits, base_transition_matrix, obstacle_log_effects):
+        """Rebuilds task effects from their arrays (e.g., in a worker process)"""
+        task_effects = cls.__new__(cls)
+        task_effects.base_logits = base_logits
+        task_effects.base_transition_matrix = base_transition_matrix
+        task_effects.obstacle_log_effects = obstacle_log_effects
+        return task_effects
+
+    def construed_log_effect(self, construal):
+        """Sparse sum of the log-effects of the obstacles in `construal`"""
+        log_effect = sparse.csr_matrix(self.base_logits.shape)
+        for obstacle in construal:
+            log_effect = log_effect + self.obstacle_log_effects[obstacle]
+        return log_effect
+
+    def construed_transition_matrix(self, construal):
+        log_effect = self.construed_log_effect(construal)
+        rows = np.unique(log_effect.nonzero()[0])
+        tf = self.base_transition_matrix.copy()
+        tf_flat = tf.reshape(self.base_logits.shape)
+        row_tf = np.exp(self.base_logits[rows] + log_effect[rows].toarray())
+        tf_flat[rows] = row_tf/row_tf.sum(-1, keepdims=True)
+        return tf
+
+@memory_cache
+def _get_task_effects(true_maze_params):
+    return TaskEffects(true_maze_params)
+def get_task_effects(true_maze_params):
+    """Returns the (cached) `TaskEffects` for a maze"""
+    if not isinstance(true_maze_params['tile_array'], tuple):
+        true_maze_params = {**true_maze_params, 'tile_array': tuple(true_maze_params['tile_array'])}
+    return _get_task_effects(frozendict(true_maze_params))
+
 def create_construed_transition_matrix(task_effects, construal):
     tf = np.zeros_like(task_effects.center_wall_effect)
     tf += np.log(task_effects.center_wall_effect)
@@ -76,15 +177,116 @@ def create_construed_transition_matrix(task_effects, construal):
     tf /= tf.sum(-1, keepdims=True)
     return tf
 
+def plan_construals_batched(true_maze, true_maze_params, construals):
+    """
+    Solves all construals of a maze with one call to
+    `batched_policy_iteration` on the stacked `(C, S, A, S)`
+    construed transition matrices.
+    """
+    task_effects = get_task_effects(true_maze_params)
+    nt = true_maze.nonterminal_state_vec.astype(bool)
+    tfs = np.stack([task_effects.construed_transition_matrix(c) for c in construals])
+    tfs = tfs*nt[None, :, None, None]
+    sa_rfs = np.einsum("csan,san->csa", tfs, true_maze.reward_matrix)
+    sa_rfs = sa_rfs + np.log(true_maze.action_matrix)
+    batch_res = batched_policy_iteration(
+        transition_matrices=tfs,
+        state_action_reward_matrices=sa_rfs,
+        discount_rate=true_maze.discount_rate,
+        initial_state_vec=true_maze.initial_state_vec
+    )
+    plan_results = {}
+    for ci, c in enumerate(construals):
+        plan_results[c] = SimpleNamespace(
+            _qvaluemat=batch_res.state_action_value_matrices[ci],
+            _valuevec=batch_res.state_value_vecs[ci],
+            policy=TabularPolicy.from_q_matrix(
+                true_maze.state_list,
+                true_maze.action_list,
+                batch_res.state_action_value_matrices[ci]
+            ),
+            initial_value=batch_res.initial_values[ci],
+            converged=batch_res.converged[ci],
+            iterations=batch_res.iterations[ci]
+        )
+    return plan_results
+
+def construal_policy_utility(true_maze, construed_maze):
+    """
+    Plans on a construed maze with policy iteration and returns the value
+    of the resulting policy in the true maze. This is the same computation
+    as the serial `policy_iteration`/`evaluate_on` path of `value_guided_construal`.
+    """
+    plan_res = PolicyIteration().plan_on(construed_maze)
+    assert plan_res.converged
+    return plan_res.policy.evaluate_on(true_maze).initial_value
+
+_SHARED_TASK_ARRAYS = (
+    "base_logits",
+    "base_transition_matrix"
+)
+_construal_worker = {}
+def _init_construal_worker(array_dir, obstacle_log_effects, true_maze_params):
+    arrays = load_shared_arrays(array_dir, _SHARED_TASK_ARRAYS)
+    _construal_worker.clear()
+    _construal_worker.update(
+        task_effects=TaskEffects.from_arrays(
+            arrays['base_logits'],
+            arrays['base_transition_matrix'],
+            obstacle_log_effects
+        ),
+        true_maze_params=true_maze_params,
+        true_maze=Maze(**true_maze_params)
+    )
+
+def _construal_utility_worker(construal):
+    w = _construal_worker
+    construed_maze = ConstruedMaze(w['true_maze_params'], construal, task_effects=w['task_effects'])
+    return construal_policy_utility(w['true_maze'], construed_maze)
+
+@contextlib.contextmanager
+def parallel_construal_evaluator(true_maze_params, n_jobs, shared_dir=None):
+    """
+    Starts a pool of `n_jobs` worker processes and yields a function that
+    maps a list of construals to the utilities of their policies in the
+    true maze (see `construal_policy_utility`). The base task tensors are
+    shared with workers as memory-mapped arrays, so only construals and
+    utilities are sent between processes. Results are returned in the order
+    of the construals and do not depend on scheduling.
+    """
+    true_maze_params = dict(true_maze_params)
+    task_effects = get_task_effects(true_maze_params)
+    arrays = dict(
+        base_logits=task_effects.base_logits,
+        base_transition_matrix=task_effects.base_transition_matrix
+    )
+    with shared_arrays(arrays, dir=shared_dir) as array_dir:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_construal_worker,
+            initargs=(array_dir, task_effects.obstacle_log_effects, true_maze_params)
+        ) as executor:
+            def evaluate_construals(construals):
+                chunksize = max(1, len(construals)//(4*n_jobs))
+                return np.array(list(executor.map(_construal_utility_worker, construals, chunksize=chunksize)))
+            yield evaluate_construals
+
+def evaluate_construals_parallel(true_maze_params, construals, n_jobs, shared_dir=None):
+    """Computes construal utilities with a one-off `parallel_construal_evaluator`"""
+    with parallel_construal_evaluator(true_maze_params, n_jobs, shared_dir=shared_dir) as evaluate_construals:
+        return evaluate_construals(construals)
+
 class ConstruedMaze(Maze):
     def __init__(
         self,
         true_maze_params,
-        construal
+        construal,
+        task_effects=None
     ):
         super().__init__(**true_maze_params)
-        task_effects = generate_task_effects(true_maze_params)
-        self._transition_matrix = create_construed_transition_matrix(task_effects, construal)
+        if task_effects is None:
+            task_effects = get_task_effects(true_maze_params)
+        self._transition_matrix = task_effects.construed_transition_matrix(construal)
         self.wall_features = "#"+str(sorted(construal))
         self.construal = construal
         
@@ -109,6 +311,113 @@ class ConstruedMaze(Maze):
             ax=ax
         )
     
+def _plan_and_evaluate_construals(
+    true_maze,
+    true_maze_params,
+    construals,
+    planning_alg,
+    policy_evaluation
+):
+    planning_stats = None
+    if planning_alg == "lattice_policy_iteration":
+        lattice = plan_construal_lattice(
+            construals,
+            make_mdp=lambda c: ConstruedMaze(true_maze_params, c)
+        )
+        plan_results = lattice.results
+        planning_stats = lattice.stats
+    elif planning_alg == "batched_policy_iteration":
+        plan_results = plan_construals_batched(true_maze, true_maze_params, construals)
+    else:
+        plan_results = {}
+        for construal in construals:
+            construed_maze = ConstruedMaze(true_maze_params, construal)
+            if planning_alg == "policy_iteration":
+                plan_results[construal] = PolicyIteration().plan_on(construed_maze)
+            elif planning_alg == "value_iteration":
+                plan_results[construal] = ValueIteration().plan_on(construed_maze)
+            elif planning_alg == "prioritized_value_iteration":
+                plan_results[construal] = PrioritizedValueIteration(order="priority").plan_on(construed_maze)
+            elif planning_alg == "topological_value_iteration":
+                plan_results[construal] = PrioritizedValueIteration(order="topological").plan_on(construed_maze)
+    assert all(plan_results[c].converged for c in construals)
+
+    # utility of each construal's policy in the true maze
+    if policy_evaluation == "batched":
+        policy_matrices = greedy_policy_matrices(
+            np.stack([plan_results[c]._qvaluemat for c in construals])
+        )
+        construal_utilities = batched_policy_evaluation(
+            policy_matrices=policy_matrices,
+            transition_matrix=true_maze.transition_matrix,
+            reward_matrix=true_maze.reward_matrix,
+            discount_rate=true_maze.discount_rate,
+            nonterminal_state_vec=true_maze.nonterminal_state_vec,
+            initial_state_vec=true_maze.initial_state_vec
+        )
+    else:
+        construal_utilities = np.array([
+            plan_results[c].policy.evaluate_on(true_maze).initial_value
+            for c in construals
+        ])
+    return construal_utilities, planning_stats
+
+def branch_and_bound_construals(
+    true_maze,
+    construals,
+    evaluate_construals,
+    construal_inverse_temp,
+    prob_tolerance=None,
+    bound_slack=1e-6
+):
+    """
+    Evaluates construals in order of increasing size and skips every
+    size level that cannot contain the maximum value of representation.
+
+    No construal's policy can do better in the true maze than the optimal
+    policy, so `U - len(c)` (with `U` the optimal value of the true maze)
+    bounds the value of representation of `c`. Once `U - k` is below the
+    best value found so far, construals with `k` or more obstacles are skipped.
+
+    The skipped construals have softmax weight of at most `B`, so
+    probabilities computed from the evaluated construals (with weight `Z`)
+    are off by at most `B/(Z + B)`. If `prob_tolerance` is given, levels
+    are only skipped once that error is below it.
+
+    The bound costs one extra solve of the true maze (`bound_solves`), so
+    `skipped_solves - bound_solves` solves are saved overall.
+    """
+    utility_bound = PolicyIteration().plan_on(true_maze).initial_value + bound_slack
+    levels = [list(level) for _, level in groupby(sorted(construals, key=len), key=len)]
+    level_sizes = np.array([len(level[0]) for level in levels])
+    level_counts = np.array([len(level) for level in levels])
+
+    evaluated, utilities = [], []
+    for li, level in enumerate(levels):
+        if evaluated:
+            vor = np.array(utilities) - np.array([len(c) for c in evaluated])
+            log_z = logsumexp(construal_inverse_temp*vor)
+            log_b = logsumexp(
+                construal_inverse_temp*(utility_bound - level_sizes[li:]),
+                b=level_counts[li:]
+            )
+            prob_error = np.exp(log_b - np.logaddexp(log_z, log_b))
+            argmax_pruned = utility_bound - level_sizes[li] < vor.max()
+            if argmax_pruned and (prob_tolerance is None or prob_error <= prob_tolerance):
+                break
+        evaluated.extend(level)
+        utilities.extend(evaluate_construals(level))
+    else:
+        prob_error = 0.
+    stats = dict(
+        utility_upper_bound=float(utility_bound),
+        construals_evaluated=len(evaluated),
+        skipped_solves=len(construals) - len(evaluated),
+        bound_solves=1,
+        obstacle_probs_error=float(prob_error)
+    )
+    return evaluated, np.array(utilities), stats
+
 def value_guided_construal(
     *,
     tile_array,
@@ -120,9 +429,40 @@ def value_guided_construal(
     initial_features=("S",),
     step_cost=-1,
     discount_rate=1.0-1e-5,
-    planning_alg="policy_iteration"
+    planning_alg="policy_iteration",
+    policy_evaluation="evaluate_on",
+    n_jobs=1,
+    search="exhaustive",
+    prob_tolerance=None
 ):
-    assert planning_alg in ("policy_iteration", "value_iteration")
+    """
+    If `n_jobs > 1`, construals are solved with policy iteration and
+    evaluated in the true maze by a pool of worker processes that is
+    started once per call (see `parallel_construal_evaluator`). The workers do not support other
+    values of `planning_alg` or `policy_evaluation`, so passing them
+    together with `n_jobs > 1` raises a ValueError.
+
+    With `search="branch_and_bound"`, construals that cannot have the
+    maximum value of representation are skipped
+    (see `branch_and_bound_construals`). The maximizing construals are
+    unchanged, and `search_stats` reports the skipped solves, the solve
+    needed for the bound, and a bound on the error of `obstacle_probs`.
+    """
+    assert planning_alg in (
+        "policy_iteration",
+        "value_iteration",
+        "lattice_policy_iteration",
+        "batched_policy_iteration",
+        "prioritized_value_iteration",
+        "topological_value_iteration"
+    )
+    assert policy_evaluation in ("evaluate_on", "batched")
+    assert search in ("exhaustive", "branch_and_bound")
+    if n_jobs > 1 and (planning_alg, policy_evaluation) != ("policy_iteration", "evaluate_on"):
+        raise ValueError(
+            f"n_jobs={n_jobs} only supports planning_alg='policy_iteration' and "
+            f"policy_evaluation='evaluate_on', got {planning_alg!r} and {policy_evaluation!r}"
+        )
     true_maze_params = dict(
         tile_array=tile_array,
         feature_rewards=feature_rewards,
@@ -141,20 +481,45 @@ def value_guided_construal(
     )
     true_maze = Maze(**true_maze_params)
     obstacle_chars = set(''.join(tile_array)) & set('0123456789')
+    construals = [''.join(sorted(c)) for c in powerset(obstacle_chars)]
+    planning_stats = []
+    def plan_and_evaluate_construals(construals):
+        utilities, stats = _plan_and_evaluate_construals(
+            true_maze, true_maze_params, construals, planning_alg, policy_evaluation
+        )
+        if stats is not None:
+            planning_stats.append(stats)
+        return utilities
+    if n_jobs > 1:
+        evaluator = parallel_construal_evaluator(true_maze_params, n_jobs=n_jobs)
+    else:
+        evaluator = contextlib.nullcontext(plan_and_evaluate_construals)
+    search_stats = None
+    with evaluator as evaluate_construals:
+        if search == "branch_and_bound":
+            construals, construal_utilities, search_stats = branch_and_bound_construals(
+                true_maze,
+                construals,
+                evaluate_construals,
+                construal_inverse_temp=construal_inverse_temp,
+                prob_tolerance=prob_tolerance
+            )
+        else:
+            construal_utilities = evaluate_construals(construals)
     vor = {}
-    for construal in powerset(obstacle_chars):
-        construal = ''.join(sorted(construal))
-        construed_maze = ConstruedMaze(true_maze_params, construal)
-        if planning_alg == "policy_iteration":
-            plan_res = PolicyIteration().plan_on(construed_maze)
-        elif planning_alg == "value_iteration":
-            plan_res = ValueIteration().plan_on(construed_maze)
-        assert plan_res.converged
-        policy_utility = plan_res.policy.evaluate_on(true_maze).initial_value
+    for construal, policy_utility in zip(construals, construal_utilities):
         vor[construal] = policy_utility - len(construal)
     c_dist = SoftmaxDistribution({c: v*construal_inverse_temp for c, v in vor.items()})
     obstacle_probs = {o: c_dist.expectation(lambda c: o in c) for o in obstacle_chars}
-    return dict(
+    res = dict(
         obstacle_probs=obstacle_probs,
-        value_of_representation=vor
-    )
\ No newline at end of file
+        value_of_representation=vor,
+        construals=construals,
+        construal_utilities=construal_utilities
+    )
+    if planning_stats:
+        # branch and bound plans each construal size level separately
+        res['planning_stats'] = planning_stats if search == "branch_and_bound" else planning_stats[0]
+    if search_stats is not None:
+        res['search_stats'] = search_stats
+    return res
\ No newline at end of file